@@ -0,0 +1,95 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Compare requests per second of the Pyramid router and the fast path
+
+Requests are made in process and in a single thread, so the results are
+per core and don't include any server or network overhead.
+
+"""
+import os
+import json
+import time
+from cStringIO import StringIO
+from optparse import OptionParser
+
+from paste.deploy import loadapp
+from webob import Request
+
+from queuey.fastpath import FastPath
+
+AUTH = {'Authorization': 'Application f25bfb8fe200475c8a0532a9cbe7651e'}
+DEFAULT_INI = os.path.join(os.path.dirname(__file__), os.pardir, 'queuey',
+                           'tests', 'test_memory.ini')
+
+
+def make_queue(app):
+    request = Request.blank('/v1/queuey', method='POST', headers=AUTH)
+    return str(json.loads(request.get_response(app).body)['queue_name'])
+
+
+def start_response(status, headers, exc_info=None):
+    assert status[:3] in ('200', '201'), status
+
+
+def run(app, environ, body, requests):
+    """Return the requests per second of ``requests`` calls with a copy of
+    ``environ``"""
+    start = time.time()
+    for x in range(requests):
+        env = environ.copy()
+        env['wsgi.input'] = StringIO(body)
+        ''.join(app(env, start_response))
+    return requests / (time.time() - start)
+
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("--ini", dest="ini", default=DEFAULT_INI,
+                      help="Configuration file of the application")
+    parser.add_option("--requests", dest="requests", type="int",
+                      default=2000, help="Requests per round")
+    parser.add_option("--rounds", dest="rounds", type="int",
+                      default=5, help="Rounds per request type, the best "
+                      "is reported")
+    parser.add_option("--message_size", dest="message_size", type="int",
+                      default=20, help="Message size (in bytes)")
+    parser.add_option("--limit", dest="limit", type="int",
+                      default=10, help="Messages per read")
+    (options, args) = parser.parse_args()
+
+    app = loadapp('config:%s' % os.path.abspath(options.ini))
+    # The pipeline ends with the Pyramid router
+    router = app
+    while not hasattr(router, 'registry'):
+        router = router.app
+    handlers = [('router', router), ('fast path', FastPath(router))]
+
+    queue_name = make_queue(router)
+    body = 'x' * options.message_size
+    push = Request.blank('/v1/queuey/%s' % queue_name, method='POST',
+                         headers=AUTH, body=body).environ
+    for x in range(options.limit):
+        run(router, push, body, 1)
+    read = Request.blank('/v1/queuey/%s?limit=%s' % (queue_name,
+                                                     options.limit),
+                         headers=AUTH).environ
+    # Reads go to a queue of its own so pushes don't change their size
+    read['PATH_INFO'] = read['PATH_INFO'].replace(queue_name,
+                                                  make_queue(router))
+    for x in range(options.limit):
+        run(router, dict(push, PATH_INFO=read['PATH_INFO']), body, 1)
+
+    print "%s requests per round, %s byte messages, %s messages per read" % (
+        options.requests, options.message_size, options.limit)
+    for name, environ in [('push', push), ('read', read)]:
+        best = dict((x[0], 0) for x in handlers)
+        # Alternate between the handlers so both see the same state
+        for x in range(options.rounds):
+            for handler_name, handler in handlers:
+                best[handler_name] = max(best[handler_name], run(
+                    handler, environ, body, options.requests))
+        print "%-5s router %7.0f req/s  fast path %7.0f req/s  (%.2fx)" % (
+            name, best['router'], best['fast path'],
+            best['fast path'] / best['router'])
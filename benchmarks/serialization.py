@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Compare JSON and MessagePack encoding of message batches"""
+import os
+import base64
+import time
+from optparse import OptionParser
+
+import msgpack
+import ujson
+
+
+def timed(func, value, rounds):
+    start = time.time()
+    for x in range(rounds):
+        result = func(value)
+    return result, time.time() - start
+
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("--rounds", dest="rounds", type="int",
+                      default=100, help="Amount of batches to encode")
+    parser.add_option("--messages", dest="messages", type="int",
+                      default=1000, help="Messages per batch")
+    parser.add_option("--message_size", dest="message_size", type="int",
+                      default=140, help="Message size (in bytes)")
+    (options, args) = parser.parse_args()
+
+    bodies = [os.urandom(options.message_size)
+              for x in range(options.messages)]
+    # JSON needs binary bodies base64 encoded, MessagePack takes them raw
+    batches = {
+        'ujson': {'messages': [
+            {'body': base64.b64encode(x), 'partition': 1, 'ttl': 3600}
+            for x in bodies]},
+        'msgpack': {'messages': [
+            {'body': x, 'partition': 1, 'ttl': 3600} for x in bodies]},
+    }
+    formats = [('ujson', ujson.dumps, ujson.loads),
+               ('msgpack', msgpack.packb, msgpack.unpackb)]
+
+    print "%s rounds of %s messages of %s bytes" % (
+        options.rounds, options.messages, options.message_size)
+    for name, dumps, loads in formats:
+        data, encode = timed(dumps, batches[name], options.rounds)
+        value, decode = timed(loads, data, options.rounds)
+        print "%-8s encode %.3fs  decode %.3fs  size %d bytes" % (
+            name, encode, decode, len(data))
@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Compare the message list validation against the plain colander schema"""
+import os
+import base64
+import random
+import time
+from optparse import OptionParser
+
+from queuey import validators
+
+
+def colander_path(messages, partitions):
+    schema = validators.MessageList().bind(max_partition=partitions)
+    return schema.deserialize(messages)
+
+
+def fast_path(messages, partitions):
+    return validators.deserialize_messages(messages, partitions)
+
+
+def run(func, batches, partitions):
+    start = time.time()
+    for batch in batches:
+        func(batch, partitions)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("--batches", dest="batches", type="int",
+                      default=100, help="Amount of batches to validate")
+    parser.add_option("--messages", dest="messages", type="int",
+                      default=1000, help="Messages per batch")
+    parser.add_option("--message_size", dest="message_size", type="int",
+                      default=140, help="Message size (in bytes)")
+    parser.add_option("--partitions", dest="partitions", type="int",
+                      default=10, help="Partitions of the queue")
+    (options, args) = parser.parse_args()
+
+    print "Constructing %s batches of %s messages..." % (options.batches,
+                                                       options.messages)
+    batches = []
+    for x in range(options.batches):
+        batches.append([{
+            'body': unicode(base64.b64encode(
+                os.urandom(options.message_size))),
+            'partition': random.randint(1, options.partitions),
+            'ttl': 3600,
+        } for y in range(options.messages)])
+
+    assert colander_path(batches[0], options.partitions) == \
+        fast_path(batches[0], options.partitions)
+
+    total = options.batches * options.messages
+    for name, func in [('colander', colander_path), ('fast path', fast_path)]:
+        elapsed = run(func, batches, options.partitions)
+        print "%-10s %.3f seconds, %d messages/second" % (
+            name, elapsed, total / elapsed)
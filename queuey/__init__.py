@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 import os
+import time
 
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
@@ -9,12 +10,28 @@ from pyramid.config import Configurator
 from metlog.config import client_from_dict_config
 from mozsvc.config import Config
 
+from queuey.encoding import GzipEncoding
+from queuey.events import EventHub
+from queuey.fastpath import FastPath
+from queuey.journal import Journal
+from queuey.notify import Notifier
+from queuey.offsets import OffsetCommitter
+from queuey.ratelimit import RateLimiter
 from queuey.resources import Root
 from queuey.security import QueueyAuthenticationPolicy
 from queuey.storage import configure_from_settings
+from queuey.storage.util import WorkerPool
+
+
+def get_section(config, section):
+    """Return the options of a config section, empty if it is missing"""
+    if not config.has_section(section):
+        return {}
+    return config.get_map(section)
 
 
 def main(global_config, **settings):
+    start = time.time()
     config_file = global_config['__file__']
     config_file = os.path.abspath(
                     os.path.normpath(
@@ -42,11 +59,53 @@ def main(global_config, **settings):
     config.registry['backend_metadata'] = configure_from_settings(
         'metadata', settings['config'].get_map('metadata'))
 
+    # Wakes up long-polling requests on new messages
+    config.registry['notifier'] = Notifier(
+        **get_section(settings['config'], 'long_polling'))
+    config.registry['event_hub'] = EventHub(
+        config.registry['backend_storage'], config.registry['notifier'],
+        **get_section(settings['config'], 'events'))
+
+    # Storage reads and deletes of several partitions of a request run
+    # concurrently on these threads, shared by all requests
+    workers = get_section(settings['config'], 'partition_workers')
+    config.registry['read_workers'] = WorkerPool(
+        int(workers.get('reads', 10)))
+    config.registry['delete_workers'] = WorkerPool(
+        int(workers.get('deletes', 10)))
+
+    # Consumer group offsets are written in batches
+    config.registry['offset_committer'] = OffsetCommitter(
+        config.registry['backend_metadata'],
+        **get_section(settings['config'], 'consumer_groups'))
+
+    # Compression of request and response bodies
+    config.registry['gzip_encoding'] = GzipEncoding(
+        **get_section(settings['config'], 'gzip'))
+    config.add_tween('queuey.encoding.gzip_tween_factory')
+
+    # Per-application rate limits, checked before any storage access
+    config.registry['rate_limiter'] = RateLimiter(
+        **get_section(settings['config'], 'rate_limits'))
+    config.add_tween('queuey.ratelimit.ratelimit_tween_factory')
+
     # Load the Metlog Client instance
     config.registry['metlog_client'] = client_from_dict_config(
         settings['config'].get_map('metlog')
     )
 
+    # Messages of weak consistency queues can be accepted into a local
+    # journal and written to the storage in the background
+    journal_settings = get_section(settings['config'], 'journal')
+    journal = None
+    if journal_settings:
+        journal = Journal(config.registry['backend_storage'],
+                          notifier=config.registry['notifier'],
+                          metlog=config.registry['metlog_client'],
+                          **journal_settings)
+        journal.start()
+    config.registry['journal'] = journal
+
     # Load the application keys
     app_vals = settings['config'].get_map('application_keys')
     app_keys = {}
@@ -63,4 +122,15 @@ def main(global_config, **settings):
 
     # Replace default renderer with ujson rendering
     config.add_renderer(None, 'queuey.views.UJSONRendererFactory')
-    return config.make_wsgi_app()
+    app = config.make_wsgi_app()
+
+    # Optionally answer message posts and reads without Pyramid traversal
+    fast_path = get_section(settings['config'], 'fast_path')
+    if str(fast_path.get('enabled')).lower() in ('true', 'yes', 'on', '1'):
+        app = FastPath(app)
+
+    # Record how long it took to create the app, this includes the storage
+    # backend connections and schema verification
+    config.registry['metlog_client'].timer_send(
+        'queuey.startup', int((time.time() - start) * 1000))
+    return app
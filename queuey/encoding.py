@@ -0,0 +1,125 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""gzip Content-Encoding of request and response bodies"""
+import zlib
+
+# Amount of compressed request data decompressed at once
+READ_SIZE = 64 * 1024
+
+# zlib window bits for data with a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class RequestTooLarge(Exception):
+    """Raised when a request body decompresses to more than allowed"""
+    status = 413
+
+
+class InvalidContentEncoding(Exception):
+    """Raised for request bodies that can't be decoded"""
+    status = 400
+
+
+class UnsupportedContentEncoding(Exception):
+    """Raised for request bodies in an unknown content encoding"""
+    status = 415
+
+
+class GzipEncoding(object):
+    """Decodes gzip request bodies and compresses responses
+
+    Request bodies are decompressed a chunk at a time and rejected as soon
+    as they exceed ``max_request_size`` bytes, so a small compressed body
+    can't exhaust the memory of a worker.
+
+    Responses of at least ``min_size`` bytes are compressed with the
+    compression ``level`` for clients accepting gzip. Streamed responses are
+    sent as they are.
+
+    """
+    def __init__(self, min_size=1024, level=6, max_request_size=10485760):
+        self.min_size = int(min_size)
+        self.level = int(level)
+        self.max_request_size = int(max_request_size)
+
+    def decode_body(self, request):
+        """Return the request body, decompressed if it is gzip encoded
+
+        The body is decoded once per request, later calls return it again
+        or raise the same error.
+
+        """
+        body = request.environ.get('queuey.decoded_body')
+        if body is None:
+            try:
+                body = self._decode(request)
+            except (RequestTooLarge, InvalidContentEncoding,
+                    UnsupportedContentEncoding), exc:
+                body = exc
+            request.environ['queuey.decoded_body'] = body
+        if isinstance(body, Exception):
+            raise body
+        return body
+
+    def _decode(self, request):
+        encoding = request.headers.get('Content-Encoding', '').strip().lower()
+        if encoding in ('', 'identity'):
+            return request.body
+        elif encoding not in ('gzip', 'x-gzip'):
+            raise UnsupportedContentEncoding(
+                "Unsupported Content-Encoding: %s" % encoding)
+        max_size = self.max_request_size
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        body_file = request.body_file
+        chunks = []
+        size = 0
+        try:
+            while True:
+                data = body_file.read(READ_SIZE)
+                if not data:
+                    break
+                while data:
+                    # Never decompress more than one byte over the limit
+                    chunk = decompressor.decompress(data, max_size + 1 - size)
+                    size += len(chunk)
+                    if size > max_size:
+                        raise RequestTooLarge(
+                            "Decompressed body exceeds %s bytes." % max_size)
+                    chunks.append(chunk)
+                    data = decompressor.unconsumed_tail
+            chunk = decompressor.flush()
+        except zlib.error:
+            raise InvalidContentEncoding("Unable to decompress gzip body.")
+        if size + len(chunk) > max_size:
+            raise RequestTooLarge(
+                "Decompressed body exceeds %s bytes." % max_size)
+        chunks.append(chunk)
+        return ''.join(chunks)
+
+    def encode_response(self, request, response):
+        """Compress the body of ``response`` if the client accepts gzip"""
+        if response.content_encoding or \
+           not isinstance(response.app_iter, (list, tuple)):
+            return
+        body = response.body
+        if len(body) < self.min_size:
+            return
+        response.vary = tuple(response.vary or ()) + ('Accept-Encoding',)
+        if 'gzip' not in request.accept_encoding:
+            return
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+        response.body = compressor.compress(body) + compressor.flush()
+        response.content_encoding = 'gzip'
+
+
+def gzip_tween_factory(handler, registry):
+    """Pyramid tween compressing responses with the ``gzip_encoding`` of
+    the registry"""
+    encoding = registry['gzip_encoding']
+
+    def gzip_tween(request):
+        response = handler(request)
+        encoding.encode_response(request, response)
+        return response
+    return gzip_tween
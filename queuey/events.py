@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Server-Sent Events subscriptions to queue partitions
+
+A single :class:`TailReader` per queue partition polls the storage for new
+messages and hands them to every :class:`Subscription` of that partition,
+so the storage load doesn't grow with the number of subscribers.
+
+"""
+from cdecimal import Decimal
+import logging
+import threading
+import time
+import Queue
+
+import ujson
+
+from queuey.resources import message_key
+from queuey.resources import transform_stored_message
+
+log = logging.getLogger(__name__)
+
+
+class TooManySubscribers(Exception):
+    """Raised when no more event streams can be opened"""
+    status = 503
+
+
+class TailReader(object):
+    """Reads new messages of one queue partition for all its subscribers"""
+    def __init__(self, hub, key, batch_size=100):
+        self.hub = hub
+        self.key = key
+        self.batch_size = batch_size
+        self.subscriptions = set()
+        self.position = None
+        self.started = Decimal(repr(time.time()))
+        self.event = threading.Event()
+
+    def start(self):
+        self.hub.notifier.register([self.key[1:3]], self.event)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def read(self):
+        """Return the messages stored since the last read"""
+        consistency, application, queue_name, decompress = self.key
+        start_at = self.position or self.started
+        messages = self.hub.storage.retrieve_batch(
+            consistency, application, [queue_name], start_at=start_at,
+            limit=self.batch_size, decompress=decompress)
+        if self.position:
+            position = message_key(self.position)
+            messages = [x for x in messages
+                        if message_key(x['message_id']) > position]
+        else:
+            messages = [x for x in messages if x['timestamp'] >= start_at]
+        if messages:
+            self.position = messages[-1]['message_id']
+        for msg in messages:
+            transform_stored_message(msg)
+        return messages
+
+    def run(self):
+        try:
+            while self.subscriptions:
+                try:
+                    messages = self.read()
+                except Exception:
+                    log.exception("Unable to read %s", self.key[2])
+                    messages = []
+                if messages:
+                    for subscription in list(self.subscriptions):
+                        subscription.deliver(messages)
+                if len(messages) < self.batch_size:
+                    self.event.wait(self.hub.poll_interval)
+                    self.event.clear()
+        finally:
+            self.hub.notifier.unregister([self.key[1:3]], self.event)
+
+
+class Subscription(object):
+    """A stream of messages from queue partitions
+
+    ``positions`` maps partitions to the message id or timestamp to start
+    after, messages of other partitions are delivered from the time of
+    subscription.
+
+    Iterating the subscription yields Server-Sent Events, it is used as
+    WSGI response body so the server closes it once the client is gone.
+
+    At most ``max_pending`` deliveries wait for the client. A client that
+    falls further behind is disconnected, it reconnects with the id of the
+    last event it got and catches up from the storage.
+
+    """
+    def __init__(self, hub, consistency, application, queue_name, partitions,
+                 decompress=False, positions=None, max_pending=100):
+        self.hub = hub
+        self.consistency = consistency
+        self.application = application
+        self.queue_name = queue_name
+        self.partitions = partitions
+        self.decompress = decompress
+        self.positions = dict(positions or {})
+        self.messages = Queue.Queue(max_pending)
+        self.keys = [(consistency, application, '%s:%s' % (queue_name, x),
+                      decompress) for x in partitions]
+        self.closed = False
+        self.dropped = False
+
+    def deliver(self, messages):
+        try:
+            self.messages.put_nowait(messages)
+        except Queue.Full:
+            # Don't buffer without bounds for a client that can't keep up
+            self.dropped = True
+            self.close()
+
+    def _replay(self):
+        """Yield the stored messages after the requested positions"""
+        for partition in self.partitions:
+            start_at = self.positions.get(partition)
+            if start_at is None:
+                continue
+            position = None
+            if isinstance(start_at, basestring):
+                position = message_key(start_at)
+            messages = self.hub.storage.retrieve_iter(
+                self.consistency, self.application,
+                ['%s:%s' % (self.queue_name, partition)], start_at=start_at,
+                decompress=self.decompress)
+            for msg in messages:
+                if position and message_key(msg['message_id']) <= position:
+                    continue
+                transform_stored_message(msg)
+                yield msg
+
+    def _new(self, messages):
+        """Filter out messages already delivered by the replay"""
+        for msg in messages:
+            start_at = self.positions.get(msg['partition'])
+            if isinstance(start_at, basestring) and \
+               message_key(msg['message_id']) <= message_key(start_at):
+                continue
+            yield msg
+
+    def _event(self, msg):
+        self.positions[msg['partition']] = msg['message_id']
+        cursor = ','.join('%s:%s' % (x, y) for x, y in
+                          sorted(self.positions.items())
+                          if isinstance(y, basestring))
+        return 'id: %s\ndata: %s\n\n' % (cursor, ujson.dumps(msg))
+
+    def __iter__(self):
+        """Yield Server-Sent Events for all messages, and a comment every
+        ``keepalive`` seconds while there are none"""
+        yield ': connected\n\n'
+        for msg in self._replay():
+            yield self._event(msg)
+        while not self.closed:
+            try:
+                messages = self.messages.get(timeout=self.hub.keepalive)
+            except Queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if self.dropped:
+                break
+            for msg in self._new(messages):
+                yield self._event(msg)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.hub.unsubscribe(self)
+
+
+class EventHub(object):
+    """Keeps one :class:`TailReader` per queue partition with subscribers
+
+    At most ``max_subscribers`` streams are open at the same time. Every
+    stream holds on to a worker of the server for its lifetime, as WSGI
+    has no way to hand a response body over to another thread. With a
+    threaded server this has to stay well below the number of threads,
+    long-lived streams are best served by an evented worker. On top of
+    that every partition with subscribers has a reader thread of its own.
+
+    Streams are only served when ``enabled``, which deployments on an
+    evented worker opt into.
+
+    """
+    def __init__(self, storage, notifier, enabled=False, max_subscribers=10,
+                 poll_interval=1, keepalive=15, max_pending=100):
+        self.storage = storage
+        self.notifier = notifier
+        self.enabled = str(enabled).lower() in ('true', 'yes', 'on', '1')
+        self.max_subscribers = int(max_subscribers)
+        self.max_pending = int(max_pending)
+        self.poll_interval = float(poll_interval)
+        self.keepalive = float(keepalive)
+        self.readers = {}
+        self.subscribers = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, consistency, application, queue_name, partitions,
+                  decompress=False, positions=None):
+        """Return a new :class:`Subscription` to the partitions"""
+        subscription = Subscription(self, consistency, application,
+                                    queue_name, partitions, decompress,
+                                    positions, self.max_pending)
+        started = []
+        with self._lock:
+            if self.subscribers >= self.max_subscribers:
+                raise TooManySubscribers("Too many open event streams.")
+            self.subscribers += 1
+            for key in subscription.keys:
+                reader = self.readers.get(key)
+                if reader is None:
+                    reader = self.readers[key] = TailReader(self, key)
+                    started.append(reader)
+                reader.subscriptions.add(subscription)
+        for reader in started:
+            reader.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscribers -= 1
+            for key in subscription.keys:
+                reader = self.readers.get(key)
+                if reader is None:
+                    continue
+                reader.subscriptions.discard(subscription)
+                if not reader.subscriptions:
+                    del self.readers[key]
+                    reader.event.set()
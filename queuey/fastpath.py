@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Lean dispatch of message posts and reads
+
+Pushing to and reading from a queue are by far the most frequent requests.
+:class:`FastPath` answers them without the traversal, view lookup and view
+predicate machinery of Pyramid, while still running them through the tweens
+and exception views of the application.
+
+"""
+from pyramid.events import NewRequest
+from pyramid.events import NewResponse
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.interfaces import IAuthorizationPolicy
+from pyramid.interfaces import IRequest
+from pyramid.interfaces import IRequestFactory
+from pyramid.interfaces import IResponse
+from pyramid.interfaces import ITweens
+from pyramid.renderers import RendererHelper
+from pyramid.request import Request
+from pyramid.threadlocal import manager
+from pyramid.tweens import excview_tween_factory
+
+from queuey import views
+from queuey.resources import Application
+
+
+class FastPath(object):
+    """WSGI application answering ``POST`` and ``GET`` requests to
+    ``/v1/<application>/<queue_name>`` directly and passing all others on to
+    the Pyramid ``router``
+
+    Requests use the authentication and authorization policies, resources
+    and views of the application and go through the same tweens, so
+    responses are the same as those of the router.
+
+    """
+    def __init__(self, router):
+        self.router = router
+        self.registry = registry = router.registry
+        query = registry.queryUtility
+        self.authn_policy = query(IAuthenticationPolicy)
+        self.authz_policy = query(IAuthorizationPolicy)
+        self.request_factory = query(IRequestFactory, default=Request)
+        self.renderer = RendererHelper(name=None, package='queuey',
+                                       registry=registry)
+        tweens = query(ITweens) or excview_tween_factory
+        self.handle_request = tweens(self.handle_request, registry)
+
+    def dispatch(self, environ):
+        """Return the application and queue name of a hot request, or
+        ``None`` for requests left to the router"""
+        if environ['REQUEST_METHOD'] not in ('GET', 'POST'):
+            return None
+        segments = environ.get('PATH_INFO', '').split('/')
+        if len(segments) != 4 or segments[0] or segments[1] != 'v1' or \
+           not segments[3] or segments[3].startswith('@@') or \
+           '%' in segments[3]:
+            return None
+        if segments[2] not in self.registry['app_names']:
+            return None
+        try:
+            return segments[2], segments[3].decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    def view(self, request):
+        """Return the view and permission of a hot request"""
+        if request.method == 'GET':
+            return views.get_messages, 'view'
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return views.new_messages, 'create'
+        elif content_type.startswith(views.MSGPACK):
+            return views.new_messages_msgpack, 'create'
+        return views.new_message, 'create'
+
+    def handle_request(self, request):
+        request.request_iface = IRequest
+        registry = request.registry
+        registry.has_listeners and registry.notify(NewRequest(request))
+        application_name, queue_name = request.fast_path
+        context = Application(request, application_name)[queue_name]
+        request.context = context
+        view, permission = self.view(request)
+        principals = self.authn_policy.effective_principals(request)
+        permitted = self.authz_policy.permits(context, principals,
+                                              permission)
+        if not permitted:
+            raise HTTPForbidden('Unauthorized: %s failed permission check' %
+                                view.__name__, result=permitted)
+        result = view(context, request)
+        if registry.queryAdapterOrSelf(result, IResponse) is not None:
+            return result
+        return self.renderer.render_view(request, result, view, context)
+
+    def __call__(self, environ, start_response):
+        target = self.dispatch(environ)
+        if target is None:
+            return self.router(environ, start_response)
+        registry = self.registry
+        request = self.request_factory(environ)
+        request.fast_path = target
+        manager.push({'registry': registry, 'request': request})
+        request.registry = registry
+        try:
+            try:
+                response = self.handle_request(request)
+                registry.has_listeners and registry.notify(
+                    NewResponse(request, response))
+                if request.response_callbacks:
+                    request._process_response_callbacks(response)
+                return response(request.environ, start_response)
+            finally:
+                if request.finished_callbacks:
+                    request._process_finished_callbacks()
+        finally:
+            manager.pop()
@@ -0,0 +1,335 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Write-behind journal of accepted messages
+
+Messages are appended to segment files in a local directory and written to
+the storage by a background thread. Every append is a frame of a length and
+CRC32 header followed by a pickled batch of messages, so a frame torn by a
+crash is recognized and skipped.
+
+"""
+from cdecimal import Decimal
+import cPickle
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+log = logging.getLogger(__name__)
+
+DECIMAL_1E7 = Decimal('1e7')
+
+# Payload length and CRC32 of a frame
+HEADER = struct.Struct('>II')
+
+SEGMENT_SUFFIX = '.journal'
+
+
+def segment_name(number):
+    return '%020d%s' % (number, SEGMENT_SUFFIX)
+
+
+def read_frames(segment_file, offset, end=None):
+    """Yield ``(offset, end_offset, payload)`` of the complete frames of a
+    segment file from ``offset`` on, stopping at ``end`` or the first
+    incomplete or corrupt frame"""
+    segment_file.seek(offset)
+    while end is None or offset < end:
+        header = segment_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        length, crc = HEADER.unpack(header)
+        payload = segment_file.read(length)
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            return
+        next_offset = offset + HEADER.size + length
+        yield offset, next_offset, payload
+        offset = next_offset
+
+
+class Journal(object):
+    """Accepts messages into a local journal and pushes them to the storage
+    in the background
+
+    Appends are made durable with a group ``fsync``, concurrent appends
+    share a single one. A flusher thread reads up to ``batch_size``
+    messages at a time, pushes them with their already assigned ids and
+    records its position in a checkpoint file. Failed pushes are retried
+    every ``retry_interval`` seconds. On startup everything after the
+    checkpoint is pushed again, which overwrites messages with the same ids
+    instead of duplicating them.
+
+    New segment files are started once a segment reaches ``segment_size``
+    bytes and with every start, fully pushed segments are removed.
+
+    The ids of the messages not pushed yet are kept in memory, see
+    :meth:`pending`. Deleting or updating them in the storage would be
+    undone by their push.
+
+    """
+    def __init__(self, storage, path, notifier=None, metlog=None,
+                 batch_size=500, flush_interval=0.1, retry_interval=5,
+                 segment_size=67108864):
+        self.storage = storage
+        self.path = path
+        self.notifier = notifier
+        self.metlog = metlog
+        self.batch_size = int(batch_size)
+        self.flush_interval = float(flush_interval)
+        self.retry_interval = float(retry_interval)
+        self.segment_size = int(segment_size)
+        self.pushed = 0
+        self.failures = 0
+        self._event = threading.Event()
+        self._write_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._thread = None
+        self._head_time = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        segments = self._segments()
+        self._read_segment, self._read_offset = self._checkpoint(segments)
+        self._pending = self._scan(segments)
+
+        # Never append to a segment that might end in a torn frame
+        self._segment = (segments[-1] if segments else 0) + 1
+        self._open_segment()
+        self._frames = 0
+        self._synced_frames = 0
+        self._synced = (self._segment, 0)
+
+    def _segments(self):
+        return sorted(int(x[:-len(SEGMENT_SUFFIX)])
+                      for x in os.listdir(self.path)
+                      if x.endswith(SEGMENT_SUFFIX))
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, segment_name(number))
+
+    def _checkpoint(self, segments):
+        """Return the segment and offset to continue pushing at"""
+        try:
+            with open(os.path.join(self.path, 'checkpoint')) as checkpoint:
+                segment, offset = [int(x) for x in checkpoint.read().split()]
+        except (IOError, ValueError):
+            segment, offset = 0, 0
+        if segment in segments:
+            return segment, offset
+        later = [x for x in segments if x > segment]
+        return (later[0] if later else segment), 0
+
+    def _write_checkpoint(self):
+        path = os.path.join(self.path, 'checkpoint')
+        with open(path + '.tmp', 'w') as checkpoint:
+            checkpoint.write('%s %s' % (self._read_segment, self._read_offset))
+        os.rename(path + '.tmp', path)
+
+    def _scan(self, segments):
+        """Return the ids of the messages left to push in the segments"""
+        ids = set()
+        for segment in segments:
+            if segment < self._read_segment:
+                continue
+            offset = self._read_offset if segment == self._read_segment \
+                else 0
+            with open(self._segment_path(segment), 'rb') as segment_file:
+                for _, _, payload in read_frames(segment_file, offset):
+                    ids.update(x[4] for x in cPickle.loads(payload)[4])
+        return ids
+
+    @property
+    def backlog(self):
+        """The amount of messages not pushed yet"""
+        return len(self._pending)
+
+    def _open_segment(self):
+        self._file = open(self._segment_path(self._segment), 'ab')
+        self._size = 0
+
+    def start(self):
+        """Start pushing the journal to the storage"""
+        if self._thread is None:
+            self._thread = thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def append(self, application_name, consistency, compress, message_data):
+        """Journal a batch of messages for :meth:`storage.push_batch`, returns
+        the assigned message ids and timestamps once they are durable"""
+        records = []
+        results = []
+        for queue_name, body, ttl, metadata in message_data:
+            msg_id = uuid.uuid1()
+            records.append((queue_name, body, ttl, metadata, msg_id.hex))
+            results.append((msg_id.hex,
+                            Decimal(msg_id.time - 0x01b21dd213814000L) /
+                            DECIMAL_1E7))
+        payload = cPickle.dumps((time.time(), application_name, consistency,
+                                 compress, records), 2)
+        frame = HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+        with self._write_lock:
+            if self._size >= self.segment_size:
+                self._rotate()
+            self._file.write(frame + payload)
+            self._size += len(frame) + len(payload)
+            self._frames += 1
+            self._pending.update(x[4] for x in records)
+            frame_number = self._frames
+        self._sync(frame_number)
+        self._event.set()
+        return results
+
+    def pending(self, message_ids):
+        """Return the hex ``message_ids`` that are journaled but not
+        pushed to the storage yet"""
+        with self._write_lock:
+            return [x for x in message_ids if x.lower() in self._pending]
+
+    def _rotate(self):
+        """Continue with a new segment, called with the write lock held"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._segment += 1
+        self._open_segment()
+        self._synced = (self._segment, 0)
+
+    def _sync(self, frame_number):
+        """Make sure the frame ``frame_number`` is on disk"""
+        with self._sync_lock:
+            if self._synced_frames >= frame_number:
+                # Synced along with another append
+                return
+            with self._write_lock:
+                self._file.flush()
+                frames = self._frames
+                position = (self._segment, self._size)
+                # Rotations may close the file while it is synced
+                fileno = os.dup(self._file.fileno())
+            try:
+                os.fsync(fileno)
+            finally:
+                os.close(fileno)
+            self._synced_frames = frames
+            with self._write_lock:
+                self._synced = max(self._synced, position)
+
+    def _read(self):
+        """Return the next synced frames up to ``batch_size`` messages, and
+        the position after them"""
+        frames = []
+        count = 0
+        segment, offset = self._read_segment, self._read_offset
+        while count < self.batch_size:
+            synced_segment, synced_offset = self._synced
+            if segment > synced_segment:
+                break
+            end = synced_offset if segment == synced_segment else None
+            path = self._segment_path(segment)
+            if os.path.exists(path):
+                with open(path, 'rb') as segment_file:
+                    for _, offset, payload in read_frames(segment_file,
+                                                          offset, end):
+                        frame = cPickle.loads(payload)
+                        frames.append(frame)
+                        count += len(frame[4])
+                        if count >= self.batch_size:
+                            break
+            if count >= self.batch_size or segment == synced_segment:
+                break
+            # The rest of an older segment is either pushed or torn
+            segment, offset = segment + 1, 0
+        return frames, (segment, offset)
+
+    def _push(self, frames):
+        """Push the messages of the frames, batched by application,
+        consistency and compression"""
+        batches = {}
+        for _, application, consistency, compress, records in frames:
+            batch = batches.setdefault((application, consistency, compress),
+                                       [])
+            batch.extend(records)
+        for (application, consistency, compress), records in batches.items():
+            self.storage.push_batch(
+                consistency, application, [x[:4] for x in records],
+                compress=compress, message_ids=[x[4] for x in records])
+            if self.notifier:
+                self.notifier.notify(set((application, x[0])
+                                         for x in records))
+
+    def _advance(self, position, ids):
+        """Move past the pushed message ``ids``, removing finished
+        segments"""
+        segment = self._read_segment
+        self._read_segment, self._read_offset = position
+        self._write_checkpoint()
+        self.pushed += len(ids)
+        with self._write_lock:
+            self._pending.difference_update(ids)
+        while segment < self._read_segment:
+            path = self._segment_path(segment)
+            if os.path.exists(path):
+                os.remove(path)
+            segment += 1
+
+    def _flush_batch(self):
+        """Push the next batch, returns the amount of messages pushed"""
+        frames, position = self._read()
+        if not frames:
+            self._head_time = None
+            if position != (self._read_segment, self._read_offset):
+                self._advance(position, ())
+            return 0
+        self._head_time = frames[0][0]
+        ids = [x[4] for frame in frames for x in frame[4]]
+        count = len(ids)
+        self._push(frames)
+        if self.metlog:
+            self.metlog.incr('queuey.journal.pushed', count=count)
+            self.metlog.timer_send(
+                'queuey.journal.lag',
+                int((time.time() - self._head_time) * 1000))
+        self._advance(position, ids)
+        return count
+
+    def flush(self):
+        """Push all journaled messages, returns the amount pushed
+
+        Only to be used while the journal isn't started.
+
+        """
+        total = 0
+        while True:
+            count = self._flush_batch()
+            if not count:
+                return total
+            total += count
+
+    def _run(self):
+        while True:
+            try:
+                count = self._flush_batch()
+            except Exception:
+                self.failures += 1
+                log.exception("Unable to push journaled messages")
+                time.sleep(self.retry_interval)
+                continue
+            if count < self.batch_size:
+                self._event.wait(self.flush_interval)
+                self._event.clear()
+
+    def stats(self):
+        """Return the backlog and lag of the journal"""
+        head_time = self._head_time
+        return {
+            'backlog': self.backlog,
+            'lag': time.time() - head_time if head_time else 0,
+            'pushed': self.pushed,
+            'failures': self.failures,
+            'segments': len(self._segments()),
+        }
@@ -0,0 +1,42 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Data migrations for existing Queuey deployments. Run with the same ini file
+the application uses, e.g.::
+
+    bin/queuey-migrate etc/production.ini
+
+"""
+import os
+import sys
+from optparse import OptionParser
+
+from mozsvc.config import Config
+
+from queuey.storage import configure_from_settings
+
+
+def backfill_queue_index(config):
+    """Populate the per-application queue index rows"""
+    metadata = configure_from_settings('metadata', config.get_map('metadata'))
+    if not hasattr(metadata, 'backfill_queue_index'):
+        print("Metadata backend has no queue index, nothing to migrate.")
+        return
+    count = metadata.backfill_queue_index()
+    print("Indexed %s queues." % count)
+
+
+def main(args=None):
+    usage = "usage: %prog config_file"
+    parser = OptionParser(usage=usage)
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("A config file is required.")
+    config_file = os.path.abspath(os.path.expanduser(args[0]))
+    backfill_queue_index(Config(config_file))
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
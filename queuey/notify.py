@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""In-process notification of new messages for long-polling requests"""
+from collections import defaultdict
+import threading
+import time
+
+
+class Notifier(object):
+    """Wakes up requests waiting for messages on queue partitions
+
+    Pushes handled by this process wake the waiters of the partitions
+    directly. Pushes landing on other nodes are picked up by re-checking
+    every ``recheck_interval`` seconds.
+
+    Every waiter holds on to the worker serving its request. WSGI has no
+    way to hand a pending response back to the server, so with a threaded
+    server like the Paste threadpool a waiter pins a thread. At most
+    ``max_waiters`` requests wait at the same time so such a server always
+    has workers left for other requests, requests beyond that are
+    answered right away. With cooperative workers, like gunicorn's gevent
+    worker, a waiter only parks a greenlet on its event, and
+    ``max_waiters`` can be raised accordingly.
+
+    """
+    def __init__(self, max_waiters=20, recheck_interval=2):
+        self.max_waiters = int(max_waiters)
+        self.recheck_interval = float(recheck_interval)
+        self.waiters = 0
+        self._events = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def register(self, keys, event):
+        """Set ``event`` whenever one of the ``keys`` is notified"""
+        with self._lock:
+            for key in keys:
+                self._events[key].add(event)
+
+    def unregister(self, keys, event):
+        with self._lock:
+            for key in keys:
+                events = self._events.get(key)
+                if events is None:
+                    continue
+                events.discard(event)
+                if not events:
+                    del self._events[key]
+
+    def notify(self, keys):
+        """Wake up everyone waiting on one of the ``keys``"""
+        with self._lock:
+            events = set()
+            for key in keys:
+                events.update(self._events.get(key, ()))
+        for event in events:
+            event.set()
+
+    def wait(self, keys, timeout, check):
+        """Wait up to ``timeout`` seconds until ``check`` returns a true
+        value
+
+        ``check`` is called right away, after every notification for one of
+        the ``keys`` and every ``recheck_interval`` seconds. The last result
+        of ``check`` is returned.
+
+        """
+        if timeout <= 0:
+            return check()
+        with self._lock:
+            full = self.waiters >= self.max_waiters
+            if not full:
+                self.waiters += 1
+        if full:
+            return check()
+        event = threading.Event()
+        self.register(keys, event)
+
+        try:
+            deadline = time.time() + timeout
+            while True:
+                result = check()
+                remaining = deadline - time.time()
+                if result or remaining <= 0:
+                    return result
+                event.wait(min(remaining, self.recheck_interval))
+                event.clear()
+        finally:
+            self.unregister(keys, event)
+            with self._lock:
+                self.waiters -= 1
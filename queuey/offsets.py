@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Batched commits of consumer group offsets"""
+import atexit
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class OffsetCommitter(object):
+    """Collects consumer group offsets and stores them in batches
+
+    Commits are kept in memory and written to the metadata backend every
+    ``interval`` seconds, or as soon as ``max_pending`` partitions are
+    waiting. Within the process a commit is visible right away, other
+    processes see it once it was written.
+
+    """
+    def __init__(self, metadata, interval=1, max_pending=1000):
+        self.metadata = metadata
+        self.interval = float(interval)
+        self.max_pending = int(max_pending)
+        self._pending = {}
+        self._count = 0
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+        # Don't lose the last commits on a clean shutdown
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._event.wait(self.interval)
+            self._event.clear()
+            self.flush()
+
+    def commit(self, application, queue_name, group, offsets):
+        """Commit ``offsets``, a dict of message ids keyed by partition"""
+        if self._thread is None:
+            self._start()
+        key = (application, queue_name, group)
+        with self._lock:
+            pending = self._pending.setdefault(key, {})
+            self._count -= len(pending)
+            pending.update(offsets)
+            self._count += len(pending)
+            full = self._count >= self.max_pending
+        if full:
+            self._event.set()
+
+    def offsets(self, application, queue_name, group):
+        """Return the offsets of a group, including pending commits"""
+        offsets = self.metadata.consumer_offsets(application, queue_name,
+                                                 group)
+        with self._lock:
+            offsets.update(self._pending.get(
+                (application, queue_name, group), {}))
+        return offsets
+
+    def flush(self):
+        """Write all pending commits"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._count = 0
+        if not pending:
+            return
+        try:
+            self.metadata.commit_offsets(pending)
+        except Exception:
+            log.exception("Unable to store %s consumer group offsets",
+                          len(pending))
+            # Keep them for the next attempt, unless committed again since
+            with self._lock:
+                for key, offsets in pending.items():
+                    current = self._pending.setdefault(key, {})
+                    for partition, msg_id in offsets.items():
+                        if partition not in current:
+                            current[partition] = msg_id
+                            self._count += 1
@@ -0,0 +1,232 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Per-application token bucket rate limits"""
+import math
+import threading
+import time
+
+from pyramid.response import Response
+from pyramid.security import effective_principals
+import ujson
+
+from queuey.security import InvalidApplicationKey
+
+# Kinds of limits, in requests or request body bytes per second
+LIMITS = ('pushes', 'reads', 'bytes')
+
+# Seconds between checks for buckets that can be dropped
+SWEEP_INTERVAL = 60
+
+
+class RateLimited(Exception):
+    """Raised for requests over the rate limit of their application"""
+    status = 429
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """Allows ``rate`` units per second in bursts of up to ``capacity``"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = now or time.time()
+
+    def take(self, amount, now):
+        """Take ``amount`` units, returns ``0`` if they were available and
+        the seconds until they are otherwise
+
+        Amounts larger than the capacity are taken from a full bucket,
+        leaving it in debt for the following requests.
+
+        """
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(amount, self.capacity)
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+        self.tokens -= amount
+        return 0
+
+    def full(self, now):
+        """Whether the bucket refilled completely, so it's no different
+        from a new one"""
+        return self.tokens + (now - self.updated) * self.rate >= \
+            self.capacity
+
+
+class RateLimiter(object):
+    """Keeps a token bucket per application and kind of limit
+
+    The ``pushes``, ``reads`` and ``bytes`` limits are per second and apply
+    to every application, options named ``<application>.<limit>`` override
+    them for one application. A limit of ``0`` disables it. Buckets hold
+    ``burst`` seconds worth of their limit. With ``per_queue`` every queue
+    of an application gets its own buckets. Anonymous requests get buckets
+    of their own, apart from those of the application.
+
+    Buckets that refilled completely are dropped every ``SWEEP_INTERVAL``
+    seconds, or once ``max_buckets`` are kept. While that many are still in
+    use, queues without buckets share those of their application.
+
+    Buckets are kept in process. When ``nodes`` processes serve the
+    applications, each enforces its share of the limits, which
+    approximates cluster wide limits without any coordination as long as
+    the load balancer spreads requests evenly.
+
+    """
+    def __init__(self, pushes=0, reads=0, bytes=0, burst=1, per_queue=False,
+                 nodes=1, max_buckets=10000, **overrides):
+        nodes = int(nodes)
+        self.burst = float(burst)
+        self.max_buckets = int(max_buckets)
+        self.per_queue = str(per_queue).lower() in ('true', 'yes', 'on', '1')
+        defaults = {'pushes': pushes, 'reads': reads, 'bytes': bytes}
+        self.defaults = dict((x, float(y) / nodes)
+                             for x, y in defaults.items())
+        self.overrides = {}
+        for name, value in overrides.items():
+            application, _, kind = name.rpartition('.')
+            if kind not in LIMITS or not application:
+                raise ValueError("Unknown rate limit option: %s" % name)
+            self.overrides[(application, kind)] = float(value) / nodes
+        self._buckets = {}
+        self._swept = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return any(self.defaults.values()) or any(self.overrides.values())
+
+    def limit(self, application, kind):
+        """Return the limit per second of ``kind`` for the application"""
+        return self.overrides.get((application, kind), self.defaults[kind])
+
+    def check(self, application, queue_name, kind, amount=1,
+              anonymous=False):
+        """Take ``amount`` from the bucket of the application, raises
+        :class:`RateLimited` if it is over the limit
+
+        Requests without an authenticated application pass the application
+        of their URL and ``anonymous``, they don't use up the limits of the
+        application's own requests.
+
+        """
+        rate = self.limit(application, kind)
+        if not rate:
+            return
+        key = (application, anonymous,
+               queue_name if self.per_queue else None, kind)
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if now - self._swept >= SWEEP_INTERVAL or \
+                   (len(self._buckets) >= self.max_buckets and
+                    now - self._swept >= 1):
+                    self._sweep(now)
+                if len(self._buckets) >= self.max_buckets and key[2]:
+                    key = (application, anonymous, None, kind)
+                    bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(
+                    rate, max(rate * self.burst, 1), now)
+            wait = bucket.take(amount, now)
+        if wait:
+            raise RateLimited("Rate limit of %s exceeded." % kind,
+                              int(math.ceil(wait)))
+
+    def _sweep(self, now):
+        """Drop the buckets that refilled completely"""
+        self._swept = now
+        for key, bucket in self._buckets.items():
+            if bucket.full(now):
+                del self._buckets[key]
+
+
+def classify(request):
+    """Return the application, queue name and kinds of limits applying to
+    a request, judged from its path alone"""
+    segments = [x for x in request.path_info.split('/') if x]
+    if len(segments) < 2 or segments[0] != 'v1':
+        return None, None, ()
+    application = segments[1]
+    rest = segments[2:]
+    queue_name = None
+    if rest and not rest[0].startswith('@@'):
+        queue_name = rest.pop(0)
+    view = rest[0][2:] if rest and rest[0].startswith('@@') else None
+    method = request.method
+    if method == 'POST' and (view == 'push' or
+                             (queue_name and not rest)):
+        return application, queue_name, ('pushes', 'bytes')
+    elif (method == 'GET' and queue_name) or \
+            (method == 'POST' and view in ('fetch', 'claim')):
+        return application, queue_name, ('reads',)
+    return application, queue_name, ()
+
+
+def ratelimit_tween_factory(handler, registry):
+    """Pyramid tween rejecting requests over the rate limits of the
+    ``rate_limiter`` of the registry before any storage is accessed
+
+    The error response is made here, the request isn't routed to any view
+    yet. The ``bytes`` limit counts the body as the views get it, decoded
+    by the ``gzip_encoding`` of the registry.
+
+    """
+    limiter = registry['rate_limiter']
+    if not limiter.enabled:
+        return handler
+    metlog = registry['metlog_client']
+    encoding = registry['gzip_encoding']
+
+    def ratelimit_tween(request):
+        url_application, queue_name, kinds = classify(request)
+        if kinds:
+            # Limits apply to the authenticated application, the one in the
+            # URL mustn't pay for requests anyone can make
+            try:
+                effective_principals(request)
+            except InvalidApplicationKey:
+                # Rejected once routed
+                return handler(request)
+            application = getattr(request, 'application_name', None)
+            anonymous = application is None
+            if anonymous:
+                application = url_application
+            try:
+                for kind in kinds:
+                    amount = 1
+                    if kind == 'bytes':
+                        if not limiter.limit(application, kind):
+                            continue
+                        try:
+                            amount = len(encoding.decode_body(request))
+                        except Exception:
+                            # The view answers with the same error
+                            return handler(request)
+                        if not amount:
+                            continue
+                    limiter.check(application, queue_name, kind, amount,
+                                  anonymous)
+            except RateLimited, exc:
+                metlog.incr('%s.%srate_limited' % (
+                    application, 'anonymous.' if anonymous else ''))
+                response = Response(status='429 Too Many Requests',
+                                    content_type='application/json')
+                response.retry_after = exc.retry_after
+                response.body = ujson.dumps({
+                    'status': 'error',
+                    'error_msg': {'RateLimited': str(exc)}
+                })
+                return response
+        return handler(request)
+    return ratelimit_tween
@@ -1,18 +1,42 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import base64
 import collections
 from cdecimal import Decimal
+import hashlib
+import heapq
+import itertools
+import operator
+import random
 import re
+import uuid
 
 from pyramid.security import Allow
 from pyramid.security import Everyone
+from pyramid.security import has_permission
 
+import colander
+import ujson
+
+from queuey import validators
 
 DECIMAL_REGEX = re.compile(r'^\d+(\.\d+)?$')
-MESSAGE_REGEX = re.compile(
-    r'(?:\d\:)?[a-zA-Z0-9]{32}(?:\,(?:\d{1,3}\:)?[a-zA-Z0-9]{32}){0,}'
-)
+HEX_REGEX = re.compile(r'^[a-fA-F0-9]{32}$')
+
+# Messages returned by merged reads without a limit
+MERGE_LIMIT = 100
+
+# Message id of message dicts and of storage rows
+MESSAGE_ID = operator.itemgetter('message_id')
+ROW_ID = operator.itemgetter(0)
+
+# Queue name of stored message dicts and of storage rows
+QUEUE_NAME = operator.itemgetter('queue_name')
+ROW_QUEUE_NAME = operator.itemgetter(3)
+
+# UUID time of the unix epoch
+UUID_EPOCH = 0x01b21dd213814000L
 
 
 class InvalidQueueName(Exception):
@@ -30,13 +54,268 @@ class InvalidMessageID(Exception):
     status = 400
 
 
+class InvalidCursor(Exception):
+    """Raised for cursors that can't be decoded"""
+    status = 400
+
+
+class StaleGeneration(Exception):
+    """Raised for consumer group commits with an outdated assignment"""
+    status = 409
+
+
+class MessagesPending(Exception):
+    """Raised for changes of messages still waiting in the journal"""
+    status = 409
+
+
+class UnassignedPartitions(Exception):
+    """Raised for consumer group commits of partitions the committing
+    member isn't assigned"""
+    status = 409
+
+
+def message_key(message_id):
+    """Return a key ordering message ids like the storage does"""
+    msg_id = uuid.UUID(hex=message_id)
+    return (msg_id.time, msg_id.bytes)
+
+
+def merge_key(message, order='ascending'):
+    """Return a key sorting messages of different partitions in ``order``"""
+    msg_id = uuid.UUID(hex=message['message_id'])
+    if order == 'descending':
+        return (-msg_id.time, -msg_id.int)
+    return (msg_id.time, msg_id.int)
+
+
+def merge_messages(streams, order='ascending'):
+    """Merge message streams, each sorted in ``order``, into one sorted
+    stream
+
+    Only the head of every stream is held, so a stream is read no further
+    than the merged messages taken from it.
+
+    """
+    heap = []
+    for index, stream in enumerate(streams):
+        stream = iter(stream)
+        for msg in stream:
+            heap.append((merge_key(msg, order), index, msg, stream))
+            break
+    heapq.heapify(heap)
+    while heap:
+        key, index, msg, stream = heap[0]
+        yield msg
+        for msg in stream:
+            heapq.heapreplace(heap, (merge_key(msg, order), index, msg,
+                                     stream))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def encode_cursor(positions):
+    """Encode a dict of partition positions as an opaque cursor
+
+    Positions are either the message id to continue after, or a timestamp
+    to continue at.
+
+    """
+    if not positions:
+        return None
+    cursor = ','.join('%s:%s' % (x, positions[x]) for x in sorted(positions))
+    return base64.urlsafe_b64encode(cursor).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by :func:`encode_cursor`"""
+    try:
+        cursor = base64.urlsafe_b64decode(
+            str(cursor) + '=' * (-len(cursor) % 4))
+    except (TypeError, UnicodeEncodeError):
+        raise InvalidCursor("Invalid cursor.")
+    positions = {}
+    for item in cursor.split(','):
+        partition, _, position = item.partition(':')
+        if not partition.isdigit():
+            raise InvalidCursor("Invalid cursor.")
+        if HEX_REGEX.match(position):
+            positions[int(partition)] = position
+        elif DECIMAL_REGEX.match(position):
+            positions[int(partition)] = Decimal(position)
+        else:
+            raise InvalidCursor("Invalid cursor.")
+    return positions
+
+
+def parse_message_ids(message_ids):
+    """Parse a list of message ids, each optionally prefixed with
+    `partition:`, into a dict of message ids per partition
+
+    Ids without a partition belong to partition 1.
+
+    """
+    partitions = collections.defaultdict(list)
+    for item in message_ids:
+        partition, _, msg_id = item.strip().rpartition(':')
+        if not HEX_REGEX.match(msg_id) or (partition and not (
+           partition.isdigit() and len(partition) <= 3)):
+            raise InvalidMessageID("Invalid message id's.")
+        partitions[int(partition) if partition else 1].append(msg_id)
+    return partitions
+
+
+def parse_offsets(offsets, max_partition):
+    """Validate a dict of message ids keyed by partition, returns it with
+    integer partitions"""
+    if not isinstance(offsets, dict):
+        raise InvalidMessageID("Invalid offsets.")
+    result = {}
+    for partition, msg_id in offsets.items():
+        partition = str(partition)
+        if not partition.isdigit() or \
+           not 1 <= int(partition) <= max_partition or \
+           not isinstance(msg_id, basestring) or not HEX_REGEX.match(msg_id):
+            raise InvalidMessageID("Invalid offsets.")
+        result[int(partition)] = str(msg_id)
+    return result
+
+
+def parse_cursor(cursor, partitions):
+    """Parse an event stream cursor into a dict of partition positions
+
+    The cursor is either a timestamp or message id applying to all
+    partitions, or a comma separated list of `partition:message_id`.
+
+    """
+    if not cursor:
+        return {}
+    if DECIMAL_REGEX.match(cursor):
+        return dict((x, Decimal(cursor)) for x in partitions)
+    positions = {}
+    for item in cursor.split(','):
+        partition, _, msg_id = item.strip().rpartition(':')
+        if not HEX_REGEX.match(msg_id) or \
+           (partition and not partition.isdigit()):
+            raise InvalidMessageID("Invalid event id.")
+        if partition:
+            positions[int(partition)] = msg_id
+        else:
+            positions.update((x, msg_id) for x in partitions)
+    return positions
+
+
+def assign_partitions(members, partitions, previous=None):
+    """Split the partitions between the members, returning a dict of
+    partition lists keyed by member
+
+    Members get contiguous ranges of the same size, give or take one. Given
+    the ``previous`` assignment, members keep as many of their partitions
+    as their share allows, so a member joining or leaving only moves the
+    partitions needed to balance the group again.
+
+    """
+    members = sorted(members)
+    assignment = dict((x, []) for x in members)
+    if not members:
+        return assignment
+    previous = previous or {}
+    held = dict((x, sorted(set(p for p in previous.get(x, [])
+                               if 1 <= p <= partitions)))
+                for x in members)
+    share, extra = divmod(partitions, len(members))
+    # The larger shares go to the members holding the most partitions
+    ranked = sorted(members, key=lambda x: -len(held[x]))
+    shares = dict((x, share + (index < extra))
+                  for index, x in enumerate(ranked))
+    taken = set()
+    for member in members:
+        for partition in held[member]:
+            if len(assignment[member]) < shares[member] and \
+               partition not in taken:
+                assignment[member].append(partition)
+                taken.add(partition)
+    free = [x for x in range(1, partitions + 1) if x not in taken]
+    for member in members:
+        needed = shares[member] - len(assignment[member])
+        assignment[member].extend(free[:needed])
+        del free[:needed]
+        assignment[member].sort()
+    return assignment
+
+
+def assignment_generation(assignment):
+    """Return the generation of a partition assignment, a digest of the
+    assignment itself
+
+    Rebalances racing each other can store different assignments, but
+    never under the same generation.
+
+    """
+    value = ';'.join('%s=%s' % (x, ','.join(str(p) for p in y))
+                     for x, y in sorted(assignment.items()))
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()[:16]
+
+
 def transform_stored_message(message):
+    body = message['body']
+    if isinstance(body, str):
+        # Binary bodies are returned base64 encoded
+        try:
+            body.decode('utf-8')
+        except UnicodeDecodeError:
+            message['body'] = base64.b64encode(body)
+            message['encoding'] = 'base64'
     del message['metadata']
     message['partition'] = int(message['queue_name'].split(':')[-1])
     del message['queue_name']
     message['timestamp'] = str(message['timestamp'])
 
 
+class MessageRows(object):
+    """Messages read as storage rows, see :meth:`retrieve_rows`
+
+    ``partitions`` maps the queue names of the rows to their partition.
+    The rows are encoded to the JSON of the messages directly, with the
+    same fields :func:`transform_stored_message` gives message dicts.
+
+    """
+    def __init__(self, rows, partitions):
+        self.rows = rows
+        self.partitions = partitions
+
+    def __len__(self):
+        return len(self.rows)
+
+    def positions(self):
+        """Return the partition and message id of every message"""
+        partitions = self.partitions
+        return [(partitions[x[3]], x[0]) for x in self.rows]
+
+    def encode(self):
+        """Return the messages as a JSON list"""
+        partitions = self.partitions
+        dumps = ujson.dumps
+        encoded = []
+        for message_id, ticks, body, queue_name in self.rows:
+            seconds, fraction = divmod(ticks - UUID_EPOCH, 10000000)
+            encoding = ''
+            if isinstance(body, str):
+                # Binary bodies are returned base64 encoded
+                try:
+                    body.decode('utf-8')
+                except UnicodeDecodeError:
+                    body = base64.b64encode(body)
+                    encoding = ',"encoding":"base64"'
+            encoded.append(
+                '{"message_id":"%s","timestamp":"%d.%07d","body":%s,'
+                '"partition":%d%s}' % (message_id, seconds, fraction,
+                                       dumps(body), partitions[queue_name],
+                                       encoding))
+        return '[%s]' % ','.join(encoded)
+
+
 class Root(object):
     __acl__ = []
 
@@ -69,12 +348,21 @@ class Application(object):
         self.application_name = application_name
         self.metadata = request.registry['backend_metadata']
         self.storage = request.registry['backend_storage']
+        self.metlog = request.registry['metlog_client']
+        self.notifier = request.registry['notifier']
+        self.journal = request.registry['journal']
+        # Set once messages were only journaled by push
+        self.journaled = False
         app_id = 'app:%s' % self.application_name
 
-        # Applications can create queues and view existing queues
+        # Applications can create queues and view existing queues,
+        # fetching and pushing messages is checked against the ACL of
+        # every queue
         self.__acl__ = [
             (Allow, app_id, 'create_queue'),
-            (Allow, app_id, 'view_queues')
+            (Allow, app_id, 'view_queues'),
+            (Allow, app_id, 'push'),
+            (Allow, Everyone, 'fetch'),
         ]
 
     def __getitem__(self, name):
@@ -87,8 +375,11 @@ class Application(object):
 
     def register_queue(self, queue_name, **metadata):
         """Register a queue for this application"""
-        if not metadata.get('principles'):
-            del metadata['principles']
+        for name in ('principles', 'compression'):
+            if not metadata.get(name):
+                metadata.pop(name, None)
+        if metadata.get('compression') == 'zlib':
+            metadata['compressed_bodies'] = 'true'
         return self.metadata.register_queue(
             self.application_name,
             queue_name,
@@ -120,6 +411,132 @@ class Application(object):
             queue_list.append(qd)
         return queue_list
 
+    def fetch(self, queues, order='ascending'):
+        """Read messages of many queues at once
+
+        ``queues`` is a list of dicts with the ``queue_name``,
+        ``partitions``, ``since`` and ``limit`` to read. The queue metadata
+        is read in one go, partitions sharing the same read options are read
+        from the storage together. Returns a dict of results keyed by queue
+        name, queues that can't be read have an error status.
+
+        """
+        names = [x['queue_name'] for x in queues]
+        queue_data = self.metadata.queue_information(self.application_name,
+                                                     names)
+        results = {}
+        reads = collections.defaultdict(list)
+        for params, data in zip(queues, queue_data):
+            name = params['queue_name']
+            if not data:
+                results[name] = {'status': 'error',
+                                 'error_msg': 'Queue not found.'}
+                continue
+            queue = Queue(self.request, name, dict(data))
+            if not has_permission('view', queue, self.request):
+                results[name] = {'status': 'error',
+                                 'error_msg': 'Access was denied.'}
+                continue
+            if max(params['partitions']) > queue.partitions:
+                results[name] = {'status': 'error',
+                                 'error_msg': 'Invalid partition.'}
+                continue
+            since = params['since']
+            if since and DECIMAL_REGEX.match(since):
+                since = Decimal(since)
+            key = (queue.consistency, since, params['limit'],
+                   queue.decompress)
+            reads[key].extend('%s:%s' % (name, x)
+                              for x in params['partitions'])
+            results[name] = {'status': 'ok', 'messages': []}
+
+        count = 0
+        for key, queue_names in reads.items():
+            consistency, since, limit, decompress = key
+            messages = self.storage.retrieve_batch(
+                consistency, self.application_name, queue_names,
+                start_at=since, limit=limit, order=order,
+                decompress=decompress)
+            for msg in messages:
+                # Stored queue names are ':queue_name:partition'
+                name = msg['queue_name'][1:].rsplit(':', 1)[0]
+                transform_stored_message(msg)
+                results[name]['messages'].append(msg)
+            count += len(messages)
+        self.metlog.incr('%s.get_message' % self.application_name,
+                         count=count)
+        return results
+
+    def push(self, messages):
+        """Push messages addressed to many queues
+
+        Every message names its ``queue_name`` next to the usual message
+        fields. The queue metadata is read in one go and the messages are
+        written with one batch per consistency and compression setting.
+        Returns a result per message in the same order, messages that
+        can't be pushed have an error status.
+
+        """
+        names = list(set(x['queue_name'] for x in messages
+                         if isinstance(x, dict) and
+                         isinstance(x.get('queue_name'), basestring)))
+        queue_data = self.metadata.queue_information(self.application_name,
+                                                     names)
+        queues = {}
+        for name, data in zip(names, queue_data):
+            if data:
+                queues[name] = Queue(self.request, name, dict(data))
+
+        results = [None] * len(messages)
+        batches = collections.defaultdict(list)
+        for index, msg in enumerate(messages):
+            name = msg.get('queue_name') if isinstance(msg, dict) else None
+            queue = queues.get(name)
+            error = None
+            if queue is None:
+                error = 'Queue not found.'
+            elif not has_permission('create', queue, self.request):
+                error = 'Access was denied.'
+            else:
+                try:
+                    msg = validators.deserialize_message(msg,
+                                                         queue.partitions)
+                except colander.Invalid, exc:
+                    error = exc.asdict()
+            if error is not None:
+                results[index] = {'status': 'error', 'queue_name': name,
+                                  'error_msg': error}
+                continue
+            if not msg['partition']:
+                msg['partition'] = random.randint(1, queue.partitions)
+            batches[(queue.consistency, queue.compress)].append(
+                (index, name, msg))
+
+        written = set()
+        count = 0
+        for (consistency, compress), batch in batches.items():
+            msgs = [('%s:%s' % (x[1], x[2]['partition']), x[2]['body'],
+                     x[2]['ttl'], {}) for x in batch]
+            if self.journal is not None and consistency == 'weak':
+                stored = self.journal.append(self.application_name,
+                                             consistency, compress, msgs)
+                self.journaled = True
+            else:
+                stored = self.storage.push_batch(
+                    consistency, self.application_name, msgs,
+                    compress=compress)
+                written.update((self.application_name, x[0]) for x in msgs)
+            for (index, name, msg), (key, timestamp) in zip(batch, stored):
+                results[index] = {'status': 'ok', 'queue_name': name,
+                                  'key': key, 'timestamp': str(timestamp),
+                                  'partition': msg['partition']}
+            count += len(stored)
+        if written:
+            self.notifier.notify(written)
+        self.metlog.incr('%s.new_message' % self.application_name,
+                         count=count)
+        return results
+
 
 class Queue(object):
     """Queue Resource"""
@@ -129,6 +546,12 @@ class Queue(object):
         self.storage = request.registry['backend_storage']
         self.queue_name = queue_name
         self.metlog = request.registry['metlog_client']
+        self.notifier = request.registry['notifier']
+        self.event_hub = request.registry['event_hub']
+        self.offset_committer = request.registry['offset_committer']
+        self.journal = request.registry['journal']
+        self.read_workers = request.registry['read_workers']
+        self.delete_workers = request.registry['delete_workers']
         principles = queue_data.pop('principles', '').split(',')
         self.principles = [x.strip() for x in principles if x]
 
@@ -162,9 +585,44 @@ class Queue(object):
 
     def __getitem__(self, name):
         """Determine if this is a multiple message context"""
-        if not MESSAGE_REGEX.match(name):
-            raise InvalidMessageID("Invalid message id's.")
-        return MessageBatch(self.request, self, name)
+        return MessageBatch(self.request, self,
+                            parse_message_ids(name.split(',')))
+
+    @property
+    def compress(self):
+        """Whether new messages should be compressed"""
+        return getattr(self, 'compression', None) == 'zlib'
+
+    @property
+    def decompress(self):
+        """Whether stored messages may be compressed or binary, both are
+        flagged in the message metadata
+
+        Once compression was configured for a queue, messages stored
+        earlier might still be compressed even if it was turned off again.
+
+        """
+        return (self.compress or
+                getattr(self, 'compressed_bodies', None) == 'true' or
+                self.binary)
+
+    @property
+    def binary(self):
+        """Whether binary messages were stored, which are flagged in their
+        metadata"""
+        return getattr(self, 'binary_bodies', None) == 'true'
+
+    def partition_list(self, partitions):
+        """Return the partitions, all of them for ``['all']``"""
+        if partitions == ['all']:
+            return range(1, self.partitions + 1)
+        return partitions
+
+    @property
+    def journaled(self):
+        """Whether new messages are accepted into the journal instead of
+        being written to the storage right away"""
+        return self.journal is not None and self.consistency == 'weak'
 
     def update_metadata(self, **metadata):
         # Strip out data not being updated
@@ -172,6 +630,9 @@ class Queue(object):
         if 'partitions' in metadata:
             if metadata['partitions'] < self.partitions:
                 raise InvalidUpdate("Partitions can only be increased.")
+        if metadata.get('compression') == 'zlib':
+            # Readers keep looking for the flag if compression is turned off
+            metadata['compressed_bodies'] = 'true'
 
         self.metadata.register_queue(self.application, self.queue_name,
                                      **metadata)
@@ -185,8 +646,21 @@ class Queue(object):
         """Push a batch of messages to the storage"""
         msgs = [('%s:%s' % (self.queue_name, x['partition']), x['body'],
                  x['ttl'], x.get('metadata', {})) for x in messages]
-        results = self.storage.push_batch(self.consistency, self.application,
-                                          msgs)
+        if not self.binary and [x for x in msgs if 'BodyEncoding' in x[3]]:
+            # Readers need to know they have to look for the flag
+            self.metadata.register_queue(self.application, self.queue_name,
+                                         binary_bodies='true')
+            self.binary_bodies = 'true'
+        if self.journaled:
+            # Waiting requests are notified once the journal pushed them
+            results = self.journal.append(self.application, self.consistency,
+                                          self.compress, msgs)
+        else:
+            results = self.storage.push_batch(
+                self.consistency, self.application, msgs,
+                compress=self.compress)
+            self.notifier.notify(set((self.application, x[0])
+                                     for x in msgs))
         rl = []
         for i, msg in enumerate(results):
             rl.append({'key': msg[0], 'timestamp': str(msg[1]),
@@ -195,21 +669,387 @@ class Queue(object):
                          count=len(results))
         return rl
 
-    def get_messages(self, since=None, limit=None, order=None, partitions=None):
-        queue_names = []
-        for part in partitions:
-            queue_names.append('%s:%s' % (self.queue_name, part))
+    def _wait(self, queue_names, since, wait, limit, fetch, merge=False,
+              message_id=MESSAGE_ID, queue_name=QUEUE_NAME):
+        """Wait up to ``wait`` seconds until ``fetch`` returns messages
+        other than the ``since`` message, returns the last fetched list
+
+        ``fetch`` is called with the limit to read, which applies to every
+        partition, or to all messages together with ``merge``. After a
+        ``since`` message id one more message is read, so the ``since``
+        message itself, which reads include, can't take the place of a
+        newer message. It is only left out where it would.
+
+        """
+        probe = limit
+        if limit and since and HEX_REGEX.match(since):
+            probe = limit + 1
+        results = []
+
+        def check():
+            results[:] = fetch(probe)
+            return any(message_id(x) != since for x in results)
+        keys = [(self.application, x) for x in queue_names]
+        self.notifier.wait(keys, wait, check)
+        if probe == limit:
+            return results
+        key = (lambda x: None) if merge else queue_name
+        counts = collections.defaultdict(int)
+        for x in results:
+            counts[key(x)] += 1
+        kept = []
+        taken = collections.defaultdict(int)
+        for x in results:
+            partition = key(x)
+            if message_id(x) == since and counts[partition] > limit:
+                continue
+            if taken[partition] < limit:
+                taken[partition] += 1
+                kept.append(x)
+        return kept
+
+    def _reads(self, partitions, since, cursor):
+        """Return the reads needed for the partitions as a list of
+        ``(queue_names, start_at, after)`` tuples
+
+        Partitions positioned by the ``cursor`` are read on their own,
+        after the exclusive message id ``after`` if there is one. All
+        others start at ``since`` and are read together. The reads run
+        concurrently.
+
+        """
         if since and DECIMAL_REGEX.match(since):
             since = Decimal(since)
-        results = self.storage.retrieve_batch(
-            self.consistency, self.application, queue_names, start_at=since,
-            limit=limit, order=order)
+        positions = decode_cursor(cursor) if cursor else {}
+        reads = []
+        plain = []
+        for partition in partitions:
+            queue_name = '%s:%s' % (self.queue_name, partition)
+            position = positions.get(int(partition))
+            if position is None:
+                plain.append(queue_name)
+            elif isinstance(position, basestring):
+                reads.append(([queue_name], position, position))
+            else:
+                reads.append(([queue_name], position, None))
+        if plain:
+            reads.insert(0, (plain, since, None))
+        return reads
+
+    def _after(self, messages, after, order, limit, message_id=MESSAGE_ID):
+        """Skip the messages up to and including the message id ``after``,
+        messages are read with one more than ``limit`` to make up for it"""
+        position = message_key(after)
+        if order == 'descending':
+            messages = (x for x in messages
+                        if message_key(message_id(x)) < position)
+        else:
+            messages = (x for x in messages
+                        if message_key(message_id(x)) > position)
+        if limit:
+            messages = itertools.islice(messages, limit)
+        return messages
+
+    def _read_all(self, read, reads):
+        """Return the results of calling ``read`` with every read, running
+        concurrently if there are several"""
+        if len(reads) == 1:
+            return [read(reads[0])]
+        return self.read_workers.map(read, reads)
+
+    def _fetch(self, reads, limit, order, decompress, rows=False):
+        """Return the messages of the reads, storage rows with ``rows``"""
+        retrieve = self.storage.retrieve_rows if rows else \
+            self.storage.retrieve_batch
+
+        def read(item):
+            queue_names, start_at, after = item
+            messages = retrieve(
+                self.consistency, self.application, queue_names,
+                start_at=start_at, limit=limit + 1 if limit and after
+                else limit, order=order, decompress=decompress)
+            if after:
+                messages = self._after(messages, after, order, limit,
+                                       ROW_ID if rows else MESSAGE_ID)
+            return list(messages)
+        results = []
+        for messages in self._read_all(read, reads):
+            results.extend(messages)
+        return results
+
+    def _partition_stream(self, queue_name, first, count, limit, order,
+                          decompress, chunk_size):
+        """Yield the ``first`` messages of a partition, then continue
+        reading it if ``count`` messages filled that slice"""
+        for msg in first:
+            yield msg
+        if len(first) < count:
+            return
+        last = first[-1]['message_id']
+        messages = self.storage.retrieve_iter(
+            self.consistency, self.application, [queue_name],
+            start_at=last, limit=limit and limit + 1, order=order,
+            decompress=decompress, chunk_size=chunk_size)
+        for msg in self._after(messages, last, order, None):
+            yield msg
+
+    def _merged(self, reads, limit, order, decompress, chunk_size=100):
+        """Return the messages of the reads merged into a single order, up
+        to ``limit`` messages overall
+
+        Every partition starts with a slice of its share of ``limit``, the
+        partitions of a read fetched together. Only partitions the merge
+        runs through before reaching ``limit`` are read further. Without a
+        ``limit`` the partitions are read ``chunk_size`` messages at a
+        time.
+
+        """
+        if limit:
+            partitions = sum(len(x[0]) for x in reads)
+            share = min(limit, limit // partitions + 1)
+        else:
+            share = chunk_size
+
+        def read(item):
+            queue_names, start_at, after = item
+            return self.storage.retrieve_batch(
+                self.consistency, self.application, queue_names,
+                start_at=start_at, limit=share + 1 if after else share,
+                order=order, decompress=decompress)
+        streams = []
+        first_reads = self._read_all(read, reads)
+        for (queue_names, start_at, after), messages in zip(reads,
+                                                            first_reads):
+            count = share + 1 if after else share
+            slices = collections.defaultdict(list)
+            for msg in messages:
+                slices[int(msg['queue_name'].split(':')[-1])].append(msg)
+            for queue_name in queue_names:
+                first = slices[int(queue_name.split(':')[-1])]
+                stream = self._partition_stream(queue_name, first, count,
+                                                limit, order, decompress,
+                                                limit or chunk_size)
+                if after:
+                    stream = self._after(stream, after, order, None)
+                streams.append(stream)
+        return itertools.islice(merge_messages(streams, order), limit)
+
+    def get_messages(self, since=None, limit=None, order=None, partitions=None,
+                     wait=0, cursor=None, merge=False):
+        queue_names = ['%s:%s' % (self.queue_name, x) for x in partitions]
+        reads = self._reads(partitions, since, cursor)
+
+        def fetch(limit):
+            if merge:
+                return list(self._merged(reads, limit, order,
+                                         self.decompress))
+            return self._fetch(reads, limit, order, self.decompress)
+        results = self._wait(queue_names, since, wait,
+                             limit or MERGE_LIMIT if merge else limit, fetch,
+                             merge)
         for res in results:
             transform_stored_message(res)
         self.metlog.incr('%s.get_message' % self.application,
                          count=len(results))
         return results
 
+    def get_rows(self, since=None, limit=None, order=None, partitions=None,
+                 wait=0, cursor=None):
+        """Return the messages of :meth:`get_messages` without merging as
+        :class:`MessageRows`"""
+        queue_names = ['%s:%s' % (self.queue_name, x) for x in partitions]
+        reads = self._reads(partitions, since, cursor)
+
+        def fetch(limit):
+            return self._fetch(reads, limit, order, self.decompress,
+                               rows=True)
+        rows = self._wait(queue_names, since, wait, limit, fetch,
+                          message_id=ROW_ID, queue_name=ROW_QUEUE_NAME)
+        self.metlog.incr('%s.get_message' % self.application,
+                         count=len(rows))
+        return MessageRows(rows, dict((x, int(x.split(':')[-1]))
+                                      for x in queue_names))
+
+    def next_cursor(self, messages, partitions, since=None, cursor=None):
+        """Return the cursor continuing after the ``messages`` returned for
+        the ``since`` and ``cursor`` parameters"""
+        positions = decode_cursor(cursor) if cursor else {}
+        if since:
+            for partition in partitions:
+                positions.setdefault(int(partition), since)
+        if isinstance(messages, MessageRows):
+            positions.update(messages.positions())
+        else:
+            for msg in messages:
+                positions[msg['partition']] = msg['message_id']
+        return encode_cursor(positions)
+
+    def claim(self, limit, lease, partitions):
+        """Lease up to ``limit`` unclaimed messages of the partitions for
+        ``lease`` seconds"""
+        queue_names = ['%s:%s' % (self.queue_name, x) for x in partitions]
+        claim_id, messages = self.storage.claim(
+            self.consistency, self.application, queue_names, limit, lease,
+            decompress=self.decompress)
+        for msg in messages:
+            transform_stored_message(msg)
+        self.metlog.incr('%s.claim_message' % self.application,
+                         count=len(messages))
+        return claim_id, messages
+
+    def group_cursor(self, group):
+        """Return a cursor continuing after the committed offsets of a
+        consumer group"""
+        return encode_cursor(self.offsets(group))
+
+    def offsets(self, group):
+        """Return the committed offsets of a consumer group"""
+        return self.offset_committer.offsets(self.application,
+                                             self.queue_name, group)
+
+    def commit_offsets(self, group, offsets):
+        """Commit the offsets of a consumer group, a dict of the last
+        consumed message id keyed by partition"""
+        offsets = parse_offsets(offsets, self.partitions)
+        self.offset_committer.commit(self.application, self.queue_name,
+                                     group, offsets)
+        return offsets
+
+    def join(self, group, member, timeout):
+        """Register ``member`` in a consumer group for ``timeout`` seconds
+        and return the group members, the assignment generation and the
+        partitions of ``member``"""
+        self.metadata.heartbeat(self.application, self.queue_name, group,
+                                member, timeout)
+        members = self.metadata.group_members(self.application,
+                                              self.queue_name, group)
+        if member not in members:
+            # The read didn't see the heartbeat yet
+            members.append(member)
+        generation, assignment = self._rebalance(group, members)
+        return members, generation, assignment[member]
+
+    def leave(self, group, member):
+        """Remove ``member`` from a consumer group, its partitions go to the
+        remaining members"""
+        self.metadata.leave(self.application, self.queue_name, group, member)
+        members = self.metadata.group_members(self.application,
+                                              self.queue_name, group)
+        self._rebalance(group, [x for x in members if x != member])
+
+    def _rebalance(self, group, members):
+        """Store the assignment of the partitions to ``members``, moving
+        as few partitions as possible, and return it with its generation
+
+        The generation changes with the assignment, see
+        :func:`assignment_generation`. Every heartbeat stores the assignment
+        again, so it outlives the longest member timeout.
+
+        """
+        _, previous = self.metadata.group_assignment(
+            self.application, self.queue_name, group)
+        assignment = assign_partitions(members, self.partitions, previous)
+        generation = assignment_generation(assignment)
+        self.metadata.set_group_assignment(
+            self.application, self.queue_name, group, generation, assignment,
+            validators.MAX_GROUP_TIMEOUT)
+        return generation, assignment
+
+    def check_assignment(self, group, generation, member, partitions):
+        """Make sure ``member`` of a consumer group with members may commit
+        offsets of ``partitions``
+
+        Raises :exc:`StaleGeneration` unless ``generation`` is the current
+        assignment generation, and :exc:`UnassignedPartitions` if any of
+        the partitions is assigned to another member. Members whose
+        partitions moved in the meantime can't commit offsets for them
+        anymore.
+
+        """
+        current, assignment = self.metadata.group_assignment(
+            self.application, self.queue_name, group)
+        if not assignment:
+            return
+        if generation != current:
+            raise StaleGeneration("The group was rebalanced, join again to "
+                                  "get the current generation.")
+        unassigned = set(int(x) for x in partitions) - \
+            set(assignment.get(member, []))
+        if unassigned:
+            raise UnassignedPartitions(
+                "Partitions %s aren't assigned to this member." %
+                ','.join(str(x) for x in sorted(unassigned)))
+
+    def etag(self, variant, since=None, limit=None, order=None,
+             partitions=None, cursor=None, merge=False):
+        """Return an ETag for the messages :meth:`get_messages` would
+        return in the ``variant`` representation
+
+        The tag is derived from the write markers of the partitions, so it
+        changes with every write without reading any messages. Returns
+        ``None`` while the latest writes aren't visible to reads yet.
+
+        """
+        queue_names = ['%s:%s' % (self.queue_name, x) for x in partitions]
+        markers = self.storage.write_markers(self.consistency,
+                                             self.application, queue_names)
+        if markers is None:
+            return None
+        key = repr((queue_names, sorted(markers.items()), since, limit,
+                    order, cursor, merge, variant))
+        return hashlib.sha1(key).hexdigest()
+
+    def iter_messages(self, since=None, limit=None, order=None,
+                      partitions=None, wait=0, chunk_size=100, cursor=None,
+                      merge=False):
+        """Like :meth:`get_messages`, but reads ``chunk_size`` messages at
+        a time and yields them"""
+        queue_names = ['%s:%s' % (self.queue_name, x) for x in partitions]
+        reads = self._reads(partitions, since, cursor)
+        if wait:
+            # Only wait for the first new message, then stream them all
+            def fetch(limit):
+                return self._fetch(reads, limit, order, False)
+            self._wait(queue_names, since, wait, 1, fetch)
+        results = []
+        if merge:
+            results.append(self._merged(reads, limit, order, self.decompress,
+                                        chunk_size))
+            reads = []
+        for read_names, start_at, after in reads:
+            messages = self.storage.retrieve_iter(
+                self.consistency, self.application, read_names,
+                start_at=start_at, limit=limit + 1 if limit and after
+                else limit, order=order, decompress=self.decompress,
+                chunk_size=chunk_size)
+            if after:
+                messages = self._after(messages, after, order, limit)
+            results.append(messages)
+        count = 0
+        try:
+            for res in itertools.chain(*results):
+                transform_stored_message(res)
+                count += 1
+                yield res
+        finally:
+            self.metlog.incr('%s.get_message' % self.application,
+                             count=count)
+
+    def subscribe(self, partitions, since=None):
+        """Subscribe to new messages of the partitions, starting after the
+        ``since`` cursor"""
+        return self.event_hub.subscribe(
+            self.consistency, self.application, self.queue_name, partitions,
+            decompress=self.decompress,
+            positions=parse_cursor(since, partitions))
+
+    def delete_messages(self, message_ids):
+        """Delete a list of `partition:message_id` strings, returns the
+        amount of ids deleted"""
+        batch = MessageBatch(self.request, self,
+                             parse_message_ids(message_ids))
+        return batch.delete()
+
     def delete(self):
         partitions = range(1, self.partitions + 1)
         for partition in partitions:
@@ -220,38 +1060,58 @@ class Queue(object):
 
 
 class MessageBatch(object):
-    def __init__(self, request, queue, message_ids):
+    """Messages of a queue, ``partitions`` maps partition numbers to
+    message ids as returned by :func:`parse_message_ids`"""
+    def __init__(self, request, queue, partitions):
         self.request, self.queue = request, queue
-        self.message_ids = [x.strip() for x in message_ids.split(',')]
+        self.partitions = partitions
 
         # Copy parent ACL
         self.__acl__ = queue.__acl__[:]
 
     def _messages(self):
-        partition_hash = collections.defaultdict(lambda: [])
-        for msg_id in self.message_ids:
-            if ':' in msg_id:
-                partition, msg_id = msg_id.split(':')
-            else:
-                partition = 1
+        partition_hash = {}
+        for partition, msgs in self.partitions.items():
             qn = '%s:%s' % (self.queue.queue_name, partition)
-            partition_hash[qn].append(msg_id)
+            partition_hash[qn] = msgs
         return partition_hash
 
+    def _check_journal(self):
+        """Raise :exc:`MessagesPending` for messages not pushed from the
+        journal yet, their push would undo any change"""
+        journal = self.queue.journal
+        if journal is None:
+            return
+        pending = journal.pending([x for msgs in self.partitions.values()
+                                   for x in msgs])
+        if pending:
+            raise MessagesPending(
+                "Messages %s are still being written, retry shortly." %
+                ', '.join(pending))
+
     def delete(self):
-        for queue, msgs in self._messages().iteritems():
-            self.queue.storage.delete(
-                    self.queue.consistency,
-                    self.queue.application,
-                    queue, *msgs)
-        return
+        """Delete the messages with one storage delete per partition,
+        running concurrently if there are several"""
+        self._check_journal()
+
+        def delete(item):
+            queue, msgs = item
+            self.queue.storage.delete(self.queue.consistency,
+                                      self.queue.application, queue, *msgs)
+        items = self._messages().items()
+        if len(items) == 1:
+            delete(items[0])
+        else:
+            self.queue.delete_workers.map(delete, items)
+        return sum(len(x[1]) for x in items)
 
     def get(self):
         results = []
         for queue, msgs in self._messages().iteritems():
             for msg_id in msgs:
                 res = self.queue.storage.retrieve(self.queue.consistency,
-                    self.queue.application, queue, str(msg_id))
+                    self.queue.application, queue, str(msg_id),
+                    decompress=self.queue.decompress)
                 if res:
                     transform_stored_message(res)
                     results.append(res)
@@ -260,9 +1120,13 @@ class MessageBatch(object):
         return results
 
     def update(self, params):
+        self._check_journal()
         for queue, msgs in self._messages().iteritems():
             for msg in msgs:
                 self.queue.storage.push(self.queue.consistency,
                     self.queue.application, queue,
-                    params['body'], ttl=params['ttl'], timestamp=msg)
+                    params['body'], ttl=params['ttl'], timestamp=msg,
+                    compress=self.queue.compress)
+        self.queue.notifier.notify([(self.queue.application, x)
+                                    for x in self._messages()])
         return
@@ -44,7 +44,7 @@ class MessageQueueBackend(Interface):
 
     def retrieve_batch(consistency, application_name, queue_names,
                        limit=None, include_metadata=False, start_at=None,
-                       order="ascending"):
+                       order="ascending", decompress=False):
         """Retrieve a batch of messages from a queue
 
         :param consistency: Desired consistency of the read operation
@@ -56,6 +56,10 @@ class MessageQueueBackend(Interface):
         :param order: Which order to traverse the messages. Defaults to
                       ascending order.
         :type order: `ascending` or `descending`
+        :param decompress: Whether messages may have been pushed with
+                           compression, requiring their metadata to be
+                           read. Compressed bodies are always decompressed
+                           when ``include_metadata`` is set.
 
         :returns: A list of dicts, empty if no messages meet the criteria
         :rtype: list
@@ -89,8 +93,39 @@ class MessageQueueBackend(Interface):
 
         """
 
+    def retrieve_iter(consistency, application_name, queue_names,
+                      limit=None, include_metadata=False, start_at=None,
+                      order="ascending", decompress=False, chunk_size=100):
+        """Retrieve messages from queues as a generator
+
+        Takes the same parameters as :meth:`retrieve_batch` and yields the
+        same message dicts, the queues are read one after another.
+
+        :param chunk_size: Amount of messages read from the storage at once
+
+        :returns: A generator of message dicts
+        :rtype: generator
+
+        """
+
+    def retrieve_rows(consistency, application_name, queue_names,
+                      limit=None, start_at=None, order="ascending",
+                      decompress=False):
+        """Retrieve a batch of messages from queues as tuples
+
+        Takes the same parameters as :meth:`retrieve_batch` except for
+        ``include_metadata``, and returns the same messages without building
+        a dict per message.
+
+        :returns: A list of ``(message_id, time, body, queue_name)`` tuples,
+                  ``time`` being the 100-nanosecond UUID time of the message
+                  id and ``queue_name`` one of ``queue_names``
+        :rtype: list
+
+        """
+
     def retrieve(consistency, application_name, queue_name, message_id,
-                 include_metadata=False):
+                 include_metadata=False, decompress=False):
         """Retrieve a single message
 
         :param consistency: Desired consistency of the read operation
@@ -98,6 +133,8 @@ class MessageQueueBackend(Interface):
         :param queue_name: Queue name
         :param message_id: Message id to retrieve
         :param include_metadata: Whether to include message metadata
+        :param decompress: Whether the message may have been pushed with
+                           compression
 
         :returns: A dict
         :rtype: dict
@@ -114,7 +151,8 @@ class MessageQueueBackend(Interface):
         """
 
     def push(consistency, application_name, queue_name, message,
-             metadata=None, ttl=3600 * 24 * 3, timestamp=None):
+             metadata=None, ttl=3600 * 24 * 3, timestamp=None,
+             compress=False):
         """Push a message onto the given queue
 
         The queue is assumed to exist, and will be created if it does not
@@ -132,6 +170,11 @@ class MessageQueueBackend(Interface):
                           either a `uuid.uuid1` or a decimal/float of seconds
                           since the epoch as time.time() would return.
                           Defaults to the current time.
+        :param compress: Whether to compress the message body if it's
+                         above the backends compression threshold. The
+                         body is flagged with a ``ContentEncoding``
+                         metadata entry and transparently decompressed
+                         on retrieval.
 
         :returns: The message id and timestamp as a tuple
         :rtype: tuple
@@ -142,7 +185,8 @@ class MessageQueueBackend(Interface):
 
         """
 
-    def push_batch(consistency, application_name, message_data):
+    def push_batch(consistency, application_name, message_data,
+                   compress=False, message_ids=None):
         """Push a batch of messages to queues
 
         The queue(s) are assumed to exist, and will be created if
@@ -154,6 +198,12 @@ class MessageQueueBackend(Interface):
         :type message_data: List of tuples, where each tuple is the
                             queue_name, message body, TTL, and a dict of
                             message metadata.
+        :param compress: Whether to compress message bodies above the
+                         backends compression threshold, see :meth:`push`
+        :param message_ids: Hex ids to store the messages with instead of
+                            new ones, one per message. Pushing the same ids
+                            again overwrites the messages.
+        :type message_ids: list
 
         :returns: The message id's and timestamps as a list of tuples in the
                   order they were sent
@@ -176,7 +226,7 @@ class MessageQueueBackend(Interface):
         """
 
     def truncate(consistency, application_name, queue_name):
-        """Remove all contents of the queue
+        """Remove all contents and leases of the queue
 
         :param consistency: Desired consistency of the truncate operation
         :param application_name: Name of the application
@@ -188,7 +238,7 @@ class MessageQueueBackend(Interface):
         """
 
     def delete(consistency, application_name, queue_name, *ids):
-        """Delete all the given message ids from the queue
+        """Delete all the given message ids and their leases from the queue
 
         :param consistency: Desired consistency of the delete operation
         :param application_name: Name of the application
@@ -200,6 +250,48 @@ class MessageQueueBackend(Interface):
 
         """
 
+    def claim(consistency, application_name, queue_names, limit, lease,
+              decompress=False):
+        """Lease up to ``limit`` unclaimed messages of the queues
+
+        Claimed messages are skipped by other claims until the lease
+        expires after ``lease`` seconds, or the message is deleted. Plain
+        reads still return them. Backends without atomic writes may hand
+        a message to two claims running at the same time.
+
+        :param consistency: Desired consistency of the operation
+        :param application_name: Name of the application
+        :param queue_names: List of queue names to claim from, in order
+        :param limit: Amount of messages to claim in total
+        :param lease: Seconds until claimed messages can be claimed again
+        :param decompress: Whether messages may have been pushed with
+                           compression, see :meth:`retrieve_batch`
+
+        :returns: A new claim id and the claimed messages in the same format
+                  as :meth:`retrieve_batch`
+        :rtype: tuple
+
+        """
+
+    def write_markers(consistency, application_name, queue_names):
+        """Return the id of the last write to each queue
+
+        Every push, update, delete and truncate records a new write id for
+        the queue, so comparing them is a cheap way to tell whether the
+        contents of a queue changed without reading its messages. Expiring
+        messages don't change the write id.
+
+        :param consistency: Desired consistency of the read operation
+        :param application_name: Name of the application
+        :param queue_names: List of queue names
+
+        :returns: A dict of write ids keyed by queue name, queues never
+                  written to are left out. ``None`` if a write might still
+                  be hidden from reads by the consistency delay.
+        :rtype: dict
+
+        """
+
     def count(consistency, application_name, queue_name):
         """Returns the amount of messages in the queue
 
@@ -293,3 +385,103 @@ class MetadataBackend(Interface):
             ]
 
         """
+
+    def commit_offsets(offsets):
+        """Store the offsets of consumer groups
+
+        :param offsets: The offsets to store, later commits of a partition
+                        replace earlier ones
+        :type offsets: dict keyed by ``(application_name, queue_name,
+                       group)`` tuples, of dicts mapping partition numbers
+                       to the id of the message consumed last
+
+        :returns: Whether the offsets were stored
+        :rtype: bool
+
+        """
+
+    def consumer_offsets(application_name, queue_name, group):
+        """Return the committed offsets of a consumer group
+
+        :param application_name: Name of the application
+        :param queue_name: Queue name
+        :param group: Name of the consumer group
+
+        :returns: Message ids keyed by partition number, empty if nothing
+                  was committed yet
+        :rtype: dict
+
+        """
+
+    def heartbeat(application_name, queue_name, group, member, timeout):
+        """Register a member of a consumer group, or keep it registered
+
+        :param application_name: Name of the application
+        :param queue_name: Queue name
+        :param group: Name of the consumer group
+        :param member: Id of the member
+        :param timeout: Seconds the member stays registered without
+                        another heartbeat
+        :type timeout: int
+
+        :returns: Whether the member was registered
+        :rtype: bool
+
+        """
+
+    def leave(application_name, queue_name, group, member):
+        """Remove a member of a consumer group
+
+        :param application_name: Name of the application
+        :param queue_name: Queue name
+        :param group: Name of the consumer group
+        :param member: Id of the member
+
+        :returns: Whether the member was removed
+        :rtype: bool
+
+        """
+
+    def group_members(application_name, queue_name, group):
+        """Return the registered members of a consumer group
+
+        :param application_name: Name of the application
+        :param queue_name: Queue name
+        :param group: Name of the consumer group
+
+        :returns: Sorted member ids
+        :rtype: list
+
+        """
+
+    def group_assignment(application_name, queue_name, group):
+        """Return the stored partition assignment of a consumer group
+
+        :param application_name: Name of the application
+        :param queue_name: Queue name
+        :param group: Name of the consumer group
+
+        :returns: The generation and a dict of partition lists keyed by
+                  member, ``(None, {})`` if none was stored
+        :rtype: tuple
+
+        """
+
+    def set_group_assignment(application_name, queue_name, group,
+                             generation, assignment, ttl):
+        """Store the partition assignment of a consumer group
+
+        :param application_name: Name of the application
+        :param queue_name: Queue name
+        :param group: Name of the consumer group
+        :param generation: Generation identifying the assignment
+        :type generation: str
+        :param assignment: Partition lists keyed by member
+        :type assignment: dict
+        :param ttl: Seconds until the assignment expires
+        :type ttl: int
+
+        :returns: Whether the assignment was stored
+        :rtype: bool
+
+        """
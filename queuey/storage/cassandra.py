@@ -2,13 +2,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 from cdecimal import Decimal
+import collections
+import hashlib
 import inspect
+import logging
+import os
+import random
+import tempfile
+import threading
 import uuid
 import time
+import Queue
 
 import pycassa
-from pycassa.index import create_index_expression
-from pycassa.index import create_index_clause
 from pycassa import system_manager
 from thrift.Thrift import TException
 from zope.interface import implements
@@ -16,7 +22,15 @@ from zope.interface import implements
 from queuey.storage import MessageQueueBackend
 from queuey.storage import MetadataBackend
 from queuey.storage import StorageUnavailable
+from queuey.storage.pool import HostPolicy
+from queuey.storage.pool import PolicyConnectionPool
+from queuey.storage.util import compress_body
 from queuey.storage.util import convert_time_to_uuid
+from queuey.storage.util import DeadlineTimer
+from queuey.storage.util import decompress_body
+from queuey.storage.util import ENCODING_FLAGS
+from queuey.storage.util import WorkerPool
+from queuey.storage.util import WriteCoalescer
 
 ONE = pycassa.ConsistencyLevel.ONE
 QUORUM = pycassa.ConsistencyLevel.QUORUM
@@ -24,6 +38,21 @@ LOCAL_QUORUM = pycassa.ConsistencyLevel.LOCAL_QUORUM
 EACH_QUORUM = pycassa.ConsistencyLevel.EACH_QUORUM
 DECIMAL_1E7 = Decimal('1e7')
 
+# Most leases of a queue partition considered when claiming messages
+MAX_LEASES = 10000
+
+# Most members of a consumer group read, more than queues have partitions
+MAX_MEMBERS = 1000
+
+# Columns of the consumer members row holding the partition assignment
+ASSIGNMENT_COLUMNS = [':generation', ':assignment']
+
+# Bump whenever the column families created by :class:`Schema` change, so
+# nodes holding a cached verification introspect the cluster again
+SCHEMA_VERSION = 6
+
+log = logging.getLogger(__name__)
+
 
 def parse_hosts(raw_hosts):
     """Parses out hosts into a list"""
@@ -39,13 +68,119 @@ def parse_hosts(raw_hosts):
     return hosts
 
 
-def wrap_func(func):
-    def wrapper(*args, **kwargs):
+class SchemaCache(object):
+    """Records keyspaces whose schema has been verified
+
+    A marker file named after a fingerprint of the keyspace, host and
+    :data:`SCHEMA_VERSION` is written once the schema was verified, so
+    later worker starts can skip the schema introspection entirely.
+
+    """
+    def __init__(self, directory=None):
+        if not directory:
+            directory = os.path.join(tempfile.gettempdir(), 'queuey-schema')
+        self.directory = directory
+
+    def _path(self, kind, host, database):
+        fingerprint = hashlib.sha1('%s:%s:%s:%s' % (
+            kind, host, database, SCHEMA_VERSION)).hexdigest()
+        return os.path.join(self.directory, fingerprint)
+
+    def verified(self, kind, host, database):
+        return os.path.exists(self._path(kind, host, database))
+
+    def record(self, kind, host, database):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(self._path(kind, host, database), 'w') as f:
+                f.write('%s %s %s\n' % (kind, database, SCHEMA_VERSION))
+        except (IOError, OSError):
+            log.warning("Unable to record verified schema in %s",
+                        self.directory)
+
+    def forget(self, kind, host, database):
         try:
-            return func(*args, **kwargs)
-        except (pycassa.UnavailableException, pycassa.TimedOutException,
-                pycassa.MaximumRetryException):
-            raise StorageUnavailable("Unable to contact storage pool")
+            os.remove(self._path(kind, host, database))
+        except OSError:
+            pass
+
+
+def verify_schema(kind, host, database, schema_cache):
+    """Create or verify the schema unless already verified"""
+    if schema_cache.verified(kind, host, database):
+        return
+    try:
+        sm = Schema(host)
+        getattr(sm, 'install_' + kind)(database)
+        sm.close()
+    except TException, exc:
+        log.warning("Unable to verify the %s schema of %s on %s: %r",
+                    kind, database, host, exc)
+        return
+    schema_cache.record(kind, host, database)
+
+
+def connect_with_schema(connect, kind, hosts, database, credentials,
+                        create_schema=True, schema_cache_dir=None):
+    """Call ``connect`` after verifying the schema
+
+    If the connection fails due to a missing keyspace or column family
+    while the cached verification said all was well, the cache entry is
+    dropped and the schema is verified again.
+
+    """
+    if not create_schema:
+        return connect(hosts, database, credentials)
+    schema_cache = SchemaCache(schema_cache_dir)
+    cached = schema_cache.verified(kind, hosts[0], database)
+    verify_schema(kind, hosts[0], database, schema_cache)
+    try:
+        return connect(hosts, database, credentials)
+    except (pycassa.InvalidRequestException, pycassa.NotFoundException):
+        if not cached:
+            raise
+        schema_cache.forget(kind, hosts[0], database)
+        verify_schema(kind, hosts[0], database, schema_cache)
+        return connect(hosts, database, credentials)
+
+
+def create_host_policy(hosts, latency_aware=False, local_hosts=None):
+    """Return a :class:`HostPolicy` if latency aware host selection is
+    enabled"""
+    if not latency_aware:
+        return None
+    if local_hosts:
+        local_hosts = parse_hosts(local_hosts)
+    return HostPolicy(hosts, local_hosts)
+
+
+def create_pool(database, hosts, credentials, policy=None, **kwargs):
+    """Return a connection pool, routed by ``policy`` if given"""
+    if policy is not None:
+        return PolicyConnectionPool(database, hosts, policy=policy,
+                                    credentials=credentials, **kwargs)
+    return pycassa.ConnectionPool(keyspace=database, server_list=hosts,
+                                  credentials=credentials, **kwargs)
+
+
+def wrap_func(func):
+    if inspect.isgeneratorfunction(func):
+        # Errors of generators only surface while iterating
+        def wrapper(*args, **kwargs):
+            try:
+                for item in func(*args, **kwargs):
+                    yield item
+            except (pycassa.UnavailableException, pycassa.TimedOutException,
+                    pycassa.MaximumRetryException):
+                raise StorageUnavailable("Unable to contact storage pool")
+    else:
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except (pycassa.UnavailableException, pycassa.TimedOutException,
+                    pycassa.MaximumRetryException):
+                raise StorageUnavailable("Unable to contact storage pool")
     for attr in "__module__", "__name__", "__doc__":
         setattr(wrapper, attr, getattr(func, attr))
     return wrapper
@@ -62,43 +197,223 @@ def raise_unavailable(cls):
     return cls
 
 
+class HedgedReader(object):
+    """Duplicates slow reads to a second host, the first answer wins
+
+    Each read is sent to a random host from one of ``workers`` primary
+    threads. If it hasn't answered within the ``percentile`` latency of
+    recent reads (but at least ``min_delay`` seconds) after it was sent, the
+    same read is sent to another host from one of ``workers`` hedge threads.
+    A host failing outright is hedged immediately. The caller gets the first
+    successful answer, the other one only if the first read failed.
+
+    Primary reads and hedges have threads and connections of their own, a
+    connection per thread and host, so a hedge never waits behind primary
+    reads. A thread stuck on a slow host is freed by the ``timeout`` of its
+    connection.
+
+    The ``stats`` dict counts the ``reads``, how often a hedge was
+    ``fired`` and how often the hedge ``won``.
+
+    If a :class:`~queuey.storage.pool.HostPolicy` is given, it picks the
+    hosts instead and is told about the latency and failures of each
+    attempt.
+
+    """
+    # Errors that are a valid answer rather than a failing host
+    answers = (pycassa.NotFoundException, pycassa.InvalidRequestException)
+
+    def __init__(self, hosts, keyspace, credentials=None, percentile=95,
+                 min_delay=0.005, workers=20, timeout=0.5, policy=None):
+        self.hosts = hosts
+        self.policy = policy
+        self.keyspace = keyspace
+        self.credentials = credentials
+        self.percentile = float(percentile)
+        self.min_delay = self.delay = min_delay
+        self.timeout = timeout
+        self.latencies = collections.deque(maxlen=1000)
+        self.workers = WorkerPool(workers)
+        self.hedgers = WorkerPool(workers)
+        self.timer = DeadlineTimer()
+        self.stats = {'reads': 0, 'fired': 0, 'won': 0}
+        self._samples = 0
+        self._fams = {}
+        self._lock = threading.Lock()
+
+    def _column_families(self, host, hedge=False):
+        key = (host, hedge)
+        if key not in self._fams:
+            with self._lock:
+                if key not in self._fams:
+                    threads = self.hedgers if hedge else self.workers
+                    # A connection for every thread, the hedge is the retry
+                    pool = create_pool(self.keyspace, [host],
+                                       self.credentials, prefill=False,
+                                       pool_size=threads.size, max_overflow=0,
+                                       timeout=self.timeout, max_retries=0)
+                    self._fams[key] = {
+                        'message_fam': pycassa.ColumnFamily(pool, 'Messages'),
+                        'meta_fam': pycassa.ColumnFamily(pool,
+                                                         'MessageMetadata'),
+                        'marker_fam': pycassa.ColumnFamily(pool,
+                                                           'WriteMarkers'),
+                    }
+        return self._fams[key]
+
+    def _incr(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _record(self, latency):
+        self.latencies.append(latency)
+        self._samples += 1
+        if self._samples % 100 == 0:
+            ordered = sorted(self.latencies)
+            index = int(len(ordered) * self.percentile / 100)
+            self.delay = max(self.min_delay,
+                             ordered[min(index, len(ordered) - 1)])
+
+    def read(self, fam, method, *args, **kwargs):
+        """Call ``method`` on the ``fam`` column family of two hosts"""
+        if self.policy is not None:
+            primary = self.policy.choose()
+            backup = self.policy.choose(exclude=(primary,))
+        else:
+            primary, backup = random.sample(self.hosts, 2)
+        answers = Queue.Queue()
+        policy = self.policy
+        lock = threading.Lock()
+        state = {'done': False, 'fired': False}
+
+        def attempt(host, hedge=False):
+            start = time.time()
+            if not hedge:
+                # The delay counts from sending the primary read, not from
+                # queueing it
+                self.timer.schedule(start + self.delay, fire)
+            try:
+                cf = self._column_families(host, hedge)[fam]
+                result = getattr(cf, method)(*args, **kwargs)
+            except self.answers, exc:
+                answers.put((host, False, exc, None))
+                return
+            except Exception, exc:
+                if policy is not None:
+                    policy.record(host, error=True)
+                answers.put((host, True, exc, None))
+                return
+            latency = time.time() - start
+            self._record(latency)
+            if policy is not None:
+                policy.record(host, latency)
+            answers.put((host, False, None, result))
+
+        def fire():
+            with lock:
+                if state['done'] or state['fired']:
+                    return
+                state['fired'] = True
+            self._incr('fired')
+            self.hedgers.submit(attempt, backup, True)
+
+        self._incr('reads')
+        self.workers.submit(attempt, primary)
+        answer = first = answers.get()
+        if answer[1]:
+            fire()
+            # The other read is still out, its answer is the last chance
+            answer = answers.get()
+        with lock:
+            state['done'] = True
+        if first[0] == backup and not first[1]:
+            self._incr('won')
+        host, failed, exc, result = answer
+        if exc is not None:
+            raise exc
+        return result
+
+
 @raise_unavailable
 class CassandraQueueBackend(object):
     implements(MessageQueueBackend)
 
     def __init__(self, username=None, password=None, database='MessageStore',
                  host='localhost', base_delay=None, multi_dc=False,
-                 create_schema=True):
+                 create_schema=True, schema_cache_dir=None,
+                 compress_threshold=1024, hedged_reads=False,
+                 hedge_percentile=95, hedge_min_delay=5, hedge_timeout=500,
+                 latency_aware=False, local_hosts=None, coalesce_window=0,
+                 coalesce_max=100):
         """Create a Cassandra backend for the Message Queue
 
         :param host: Hostname, accepts either an IP, hostname, hostname:port,
                      or a comma seperated list of 'hostname:port'
+        :param schema_cache_dir: Directory recording already verified
+                                 schemas, defaults to a directory in the
+                                 system temp dir
+        :param compress_threshold: Minimum body size in bytes to compress
+                                   when pushing with compression enabled
+        :param hedged_reads: Whether weak consistency reads should be
+                             duplicated to a second host when the first
+                             one is slow to answer
+        :param hedge_percentile: Latency percentile of recent reads after
+                                 which a read is hedged
+        :param hedge_min_delay: Minimum delay in milliseconds before a read
+                                is hedged
+        :param hedge_timeout: Milliseconds after which a hedged read of a
+                              host that doesn't answer fails
+        :param latency_aware: Whether connections should go to the fastest
+                              healthy hosts instead of rotating through
+                              all of them
+        :param local_hosts: Comma seperated list of the hosts in the local
+                            data center, preferred by latency aware host
+                            selection
+        :param coalesce_window: Milliseconds concurrent message pushes are
+                                collected for a single batch mutation,
+                                ``0`` sends every push on its own
+        :param coalesce_max: Amount of inserts after which a coalesced
+                             batch is sent right away
 
         """
         hosts = parse_hosts(host)
-        if create_schema:
-            self._create_schema(hosts[0], database)
+        self.host_policy = create_host_policy(hosts, latency_aware,
+                                              local_hosts)
         credentials = None
         if username and password is not None:
             credentials = dict(username=username, password=password)
-        self.pool = pool = pycassa.ConnectionPool(
-            keyspace=database,
-            server_list=hosts,
-            credentials=credentials,
-        )
-        self.message_fam = pycassa.ColumnFamily(pool, 'Messages')
-        self.meta_fam = pycassa.ColumnFamily(pool, 'MessageMetadata')
+        connect_with_schema(self._connect, 'message', hosts, database,
+                            credentials, create_schema, schema_cache_dir)
         self.delay = int(base_delay) if base_delay else 0
         self.cl = ONE if len(hosts) < 2 else None
         self.multi_dc = multi_dc
+        self.compress_threshold = int(compress_threshold)
+        self.hedged_reader = None
+        if hedged_reads and len(hosts) > 1:
+            self.hedged_reader = HedgedReader(
+                hosts, database, credentials, percentile=hedge_percentile,
+                min_delay=float(hedge_min_delay) / 1000,
+                timeout=float(hedge_timeout) / 1000, policy=self.host_policy)
+        self.coalescer = None
+        if float(coalesce_window) > 0:
+            self.coalescer = WriteCoalescer(
+                self._send_inserts, window=float(coalesce_window) / 1000,
+                max_items=int(coalesce_max))
 
-    def _create_schema(self, host, database):
-        try:
-            sm = Schema(host)
-            sm.install_message(database)
-            sm.close()
-        except TException:
-            pass
+    def _connect(self, hosts, database, credentials):
+        self.pool = pool = create_pool(database, hosts, credentials,
+                                       self.host_policy)
+        self.message_fam = pycassa.ColumnFamily(pool, 'Messages')
+        self.meta_fam = pycassa.ColumnFamily(pool, 'MessageMetadata')
+        self.marker_fam = pycassa.ColumnFamily(pool, 'WriteMarkers')
+        self.lease_fam = pycassa.ColumnFamily(pool, 'MessageLeases')
+
+    def host_stats(self):
+        """Return latency and error statistics per host, empty unless
+        latency aware host selection is enabled"""
+        if self.host_policy is None:
+            return {}
+        return self.host_policy.host_stats()
 
     def _get_cl(self, consistency):
         """Return the consistency operation to use"""
@@ -111,6 +426,52 @@ class CassandraQueueBackend(object):
         else:
             return LOCAL_QUORUM
 
+    def _read(self, consistency, fam, method, *args, **kwargs):
+        """Run a read on one of the column families, hedged for weak
+        consistency reads if enabled"""
+        if self.hedged_reader and consistency == 'weak':
+            return self.hedged_reader.read(fam, method, *args, **kwargs)
+        return getattr(getattr(self, fam), method)(*args, **kwargs)
+
+    def _start_uuid(self, start_at):
+        """Convert a message id or timestamp to a start column"""
+        if isinstance(start_at, basestring):
+            # Assume its a hex, transform to a datetime
+            return uuid.UUID(hex=start_at)
+        else:
+            # Assume its a float/decimal, convert to UUID
+            return convert_time_to_uuid(start_at)
+
+    def _get_cut_off(self, delay):
+        """Return the UUID time after which messages are left out"""
+        if not delay:
+            return None
+        cut_off = time.time() - delay
+        # Turn it into time in ns, for efficient comparison
+        return int(cut_off * 1e7) + 0x01b21dd213814000L
+
+    def _message(self, queue_name, msg_id, body):
+        """Build the message dict of a stored message"""
+        return {
+            'message_id': msg_id.hex,
+            'timestamp': (Decimal(msg_id.time - 0x01b21dd213814000L) /
+                DECIMAL_1E7),
+            'body': body,
+            'metadata': {},
+            'queue_name': queue_name[queue_name.find(':'):]
+        }
+
+    def _add_metadata(self, consistency, msg_hash, include_metadata):
+        """Read the metadata of messages keyed by id, decompressing their
+        bodies"""
+        results = self._read(consistency, 'meta_fam', 'multiget',
+                             keys=msg_hash.keys())
+        for msg_id, metadata in results.items():
+            obj = msg_hash[msg_id]
+            obj['body'] = decompress_body(obj['body'], metadata)
+            if include_metadata:
+                obj['metadata'] = metadata
+
     def _get_delay(self, consistency):
         """Return the delay value to use for the results"""
         if self.cl:
@@ -124,8 +485,44 @@ class CassandraQueueBackend(object):
 
     def retrieve_batch(self, consistency, application_name, queue_names,
                        limit=None, include_metadata=False, start_at=None,
-                       order="ascending"):
+                       order="ascending", decompress=False):
         """Retrieve a batch of messages off the queue"""
+        result_list = []
+        msg_hash = {}
+        for queue_name, msg_id, body in self._columns(
+                consistency, application_name, queue_names, limit, start_at,
+                order):
+            obj = self._message(queue_name, msg_id, body)
+            result_list.append(obj)
+            msg_hash[msg_id] = obj
+
+        # Get metadata?
+        if (include_metadata or decompress) and msg_hash:
+            self._add_metadata(consistency, msg_hash, include_metadata)
+        return result_list
+
+    def retrieve_rows(self, consistency, application_name, queue_names,
+                      limit=None, start_at=None, order="ascending",
+                      decompress=False):
+        """Retrieve a batch of messages off the queue as tuples"""
+        columns = self._columns(consistency, application_name, queue_names,
+                                limit, start_at, order)
+        metadata = {}
+        if decompress and columns:
+            metadata = self._read(consistency, 'meta_fam', 'multiget',
+                                  keys=[x[1] for x in columns])
+        prefix = len(application_name) + 1
+        rows = []
+        for queue_name, msg_id, body in columns:
+            if msg_id in metadata:
+                body = decompress_body(body, metadata[msg_id])
+            rows.append((msg_id.hex, msg_id.time, body, queue_name[prefix:]))
+        return rows
+
+    def _columns(self, consistency, application_name, queue_names, limit,
+                 start_at, order):
+        """Read the message columns of the queues, returns a list of
+        ``(queue_name, msg_id, body)`` tuples with full queue names"""
         if not isinstance(queue_names, list):
             raise Exception("queue_names must be a list")
 
@@ -140,49 +537,86 @@ class CassandraQueueBackend(object):
             kwargs['column_count'] = limit
 
         if start_at:
-            if isinstance(start_at, basestring):
-                # Assume its a hex, transform to a datetime
-                start_at = uuid.UUID(hex=start_at)
-            else:
-                # Assume its a float/decimal, convert to UUID
-                start_at = convert_time_to_uuid(start_at)
-
-            kwargs['column_start'] = start_at
+            kwargs['column_start'] = self._start_uuid(start_at)
 
         queue_names = ['%s:%s' % (application_name, x) for x in queue_names]
-        results = self.message_fam.multiget(keys=queue_names, **kwargs)
-        results = results.items()
-        if delay:
-            cut_off = time.time() - delay
-            # Turn it into time in ns, for efficient comparison
-            cut_off = int(cut_off * 1e7) + 0x01b21dd213814000L
+        results = self._read(consistency, 'message_fam', 'multiget',
+                             keys=queue_names, **kwargs)
+        cut_off = self._get_cut_off(delay)
 
-        result_list = []
-        msg_hash = {}
-        for queue_name, messages in results:
+        columns = []
+        for queue_name, messages in results.items():
             for msg_id, body in messages.items():
                 if delay and msg_id.time >= cut_off:
                     continue
-                obj = {
-                    'message_id': msg_id.hex,
-                    'timestamp': (Decimal(msg_id.time - 0x01b21dd213814000L) /
-                        DECIMAL_1E7),
-                    'body': body,
-                    'metadata': {},
-                    'queue_name': queue_name[queue_name.find(':'):]
-                }
-                result_list.append(obj)
-                msg_hash[msg_id] = obj
+                columns.append((queue_name, msg_id, body))
+        return columns
 
-        # Get metadata?
-        if include_metadata:
-            results = self.meta_fam.multiget(keys=msg_hash.keys())
-            for msg_id, metadata in results.items():
-                msg_hash[msg_id]['metadata'] = metadata
-        return result_list
+    def retrieve_iter(self, consistency, application_name, queue_names,
+                      limit=None, include_metadata=False, start_at=None,
+                      order="ascending", decompress=False, chunk_size=100):
+        """Retrieve messages off the queues, reading ``chunk_size``
+        messages at a time"""
+        if not isinstance(queue_names, list):
+            raise Exception("queue_names must be a list")
+
+        cl = self.cl or self._get_cl(consistency)
+        delay = self._get_delay(consistency)
+        cut_off = self._get_cut_off(delay)
+
+        kwargs = {'read_consistency_level': cl}
+        if order == 'descending':
+            kwargs['column_reversed'] = True
+        if start_at:
+            start_at = self._start_uuid(start_at)
+
+        for queue_name in queue_names:
+            queue_name = '%s:%s' % (application_name, queue_name)
+            column_start = start_at or ''
+            remaining = limit
+            paging = False
+            while remaining is None or remaining > 0:
+                count = chunk_size
+                if remaining is not None:
+                    count = min(count, remaining)
+                # Column slices include their start, which was the last
+                # message of the previous chunk
+                try:
+                    messages = self._read(
+                        consistency, 'message_fam', 'get', queue_name,
+                        column_start=column_start,
+                        column_count=count + paging, **kwargs).items()
+                except pycassa.NotFoundException:
+                    break
+                if paging and messages and messages[0][0] == column_start:
+                    messages = messages[1:]
+                messages = messages[:count]
+                if not messages:
+                    break
+                if remaining is not None:
+                    remaining -= len(messages)
+
+                chunk = []
+                msg_hash = {}
+                for msg_id, body in messages:
+                    if delay and msg_id.time >= cut_off:
+                        continue
+                    obj = self._message(queue_name, msg_id, body)
+                    chunk.append(obj)
+                    msg_hash[msg_id] = obj
+                if (include_metadata or decompress) and msg_hash:
+                    self._add_metadata(consistency, msg_hash,
+                                       include_metadata)
+                for obj in chunk:
+                    yield obj
+
+                if len(messages) < count:
+                    break
+                column_start = messages[-1][0]
+                paging = True
 
     def retrieve(self, consistency, application_name, queue_name, message_id,
-                 include_metadata=False):
+                 include_metadata=False, decompress=False):
         """Retrieve a single message"""
         cl = self.cl or self._get_cl(consistency)
         if isinstance(message_id, basestring):
@@ -197,33 +631,34 @@ class CassandraQueueBackend(object):
             'columns': [message_id]}
         queue_name = '%s:%s' % (application_name, queue_name)
         try:
-            results = self.message_fam.get(key=queue_name, **kwargs)
+            results = self._read(consistency, 'message_fam', 'get',
+                                 key=queue_name, **kwargs)
         except (pycassa.NotFoundException, pycassa.InvalidRequestException):
             return {}
         msg_id, body = results.items()[0]
-
-        obj = {
-            'message_id': msg_id.hex,
-            'timestamp': (Decimal(msg_id.time - 0x01b21dd213814000L) /
-                DECIMAL_1E7),
-            'body': body,
-            'metadata': {},
-            'queue_name': queue_name[queue_name.find(':'):]
-        }
+        obj = self._message(queue_name, msg_id, body)
 
         # Get metadata?
-        if include_metadata:
+        if include_metadata or decompress:
             try:
-                results = self.meta_fam.get(key=msg_id)
-                obj['metadata'] = results
+                metadata = self._read(consistency, 'meta_fam', 'get',
+                                      key=msg_id)
             except pycassa.NotFoundException:
-                pass
+                metadata = {}
+            obj['body'] = decompress_body(body, metadata)
+            if include_metadata:
+                obj['metadata'] = metadata
         return obj
 
     def push(self, consistency, application_name, queue_name, message,
-             metadata=None, ttl=60 * 60 * 24 * 3, timestamp=None):
+             metadata=None, ttl=60 * 60 * 24 * 3, timestamp=None,
+             compress=False):
         """Push a message onto the queue"""
         cl = self.cl or self._get_cl(consistency)
+        if compress:
+            metadata = dict(metadata or {})
+            message = compress_body(message, metadata,
+                                    self.compress_threshold)
         if not timestamp:
             now = uuid.uuid1()
         elif isinstance(timestamp, (float, Decimal)):
@@ -231,52 +666,146 @@ class CassandraQueueBackend(object):
         else:
             now = uuid.UUID(hex=timestamp)
         queue_name = '%s:%s' % (application_name, queue_name)
+        batch = pycassa.batch.Mutator(self.pool, write_consistency_level=cl)
+        batch.insert(self.message_fam, key=queue_name,
+                     columns={now: message}, ttl=ttl)
         if metadata:
-            batch = pycassa.batch.Mutator(self.pool,
-                                          write_consistency_level=cl)
-            batch.insert(self.message_fam, key=queue_name,
-                         columns={now: message}, ttl=ttl)
             batch.insert(self.meta_fam, key=now, columns=metadata, ttl=ttl)
-            batch.send()
-        else:
-            self.message_fam.insert(key=queue_name, columns={now: message},
-                                    ttl=ttl, write_consistency_level=cl)
+        if timestamp:
+            # An update replaces the body, so flags of the old one are stale
+            stale = [x for x in ENCODING_FLAGS if x not in (metadata or {})]
+            batch.remove(self.meta_fam, key=now, columns=stale)
+        # Updates reuse the message id, so always mark with a new one
+        batch.insert(self.marker_fam, key=queue_name,
+                     columns={'last': uuid.uuid1().hex})
+        batch.send()
         timestamp = Decimal(now.time - 0x01b21dd213814000L) / DECIMAL_1E7
         return now.hex, timestamp
 
-    def push_batch(self, consistency, application_name, message_data):
-        """Push a batch of messages"""
-        cl = self.cl or self._get_cl(consistency)
+    def _send_inserts(self, cl, inserts):
+        """Send ``(column_family, key, columns, ttl)`` inserts as one batch
+        mutation"""
         batch = pycassa.batch.Mutator(self.pool, write_consistency_level=cl)
+        for column_family, key, columns, ttl in inserts:
+            batch.insert(column_family, key=key, columns=columns, ttl=ttl)
+        batch.send()
+
+    def push_batch(self, consistency, application_name, message_data,
+                   compress=False, message_ids=None):
+        """Push a batch of messages
+
+        With a ``coalesce_window`` the batch is sent together with the
+        concurrent pushes of the same consistency level.
+
+        """
+        cl = self.cl or self._get_cl(consistency)
+        inserts = []
         msgs = []
-        for queue_name, body, ttl, metadata in message_data:
+        markers = {}
+        for index, (queue_name, body, ttl, metadata) in \
+                enumerate(message_data):
             qn = '%s:%s' % (application_name, queue_name)
-            now = uuid.uuid1()
-            batch.insert(self.message_fam, key=qn, columns={now: body},
-                         ttl=ttl)
+            if compress:
+                metadata = dict(metadata or {})
+                body = compress_body(body, metadata, self.compress_threshold)
+            if message_ids:
+                now = uuid.UUID(hex=message_ids[index])
+            else:
+                now = uuid.uuid1()
+            inserts.append((self.message_fam, qn, {now: body}, ttl))
             if metadata:
-                batch.insert(self.meta_fam, key=now, columns=metadata, ttl=ttl)
+                inserts.append((self.meta_fam, now, metadata, ttl))
+            # Given ids may be older than the last write
+            markers[qn] = uuid.uuid1().hex if message_ids else now.hex
             timestamp = (Decimal(now.time - 0x01b21dd213814000L) / DECIMAL_1E7)
             msgs.append((now.hex, timestamp))
-        batch.send()
+        for qn, marker in markers.items():
+            inserts.append((self.marker_fam, qn, {'last': marker}, None))
+        if self.coalescer:
+            self.coalescer.write(cl, inserts)
+        else:
+            self._send_inserts(cl, inserts)
         return msgs
 
     def truncate(self, consistency, application_name, queue_name):
         """Remove all contents of the queue"""
         cl = self.cl or self._get_cl(consistency)
         queue_name = '%s:%s' % (application_name, queue_name)
-        self.message_fam.remove(key=queue_name, write_consistency_level=cl)
+        batch = pycassa.batch.Mutator(self.pool, write_consistency_level=cl)
+        batch.remove(self.message_fam, key=queue_name)
+        batch.remove(self.lease_fam, key=queue_name)
+        batch.insert(self.marker_fam, key=queue_name,
+                     columns={'last': uuid.uuid1().hex})
+        batch.send()
         return True
 
     def delete(self, consistency, application_name, queue_name, *keys):
         """Delete a batch of keys"""
         cl = self.cl or self._get_cl(consistency)
         queue_name = '%s:%s' % (application_name, queue_name)
-        self.message_fam.remove(key=queue_name,
-                                columns=[uuid.UUID(hex=x) for x in keys],
-                                write_consistency_level=cl)
+        batch = pycassa.batch.Mutator(self.pool, write_consistency_level=cl)
+        columns = [uuid.UUID(hex=x) for x in keys]
+        batch.remove(self.message_fam, key=queue_name, columns=columns)
+        batch.remove(self.lease_fam, key=queue_name, columns=columns)
+        batch.insert(self.marker_fam, key=queue_name,
+                     columns={'last': uuid.uuid1().hex})
+        batch.send()
         return True
 
+    def claim(self, consistency, application_name, queue_names, limit, lease,
+              decompress=False):
+        """Lease up to ``limit`` unclaimed messages of the queues
+
+        Leases are columns of the message id in the MessageLeases row of
+        the queue, written with a TTL of the lease so they expire by
+        themselves. Cassandra has no conditional writes, so two claims
+        running at the same time can both lease the same message, the
+        lease written last merely ends up in the row.
+
+        """
+        cl = self.cl or self._get_cl(consistency)
+        claim_id = uuid.uuid4().hex
+        keys = ['%s:%s' % (application_name, x) for x in queue_names]
+        leased = self.lease_fam.multiget(keys, column_count=MAX_LEASES,
+                                         read_consistency_level=cl)
+        claimed = []
+        for queue_name, key in zip(queue_names, keys):
+            wanted = limit - len(claimed)
+            if wanted <= 0:
+                break
+            active = leased.get(key, {})
+            # Read enough messages to find unleased ones past the leased
+            messages = self.retrieve_batch(
+                consistency, application_name, [queue_name],
+                limit=wanted + len(active), decompress=decompress)
+            candidates = [x for x in messages
+                          if uuid.UUID(hex=x['message_id']) not in active]
+            candidates = candidates[:wanted]
+            if not candidates:
+                continue
+            columns = [uuid.UUID(hex=x['message_id']) for x in candidates]
+            self.lease_fam.insert(key, dict((x, claim_id) for x in columns),
+                                  ttl=int(lease), write_consistency_level=cl)
+            claimed.extend(candidates)
+        return claim_id, claimed
+
+    def write_markers(self, consistency, application_name, queue_names):
+        """Return the id of the last write to each queue"""
+        cl = self.cl or self._get_cl(consistency)
+        keys = ['%s:%s' % (application_name, x) for x in queue_names]
+        results = self._read(consistency, 'marker_fam', 'multiget',
+                             keys=keys, columns=['last'],
+                             read_consistency_level=cl)
+        cut_off = self._get_cut_off(self._get_delay(consistency))
+        markers = {}
+        for key, columns in results.items():
+            marker = columns['last']
+            if cut_off and uuid.UUID(hex=marker).time >= cut_off:
+                # Reads don't show this write yet
+                return None
+            markers[key[key.find(':') + 1:]] = marker
+        return markers
+
     def count(self, consistency, application_name, queue_name):
         """Return a count of the items in this queue"""
         cl = self.cl or self._get_cl(consistency)
@@ -290,36 +819,49 @@ class CassandraMetadata(object):
     implements(MetadataBackend)
 
     def __init__(self, username=None, password=None, database='MetadataStore',
-                 host='localhost', multi_dc=False, create_schema=True):
+                 host='localhost', multi_dc=False, create_schema=True,
+                 schema_cache_dir=None, latency_aware=False, local_hosts=None):
         """Create a Cassandra backend for the Message Queue
 
         :param host: Hostname, accepts either an IP, hostname, hostname:port,
                      or a comma seperated list of 'hostname:port'
+        :param schema_cache_dir: Directory recording already verified
+                                 schemas, defaults to a directory in the
+                                 system temp dir
+        :param latency_aware: Whether connections should go to the fastest
+                              healthy hosts instead of rotating through
+                              all of them
+        :param local_hosts: Comma seperated list of the hosts in the local
+                            data center, preferred by latency aware host
+                            selection
 
         """
         hosts = parse_hosts(host)
-        if create_schema:
-            self._create_schema(hosts[0], database)
+        self.host_policy = create_host_policy(hosts, latency_aware,
+                                              local_hosts)
         credentials = None
         if username and password is not None:
             credentials = dict(username=username, password=password)
-        self.pool = pool = pycassa.ConnectionPool(
-            keyspace=database,
-            server_list=hosts,
-            credentials=credentials,
-        )
-        self.metric_fam = pycassa.ColumnFamily(pool, 'ApplicationQueueData')
-        self.queue_fam = pycassa.ColumnFamily(pool, 'Queues')
+        connect_with_schema(self._connect, 'metadata', hosts, database,
+                            credentials, create_schema, schema_cache_dir)
         self.cl = ONE if len(hosts) < 2 else None
         self.multi_dc = multi_dc
 
-    def _create_schema(self, host, database):
-        try:
-            sm = Schema(host)
-            sm.install_metadata(database)
-            sm.close()
-        except TException:
-            pass
+    def _connect(self, hosts, database, credentials):
+        self.pool = pool = create_pool(database, hosts, credentials,
+                                       self.host_policy)
+        self.metric_fam = pycassa.ColumnFamily(pool, 'ApplicationQueueData')
+        self.queue_fam = pycassa.ColumnFamily(pool, 'Queues')
+        self.app_queue_fam = pycassa.ColumnFamily(pool, 'ApplicationQueues')
+        self.offset_fam = pycassa.ColumnFamily(pool, 'ConsumerOffsets')
+        self.member_fam = pycassa.ColumnFamily(pool, 'ConsumerMembers')
+
+    def host_stats(self):
+        """Return latency and error statistics per host, empty unless
+        latency aware host selection is enabled"""
+        if self.host_policy is None:
+            return {}
+        return self.host_policy.host_stats()
 
     def register_queue(self, application_name, queue_name, **metadata):
         """Register a queue, optionally with metadata"""
@@ -338,8 +880,11 @@ class CassandraMetadata(object):
         metadata['application'] = application_name
         if 'created' not in metadata:
             metadata['created'] = time.time()
-        self.queue_fam.insert(queue_name, columns=metadata,
-                              write_consistency_level=cl)
+        batch = pycassa.batch.Mutator(self.pool, write_consistency_level=cl)
+        batch.insert(self.queue_fam, queue_name, columns=metadata)
+        batch.insert(self.app_queue_fam, application_name,
+                     columns={queue_name[len(application_name) + 1:]: ''})
+        batch.send()
         self.metric_fam.add(application_name, column='queue_count', value=1,
                             write_consistency_level=cl)
         return True
@@ -347,14 +892,16 @@ class CassandraMetadata(object):
     def remove_queue(self, application_name, queue_name):
         """Remove a queue"""
         cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
-        queue_name = '%s:%s' % (application_name, queue_name)
+        key = '%s:%s' % (application_name, queue_name)
         try:
-            self.queue_fam.get(key=queue_name,
-                               read_consistency_level=cl)
+            self.queue_fam.get(key=key, read_consistency_level=cl)
         except pycassa.NotFoundException:
             return False
-        self.queue_fam.remove(key=queue_name,
-                            write_consistency_level=cl)
+        batch = pycassa.batch.Mutator(self.pool, write_consistency_level=cl)
+        batch.remove(self.queue_fam, key)
+        batch.remove(self.app_queue_fam, application_name,
+                     columns=[queue_name])
+        batch.send()
         self.metric_fam.add(application_name, column='queue_count', value=-1,
                             write_consistency_level=cl)
         return True
@@ -362,18 +909,45 @@ class CassandraMetadata(object):
     def queue_list(self, application_name, limit=100, offset=None):
         """Return list of queues"""
         cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
-        app_expr = create_index_expression('application', application_name)
-        if offset:
-            offset = '%s:%s' % (application_name, offset)
-            clause = create_index_clause([app_expr], start_key=offset,
-                                         count=limit)
-        else:
-            clause = create_index_clause([app_expr], count=limit)
-        results = self.queue_fam.get_indexed_slices(
-            clause, columns=['application'], read_consistency_level=cl)
-        # Pull off the application name in front
-        app_len = len(application_name) + 1
-        return [key[app_len:] for key, _ in results]
+        try:
+            results = self.app_queue_fam.get(
+                application_name, column_start=offset or '',
+                column_count=limit or 100, read_consistency_level=cl)
+        except pycassa.NotFoundException:
+            return []
+        return results.keys()
+
+    def backfill_queue_index(self, batch_size=100):
+        """Rebuild the per-application queue index from the Queues
+        column family
+
+        Queues registered before the ApplicationQueues column family
+        existed are only reachable through the old secondary index, this
+        adds them to the index rows used by :meth:`queue_list`. Running
+        it more than once is harmless.
+
+        :returns: Amount of queues indexed
+        :rtype: int
+
+        """
+        cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
+        batch = pycassa.batch.Mutator(self.pool, queue_size=batch_size,
+                                      write_consistency_level=cl)
+        count = 0
+        rows = self.queue_fam.get_range(columns=['application'],
+                                        buffer_size=batch_size,
+                                        read_consistency_level=cl)
+        for key, columns in rows:
+            application_name = columns.get('application')
+            if not application_name:
+                # Deleted rows show up without columns until compaction
+                continue
+            queue_name = key[len(application_name) + 1:]
+            batch.insert(self.app_queue_fam, application_name,
+                         columns={queue_name: ''})
+            count += 1
+        batch.send()
+        return count
 
     def queue_information(self, application_name, queue_names):
         """Return information on a registered queue"""
@@ -388,6 +962,90 @@ class CassandraMetadata(object):
             results.append(queues.get(queue, {}))
         return results
 
+    def commit_offsets(self, offsets):
+        """Store the offsets of consumer groups in one batch"""
+        cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
+        batch = pycassa.batch.Mutator(self.pool, write_consistency_level=cl)
+        for (application_name, queue_name, group), partitions in \
+                offsets.items():
+            key = '%s:%s:%s' % (application_name, queue_name, group)
+            batch.insert(self.offset_fam, key, columns=dict(
+                (str(x), y) for x, y in partitions.items()))
+        batch.send()
+        return True
+
+    def consumer_offsets(self, application_name, queue_name, group):
+        """Return the committed offsets of a consumer group"""
+        cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
+        key = '%s:%s:%s' % (application_name, queue_name, group)
+        try:
+            columns = self.offset_fam.get(key, read_consistency_level=cl)
+        except pycassa.NotFoundException:
+            return {}
+        return dict((int(x), y) for x, y in columns.items())
+
+    def heartbeat(self, application_name, queue_name, group, member,
+                  timeout):
+        """Register a member of a consumer group for ``timeout`` seconds"""
+        cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
+        key = '%s:%s:%s' % (application_name, queue_name, group)
+        # Members expire with their column
+        self.member_fam.insert(key, {member: ''}, ttl=int(timeout),
+                               write_consistency_level=cl)
+        return True
+
+    def leave(self, application_name, queue_name, group, member):
+        """Remove a member of a consumer group"""
+        cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
+        key = '%s:%s:%s' % (application_name, queue_name, group)
+        self.member_fam.remove(key, columns=[member],
+                               write_consistency_level=cl)
+        return True
+
+    def group_members(self, application_name, queue_name, group):
+        """Return the registered members of a consumer group"""
+        cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
+        key = '%s:%s:%s' % (application_name, queue_name, group)
+        try:
+            columns = self.member_fam.get(key, column_count=MAX_MEMBERS,
+                                          read_consistency_level=cl)
+        except pycassa.NotFoundException:
+            return []
+        return sorted(x for x in columns if not x.startswith(':'))
+
+    def group_assignment(self, application_name, queue_name, group):
+        """Return the stored partition assignment of a consumer group"""
+        cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
+        key = '%s:%s:%s' % (application_name, queue_name, group)
+        try:
+            columns = self.member_fam.get(key, columns=ASSIGNMENT_COLUMNS,
+                                          read_consistency_level=cl)
+        except pycassa.NotFoundException:
+            return None, {}
+        if len(columns) < 2:
+            return None, {}
+        assignment = {}
+        # Stored as member=1,2,3;member=4,5
+        for item in columns[':assignment'].split(';'):
+            if item:
+                member, _, partitions = item.partition('=')
+                assignment[member] = [int(x) for x in partitions.split(',')
+                                      if x]
+        return columns[':generation'], assignment
+
+    def set_group_assignment(self, application_name, queue_name, group,
+                             generation, assignment, ttl):
+        """Store the partition assignment of a consumer group"""
+        cl = self.cl or LOCAL_QUORUM if self.multi_dc else QUORUM
+        key = '%s:%s:%s' % (application_name, queue_name, group)
+        value = ';'.join('%s=%s' % (x, ','.join(str(p) for p in y))
+                         for x, y in sorted(assignment.items()))
+        # Member ids can't start with a colon, so these never clash
+        self.member_fam.insert(key, {':generation': generation,
+                                     ':assignment': value},
+                               ttl=int(ttl), write_consistency_level=cl)
+        return True
+
 
 class Schema(object):
 
@@ -434,6 +1092,21 @@ class Schema(object):
                     }
             )
 
+        if 'MessageLeases' not in cfs:
+            sm.create_column_family(database, 'MessageLeases',
+                comparator_type=self.TIME_UUID_TYPE,
+                default_validation_class=self.UTF8_TYPE,
+                key_validation_class=self.UTF8_TYPE,
+            )
+
+        if 'WriteMarkers' not in cfs:
+            sm.create_column_family(database, 'WriteMarkers',
+                comparator_type=self.UTF8_TYPE,
+                default_validation_class=self.UTF8_TYPE,
+                key_validation_class=self.UTF8_TYPE,
+                caching='all',
+            )
+
     def install_metadata(self, database='MetadataStore'):
         sm = self.sm
         keyspaces = sm.list_keyspaces()
@@ -471,5 +1144,26 @@ class Schema(object):
             sm.create_index(database, 'Queues', 'type',
                 self.UTF8_TYPE, index_type=self.KEYS_INDEX)
 
+        if 'ApplicationQueues' not in cfs:
+            sm.create_column_family(database, 'ApplicationQueues',
+                comparator_type=self.UTF8_TYPE,
+                key_validation_class=self.UTF8_TYPE,
+                caching='all',
+            )
+
+        if 'ConsumerOffsets' not in cfs:
+            sm.create_column_family(database, 'ConsumerOffsets',
+                comparator_type=self.UTF8_TYPE,
+                default_validation_class=self.UTF8_TYPE,
+                key_validation_class=self.UTF8_TYPE,
+            )
+
+        if 'ConsumerMembers' not in cfs:
+            sm.create_column_family(database, 'ConsumerMembers',
+                comparator_type=self.UTF8_TYPE,
+                default_validation_class=self.UTF8_TYPE,
+                key_validation_class=self.UTF8_TYPE,
+            )
+
     def close(self):
         self.sm.close()
@@ -3,6 +3,7 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 from collections import defaultdict
 from cdecimal import Decimal
+import threading
 import uuid
 import time
 
@@ -10,7 +11,9 @@ from zope.interface import implements
 
 from queuey.storage import MessageQueueBackend
 from queuey.storage import MetadataBackend
+from queuey.storage.util import compress_body
 from queuey.storage.util import convert_time_to_uuid
+from queuey.storage.util import decompress_body
 
 DECIMAL_1E7 = Decimal('1e7')
 
@@ -21,6 +24,25 @@ message_store = defaultdict(list)
 # Applcation's keyed by application name
 metadata_store = {}
 
+# Id of the last write keyed by application_name + queue_name
+marker_store = {}
+
+# Consumer group offsets keyed by application_name, queue_name and group
+offset_store = defaultdict(dict)
+
+# Expiry time of consumer group members keyed by application_name,
+# queue_name and group
+member_store = defaultdict(dict)
+
+# Generation, assignment and expiry time of consumer group partitions keyed
+# by application_name, queue_name and group
+assignment_store = {}
+
+# Leases of claimed messages keyed by application_name + queue_name, each
+# a dict of claim id and expiration keyed by message id
+lease_store = defaultdict(dict)
+lease_lock = threading.Lock()
+
 
 class Message(object):
     def __init__(self, id, body, ttl, **metadata):
@@ -54,13 +76,58 @@ class QueueMetadata(object):
 class MemoryQueueBackend(object):
     implements(MessageQueueBackend)
 
-    def __init__(self):
-        pass
+    def __init__(self, compress_threshold=1024):
+        self.compress_threshold = int(compress_threshold)
 
     def retrieve_batch(self, consistency, application_name, queue_names,
                        limit=None, include_metadata=False, start_at=None,
-                       order="ascending"):
+                       order="ascending", decompress=False):
         """Retrieve a batch of messages off the queue"""
+        return list(self.retrieve_iter(
+            consistency, application_name, queue_names, limit=limit,
+            include_metadata=include_metadata, start_at=start_at,
+            order=order, decompress=decompress))
+
+    def retrieve_iter(self, consistency, application_name, queue_names,
+                      limit=None, include_metadata=False, start_at=None,
+                      order="ascending", decompress=False, chunk_size=100):
+        """Retrieve messages off the queues one at a time"""
+        for queue_name, msg in self._stored(application_name, queue_names,
+                                            limit, start_at, order):
+            obj = {
+                'message_id': msg.id.hex,
+                'timestamp': (Decimal(msg.id.time - 0x01b21dd213814000L) /
+                    DECIMAL_1E7),
+                'body': msg.body,
+                'metadata': {},
+                'queue_name': queue_name[queue_name.find(':'):]
+            }
+            if include_metadata or decompress:
+                metadata = msg.metadata.copy()
+                obj['body'] = decompress_body(msg.body, metadata)
+                if include_metadata:
+                    obj['metadata'] = metadata
+            yield obj
+
+    def retrieve_rows(self, consistency, application_name, queue_names,
+                      limit=None, start_at=None, order="ascending",
+                      decompress=False):
+        """Retrieve messages off the queues as tuples"""
+        prefix = len(application_name) + 1
+        rows = []
+        for queue_name, msg in self._stored(application_name, queue_names,
+                                            limit, start_at, order):
+            body = msg.body
+            if decompress and msg.metadata:
+                body = decompress_body(body, msg.metadata.copy())
+            rows.append((msg.id.hex, msg.id.time, body,
+                         queue_name[prefix:]))
+        return rows
+
+    def _stored(self, application_name, queue_names, limit, start_at,
+                order):
+        """Yield the live messages of the queues with their full queue
+        name"""
         if not isinstance(queue_names, list):
             raise Exception("queue_names must be a list")
 
@@ -75,7 +142,6 @@ class MemoryQueueBackend(object):
                 start_at = convert_time_to_uuid(start_at)
 
         queue_names = ['%s:%s' % (application_name, x) for x in queue_names]
-        results = []
         now = Decimal(repr(time.time()))
         for queue_name in queue_names:
             msgs = message_store[queue_name]
@@ -115,21 +181,10 @@ class MemoryQueueBackend(object):
                 count += 1
                 if limit and count > limit:
                     break
-                obj = {
-                    'message_id': msg.id.hex,
-                    'timestamp': (Decimal(msg.id.time - 0x01b21dd213814000L) /
-                        DECIMAL_1E7),
-                    'body': msg.body,
-                    'metadata': {},
-                    'queue_name': queue_name[queue_name.find(':'):]
-                }
-                if include_metadata:
-                    obj['metadata'] = msg.metadata
-                results.append(obj)
-        return results
+                yield queue_name, msg
 
     def retrieve(self, consistency, application_name, queue_name, message_id,
-                 include_metadata=False):
+                 include_metadata=False, decompress=False):
         """Retrieve a single message"""
         if isinstance(message_id, basestring):
             # Convert to uuid for lookup
@@ -162,13 +217,21 @@ class MemoryQueueBackend(object):
             'metadata': {},
             'queue_name': queue_name[queue_name.find(':'):]
         }
-        if include_metadata:
-            obj['metadata'] = found.metadata
+        if include_metadata or decompress:
+            metadata = found.metadata.copy()
+            obj['body'] = decompress_body(found.body, metadata)
+            if include_metadata:
+                obj['metadata'] = metadata
         return obj
 
     def push(self, consistency, application_name, queue_name, message,
-             metadata=None, ttl=60 * 60 * 24 * 3, timestamp=None):
+             metadata=None, ttl=60 * 60 * 24 * 3, timestamp=None,
+             compress=False):
         """Push a message onto the queue"""
+        if compress:
+            metadata = dict(metadata or {})
+            message = compress_body(message, metadata,
+                                    self.compress_threshold)
         if not timestamp:
             now = uuid.uuid1()
         elif isinstance(timestamp, (float, Decimal)):
@@ -183,17 +246,31 @@ class MemoryQueueBackend(object):
         if msg in message_store[queue_name]:
             message_store[queue_name].remove(msg)
         message_store[queue_name].append(msg)
+        marker_store[queue_name] = uuid.uuid1().hex
         return msg.id.hex, timestamp
 
-    def push_batch(self, consistency, application_name, message_data):
+    def push_batch(self, consistency, application_name, message_data,
+                   compress=False, message_ids=None):
         """Push a batch of messages"""
         msgs = []
-        for queue_name, body, ttl, metadata in message_data:
+        for index, (queue_name, body, ttl, metadata) in \
+                enumerate(message_data):
             qn = '%s:%s' % (application_name, queue_name)
-            msg = Message(id=uuid.uuid1(), body=body, ttl=ttl)
+            if compress:
+                metadata = dict(metadata or {})
+                body = compress_body(body, metadata, self.compress_threshold)
+            if message_ids:
+                msg_id = uuid.UUID(hex=message_ids[index])
+            else:
+                msg_id = uuid.uuid1()
+            msg = Message(id=msg_id, body=body, ttl=ttl)
             if metadata:
                 msg.metadata = metadata
+            if message_ids and msg in message_store[qn]:
+                message_store[qn].remove(msg)
             message_store[qn].append(msg)
+            # Given ids may be older than the last write
+            marker_store[qn] = uuid.uuid1().hex if message_ids else msg.id.hex
             timestamp = (Decimal(msg.id.time - 0x01b21dd213814000L) /
                 DECIMAL_1E7)
             msgs.append((msg.id.hex, timestamp))
@@ -203,6 +280,8 @@ class MemoryQueueBackend(object):
         """Remove all contents of the queue"""
         queue_name = '%s:%s' % (application_name, queue_name)
         message_store[queue_name] = []
+        lease_store.pop(queue_name, None)
+        marker_store[queue_name] = uuid.uuid1().hex
         return True
 
     def delete(self, consistency, application_name, queue_name, *keys):
@@ -215,8 +294,45 @@ class MemoryQueueBackend(object):
                 del_items.append(index)
         for index in sorted(del_items)[::-1]:
             del queue[index]
+        leases = lease_store.get(queue_name, {})
+        for key in keys:
+            leases.pop(key, None)
+        marker_store[queue_name] = uuid.uuid1().hex
         return True
 
+    def claim(self, consistency, application_name, queue_names, limit, lease,
+              decompress=False):
+        """Lease up to ``limit`` unclaimed messages of the queues"""
+        claim_id = uuid.uuid4().hex
+        claimed = []
+        with lease_lock:
+            now = time.time()
+            expires = now + lease
+            for queue_name in queue_names:
+                leases = lease_store['%s:%s' % (application_name, queue_name)]
+                for msg_id, (_, until) in leases.items():
+                    if until <= now:
+                        del leases[msg_id]
+                for msg in self.retrieve_iter(consistency, application_name,
+                                              [queue_name],
+                                              decompress=decompress):
+                    if len(claimed) >= limit:
+                        return claim_id, claimed
+                    if msg['message_id'] in leases:
+                        continue
+                    leases[msg['message_id']] = (claim_id, expires)
+                    claimed.append(msg)
+        return claim_id, claimed
+
+    def write_markers(self, consistency, application_name, queue_names):
+        """Return the id of the last write to each queue"""
+        markers = {}
+        for queue_name in queue_names:
+            marker = marker_store.get('%s:%s' % (application_name, queue_name))
+            if marker:
+                markers[queue_name] = marker
+        return markers
+
     def count(self, consistency, application_name, queue_name):
         """Return a count of the items in this queue"""
         queue_name = '%s:%s' % (application_name, queue_name)
@@ -284,3 +400,50 @@ class MemoryMetadata(object):
                 continue
             results.append(queue.metadata)
         return results
+
+    def commit_offsets(self, offsets):
+        """Store the offsets of consumer groups"""
+        for key, partitions in offsets.items():
+            offset_store[key].update(partitions)
+        return True
+
+    def consumer_offsets(self, application_name, queue_name, group):
+        """Return the committed offsets of a consumer group"""
+        return dict(offset_store.get((application_name, queue_name, group),
+                                     {}))
+
+    def heartbeat(self, application_name, queue_name, group, member,
+                  timeout):
+        """Register a member of a consumer group for ``timeout`` seconds"""
+        key = (application_name, queue_name, group)
+        member_store[key][member] = time.time() + timeout
+        return True
+
+    def leave(self, application_name, queue_name, group, member):
+        """Remove a member of a consumer group"""
+        members = member_store.get((application_name, queue_name, group))
+        if members:
+            members.pop(member, None)
+        return True
+
+    def group_members(self, application_name, queue_name, group):
+        """Return the registered members of a consumer group"""
+        members = member_store.get((application_name, queue_name, group), {})
+        now = time.time()
+        return sorted(x for x, expires in members.items() if expires > now)
+
+    def group_assignment(self, application_name, queue_name, group):
+        """Return the stored partition assignment of a consumer group"""
+        stored = assignment_store.get((application_name, queue_name, group))
+        if not stored or stored[2] <= time.time():
+            return None, {}
+        generation, assignment, expires = stored
+        return generation, dict((x, list(y)) for x, y in assignment.items())
+
+    def set_group_assignment(self, application_name, queue_name, group,
+                             generation, assignment, ttl):
+        """Store the partition assignment of a consumer group"""
+        assignment_store[(application_name, queue_name, group)] = (
+            generation, dict((x, list(y)) for x, y in assignment.items()),
+            time.time() + ttl)
+        return True
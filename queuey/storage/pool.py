@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Latency aware host selection for the Cassandra connection pool"""
+import random
+import threading
+import time
+
+import pycassa
+
+
+class HostStats(object):
+    """Request statistics of a single host"""
+    def __init__(self, local=True):
+        self.local = local
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = 0
+
+
+class HostPolicy(object):
+    """Picks hosts based on their recent latency and error rate
+
+    Latency and error rate are tracked per host as exponentially weighted
+    moving averages. A host is unhealthy while its error rate is above the
+    ``error_threshold``, it gets retried once no error was seen for
+    ``retry_interval`` seconds.
+
+    Healthy hosts in ``local_hosts`` are always preferred, remote hosts are
+    only used if no local host is healthy. Among the candidates, two random
+    hosts are compared and the faster one is used, which routes most traffic
+    to the fastest hosts without piling everything onto a single one.
+
+    Pooled connections are kept while their host is :meth:`preferred`, that
+    is healthy, local if possible and at most ``slow_factor`` times slower
+    than the fastest measured candidate. Once every ``probe_interval``
+    seconds a connection is given up while candidates weren't measured yet,
+    so its replacement can try one of them.
+
+    """
+    def __init__(self, hosts, local_hosts=None, alpha=0.2,
+                 error_threshold=0.5, retry_interval=30, slow_factor=2.0,
+                 probe_interval=10):
+        local_hosts = set(local_hosts or hosts)
+        self.hosts = list(hosts)
+        self.alpha = alpha
+        self.error_threshold = error_threshold
+        self.retry_interval = retry_interval
+        self.slow_factor = slow_factor
+        self.probe_interval = probe_interval
+        self.last_probe = 0
+        self.stats = dict((host, HostStats(host in local_hosts))
+                          for host in hosts)
+        self._lock = threading.Lock()
+
+    def record(self, host, latency=None, error=False):
+        """Record the outcome of a request to ``host``"""
+        stats = self.stats.get(host)
+        if stats is None:
+            return
+        alpha = self.alpha
+        with self._lock:
+            stats.requests += 1
+            stats.error_rate = (alpha * (1.0 if error else 0.0) +
+                                (1 - alpha) * stats.error_rate)
+            if error:
+                stats.errors += 1
+                stats.last_error = time.time()
+            elif latency is not None:
+                if stats.latency is None:
+                    stats.latency = latency
+                else:
+                    stats.latency = (alpha * latency +
+                                     (1 - alpha) * stats.latency)
+
+    def healthy(self, host):
+        stats = self.stats.get(host)
+        if stats is None:
+            return False
+        return (stats.error_rate <= self.error_threshold or
+                time.time() - stats.last_error > self.retry_interval)
+
+    def _candidates(self, exclude):
+        hosts = [x for x in self.hosts if x not in exclude] or self.hosts
+        healthy = [x for x in hosts if self.healthy(x)]
+        local = [x for x in healthy if self.stats[x].local]
+        if local:
+            return local
+        elif healthy:
+            return healthy
+        # Nothing is healthy, use the ones failing the least
+        lowest = min(self.stats[x].error_rate for x in hosts)
+        return [x for x in hosts if self.stats[x].error_rate == lowest]
+
+    def preferred(self, host):
+        """Whether connections to ``host`` should be kept"""
+        candidates = self._candidates(())
+        if host not in candidates:
+            return False
+        latency = self.stats[host].latency
+        if latency is None:
+            return True
+        latencies = [self.stats[x].latency for x in candidates]
+        if None in latencies:
+            # Hosts without a measurement don't count against the others,
+            # but get a connection now and then to be measured
+            now = time.time()
+            with self._lock:
+                if now - self.last_probe >= self.probe_interval:
+                    self.last_probe = now
+                    return False
+            latencies = [x for x in latencies if x is not None]
+        return latency <= self.slow_factor * min(latencies)
+
+    def choose(self, exclude=()):
+        """Return the host that should serve the next request"""
+        candidates = self._candidates(exclude)
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        # Hosts without a measurement yet are tried first
+        if (self.stats[second].latency or 0) < \
+           (self.stats[first].latency or 0):
+            return second
+        return first
+
+    def host_stats(self):
+        """Return a dict of statistics per host"""
+        result = {}
+        for host, stats in self.stats.items():
+            result[host] = {
+                'local': stats.local,
+                'healthy': self.healthy(host),
+                'latency': stats.latency,
+                'error_rate': stats.error_rate,
+                'requests': stats.requests,
+                'errors': stats.errors,
+            }
+        return result
+
+
+class PolicyConnectionPool(pycassa.ConnectionPool):
+    """A connection pool asking a :class:`HostPolicy` for hosts
+
+    New connections are opened to the host picked by the policy, and
+    connections to a host that is no longer preferred are replaced on
+    checkout.
+    Every operation run through :meth:`execute` reports its latency to the
+    policy, failures are reported by pycassa's failure notification.
+
+    """
+    def __init__(self, keyspace, server_list, policy=None, **kwargs):
+        self.policy = policy or HostPolicy(server_list)
+        pycassa.ConnectionPool.__init__(self, keyspace,
+                                        server_list=server_list, **kwargs)
+
+    def _get_next_server(self):
+        return self.policy.choose()
+
+    def _notify_on_failure(self, error, server, connection=None):
+        self.policy.record(server, error=True)
+        pycassa.ConnectionPool._notify_on_failure(self, error, server,
+                                                  connection)
+
+    def get(self):
+        conn = pycassa.ConnectionPool.get(self)
+        if not self.policy.preferred(conn.server):
+            try:
+                replacement = self._create_connection()
+            except pycassa.AllServersUnavailable:
+                return conn
+            if replacement.server != conn.server:
+                conn.close()
+                conn._replace(replacement)
+            else:
+                replacement.close()
+        return conn
+
+    def execute(self, f, *args, **kwargs):
+        conn = None
+        try:
+            conn = self.get()
+            start = time.time()
+            result = getattr(conn, f)(*args, **kwargs)
+            self.policy.record(conn.server, time.time() - start)
+            return result
+        finally:
+            if conn:
+                self.put(conn)
@@ -1,9 +1,230 @@
 """Storage utility functions"""
 from cdecimal import Decimal
+import base64
+import heapq
+import itertools
 import random
+import threading
+import time
 import uuid
+import zlib
+import Queue
 
 DECIMAL_1E7 = Decimal('1e7')
+# Message metadata flags describing how the stored body is encoded
+ENCODING_FLAGS = ('ContentEncoding', 'BodyEncoding')
+
+class WorkerPool(object):
+    """A fixed amount of daemon threads running submitted calls
+
+    Threads are started on first use.
+
+    """
+    def __init__(self, size=10):
+        self.size = size
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self._tasks.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                # Calls are expected to report their own errors
+                pass
+
+    def submit(self, func, *args, **kwargs):
+        """Run ``func`` on one of the worker threads"""
+        if len(self._threads) < self.size:
+            self._start()
+        self._tasks.put((func, args, kwargs))
+
+    def map(self, func, items):
+        """Call ``func`` with every item on the worker threads and return
+        the results in order, once all calls are done
+
+        The first exception raised by a call is raised again.
+
+        """
+        results = Queue.Queue()
+
+        def call(index, item):
+            try:
+                results.put((index, func(item), None))
+            except Exception, exc:
+                results.put((index, None, exc))
+        for index, item in enumerate(items):
+            self.submit(call, index, item)
+        ordered = [None] * len(items)
+        error = None
+        for _ in items:
+            index, result, exc = results.get()
+            ordered[index] = result
+            if exc is not None and error is None:
+                error = exc
+        if error is not None:
+            raise error
+        return ordered
+
+
+class DeadlineTimer(object):
+    """Calls functions at their deadline on a single daemon thread
+
+    The thread is started on first use. Calls are expected to return
+    quickly, like handing work on to a :class:`WorkerPool`.
+
+    """
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def schedule(self, deadline, func):
+        """Call ``func`` once ``time.time()`` reaches ``deadline``"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+            heapq.heappush(self._heap, (deadline, next(self._order), func))
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    wait = None
+                    if self._heap:
+                        wait = self._heap[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                    self._cond.wait(wait)
+                func = heapq.heappop(self._heap)[2]
+            try:
+                func()
+            except Exception:
+                # Calls are expected to report their own errors
+                pass
+
+
+class _PendingWrite(object):
+    """Writes collected for one batch"""
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+
+class WriteCoalescer(object):
+    """Combines concurrent writes into batches
+
+    The first writer of a group waits up to ``window`` seconds for others to
+    join, or until ``max_items`` items were collected, then calls ``send``
+    with the group and all items on behalf of everyone. Every writer returns
+    once its batch was sent, or raises the error of the batch.
+
+    """
+    def __init__(self, send, window=0.002, max_items=100):
+        self.send = send
+        self.window = window
+        self.max_items = max_items
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def write(self, group, items):
+        """Write ``items`` in a batch with the concurrent writes of the same
+        ``group``"""
+        with self._lock:
+            pending = self._pending.get(group)
+            leader = pending is None
+            if leader:
+                pending = self._pending[group] = _PendingWrite()
+            pending.items.extend(items)
+            if len(pending.items) >= self.max_items:
+                # Later writes start a new batch
+                del self._pending[group]
+                pending.full.set()
+        if leader:
+            pending.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(group) is pending:
+                    del self._pending[group]
+            try:
+                self.send(group, pending.items)
+            except Exception, exc:
+                pending.error = exc
+            pending.done.set()
+        else:
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+
+def compress_body(body, metadata, threshold):
+    """Compress a message body if it's at least ``threshold`` bytes
+
+    Compressed bodies are base64 encoded so they can still be stored as
+    text, and flagged with a ``ContentEncoding`` entry in the message
+    metadata dict. Bodies that don't shrink are left alone.
+
+    :returns: The body to store
+
+    """
+    raw = body.encode('utf-8') if isinstance(body, unicode) else body
+    if len(raw) < threshold:
+        return body
+    compressed = base64.b64encode(zlib.compress(raw))
+    if len(compressed) >= len(raw):
+        return body
+    metadata['ContentEncoding'] = 'zlib'
+    return compressed
+
+
+def decompress_body(body, metadata):
+    """Decompress a body stored by :func:`compress_body`, and decode a
+    binary body stored by :func:`encode_binary`
+
+    The ``ContentEncoding`` and ``BodyEncoding`` flags are removed from the
+    metadata dict.
+
+    """
+    if metadata.get('ContentEncoding') == 'zlib':
+        del metadata['ContentEncoding']
+        body = zlib.decompress(base64.b64decode(body)).decode('utf-8')
+    if metadata.get('BodyEncoding') == 'base64':
+        del metadata['BodyEncoding']
+        body = base64.b64decode(body)
+    return body
+
+
+def encode_binary(body, metadata):
+    """Return a text body for ``body``
+
+    Byte strings that aren't valid UTF-8 are base64 encoded and flagged
+    with a ``BodyEncoding`` entry in the message metadata dict, reads
+    return them as byte strings again.
+
+    """
+    if isinstance(body, unicode):
+        return body
+    try:
+        return body.decode('utf-8')
+    except UnicodeDecodeError:
+        metadata['BodyEncoding'] = 'base64'
+        return unicode(base64.b64encode(body))
+
 
 # This function copied from pycassa, under MIT license
 # Copyright (c) 2009 Jonathan Hseu
@@ -3,6 +3,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 import os
+import socket
+import threading
 import time
 import xmlrpclib
 
@@ -45,3 +47,142 @@ def setup(timeout=10):
     """Shared one-time test setup, called from tests/__init__.py"""
     setup_supervisor()
     ensure_process('cassandra', timeout)
+
+
+class FakeCassandraHandler(object):
+    """Answers just enough of the Cassandra Thrift API for the Queuey
+    column families to be used, without storing anything
+
+    Every call sleeps for ``delay`` seconds first, and raises a
+    TimedOutException while ``fail`` is set.
+
+    """
+    def __init__(self, delay=0):
+        from pycassa.cassandra import ttypes
+        self.ttypes = ttypes
+        self.delay = delay
+        self.fail = False
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail:
+            raise self.ttypes.TimedOutException()
+
+    def login(self, auth_request):
+        pass
+
+    def set_keyspace(self, keyspace):
+        pass
+
+    def describe_version(self):
+        return '19.32.0'
+
+    def describe_keyspace(self, keyspace):
+        ttypes = self.ttypes
+        cf_defs = [
+            ttypes.CfDef(keyspace, 'Messages', comparator_type='TimeUUIDType',
+                         default_validation_class='UTF8Type',
+                         key_validation_class='UTF8Type', column_metadata=[]),
+            ttypes.CfDef(keyspace, 'MessageMetadata',
+                         comparator_type='UTF8Type',
+                         default_validation_class='UTF8Type',
+                         key_validation_class='TimeUUIDType',
+                         column_metadata=[]),
+            ttypes.CfDef(keyspace, 'MessageLeases',
+                         comparator_type='TimeUUIDType',
+                         default_validation_class='UTF8Type',
+                         key_validation_class='UTF8Type', column_metadata=[]),
+            ttypes.CfDef(keyspace, 'WriteMarkers', comparator_type='UTF8Type',
+                         default_validation_class='UTF8Type',
+                         key_validation_class='UTF8Type', column_metadata=[]),
+        ]
+        return ttypes.KsDef(keyspace, 'SimpleStrategy', {}, cf_defs=cf_defs)
+
+    def get(self, key, column_path, consistency_level):
+        self._call()
+        raise self.ttypes.NotFoundException()
+
+    def get_slice(self, key, column_parent, predicate, consistency_level):
+        self._call()
+        return []
+
+    def multiget_slice(self, keys, column_parent, predicate,
+                       consistency_level):
+        self._call()
+        return dict((key, []) for key in keys)
+
+    def get_count(self, key, column_parent, predicate, consistency_level):
+        self._call()
+        return 0
+
+    def batch_mutate(self, mutation_map, consistency_level):
+        self._call()
+
+
+class FakeCassandraServer(object):
+    """An in-process Thrift server using a :class:`FakeCassandraHandler`
+
+    Listens on a random local port, ``host`` holds the ``host:port`` to use
+    in a server list.
+
+    """
+    def __init__(self, delay=0):
+        from pycassa.cassandra import Cassandra
+        self.handler = FakeCassandraHandler(delay)
+        self.processor = Cassandra.Processor(self.handler)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(50)
+        self.sock.settimeout(0.1)
+        self.host = '127.0.0.1:%s' % self.sock.getsockname()[1]
+        self.running = False
+        self.clients = []
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        for client in self.clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _serve(self):
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            client.settimeout(None)
+            self.clients.append(client)
+            thread = threading.Thread(target=self._handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+        self.sock.close()
+
+    def _handle(self, client):
+        from thrift.protocol import TBinaryProtocol
+        from thrift.transport import TSocket
+        from thrift.transport import TTransport
+        handle = TSocket.TSocket()
+        handle.setHandle(client)
+        transport = TTransport.TFramedTransport(handle)
+        protocol = TBinaryProtocol.TBinaryProtocol(transport)
+        try:
+            while self.running:
+                self.processor.process(protocol, protocol)
+        except (TTransport.TTransportException, socket.error, EOFError):
+            pass
+        finally:
+            transport.close()
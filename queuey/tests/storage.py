@@ -1,6 +1,7 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
 import unittest
 import uuid
 
@@ -49,6 +50,21 @@ class StorageTestMessageBase(unittest.TestCase):
         eq_(batch[0]['body'], 'first message')
         eq_(batch[1]['metadata'], {'ContentType': 'application/json'})
 
+    def test_push_batch_message_ids(self):
+        backend = self._makeOne()
+        queue_name = uuid.uuid4().hex
+        msg_id = uuid.uuid1().hex
+        for body in ['first push', 'second push']:
+            results = backend.push_batch('weak', 'myapp', [
+                (queue_name, body, 3600, {}),
+            ], message_ids=[msg_id])
+            eq_(msg_id, results[0][0])
+        # Pushing again with the same id replaces the message
+        batch = backend.retrieve_batch('weak', 'myapp', [queue_name])
+        eq_(1, len(batch))
+        eq_(msg_id, batch[0]['message_id'])
+        eq_('second push', batch[0]['body'])
+
     def test_must_use_list(self):
         @raises(Exception)
         def testit():
@@ -57,6 +73,59 @@ class StorageTestMessageBase(unittest.TestCase):
             backend.retrieve_batch('weak', 'myapp', queue_name)
         testit()
 
+    def test_compressed_messages(self):
+        backend = self._makeOne()
+        payload = 'a rather boring payload' * 100
+        queue_name = uuid.uuid4().hex
+        msg_id = backend.push('weak', 'myapp', queue_name, payload,
+                              compress=True)[0]
+        backend.push_batch('weak', 'myapp', [
+            (queue_name, payload, 3600, {'ContentType': 'application/json'}),
+            (queue_name, 'too small', 3600, {}),
+        ], compress=True)
+
+        existing = backend.retrieve_batch('weak', 'myapp', [queue_name],
+                                          decompress=True)
+        eq_([payload, payload, 'too small'], [x['body'] for x in existing])
+
+        # Stored compressed
+        existing = backend.retrieve_batch('weak', 'myapp', [queue_name])
+        assert len(existing[0]['body']) < len(payload)
+
+        # Metadata hides the compression flag
+        existing = backend.retrieve_batch('weak', 'myapp', [queue_name],
+                                          include_metadata=True)
+        eq_(payload, existing[1]['body'])
+        eq_({'ContentType': 'application/json'}, existing[1]['metadata'])
+
+        one = backend.retrieve('weak', 'myapp', queue_name, msg_id,
+                               decompress=True)
+        eq_(payload, one['body'])
+
+        # Updating with a body too small to compress clears the flag
+        backend.push('weak', 'myapp', queue_name, 'small', timestamp=msg_id,
+                     compress=True)
+        one = backend.retrieve('weak', 'myapp', queue_name, msg_id,
+                               decompress=True)
+        eq_('small', one['body'])
+
+    def test_binary_messages(self):
+        from queuey.storage.util import encode_binary
+        backend = self._makeOne()
+        payload = '\xff\x00binary' * 100
+        queue_name = uuid.uuid4().hex
+        metadata = {}
+        body = encode_binary(payload, metadata)
+        eq_({'BodyEncoding': 'base64'}, metadata)
+        backend.push_batch('weak', 'myapp', [
+            (queue_name, body, 3600, metadata),
+            (queue_name, encode_binary('text', {}), 3600, {}),
+        ], compress=True)
+        existing = backend.retrieve_batch('weak', 'myapp', [queue_name],
+                                          include_metadata=True)
+        eq_([payload, 'text'], [x['body'] for x in existing])
+        eq_({}, existing[0]['metadata'])
+
     def test_no_message(self):
         backend = self._makeOne()
         queue_name = uuid.uuid4().hex
@@ -93,6 +162,104 @@ class StorageTestMessageBase(unittest.TestCase):
         eq_(existing[0]['body'], another)
         eq_(len(existing), 2)
 
+    def test_retrieve_iter(self):
+        backend = self._makeOne()
+        queue_name = uuid.uuid4().hex
+        queue_name2 = uuid.uuid4().hex
+        backend.push_batch('weak', 'myapp', [
+            (queue_name, 'message %s' % x, 3600, {}) for x in range(7)] + [
+            (queue_name2, 'another message', 3600, {})])
+        existing = list(backend.retrieve_iter(
+            'weak', 'myapp', [queue_name, queue_name2], chunk_size=3))
+        eq_(['message %s' % x for x in range(7)],
+            [x['body'] for x in existing[:7]])
+        eq_('another message', existing[7]['body'])
+        eq_(existing, backend.retrieve_batch('weak', 'myapp', [queue_name]) +
+            backend.retrieve_batch('weak', 'myapp', [queue_name2]))
+
+        # Limits apply per queue across chunks
+        existing = list(backend.retrieve_iter(
+            'weak', 'myapp', [queue_name], limit=5, chunk_size=2,
+            order='descending'))
+        eq_(['message %s' % x for x in range(6, 1, -1)],
+            [x['body'] for x in existing])
+
+        existing = list(backend.retrieve_iter(
+            'weak', 'myapp', [queue_name], start_at=existing[1]['message_id'],
+            chunk_size=2))
+        eq_(['message 5', 'message 6'], [x['body'] for x in existing])
+
+    def test_retrieve_rows(self):
+        backend = self._makeOne()
+        queue_name = uuid.uuid4().hex
+        queue_name2 = uuid.uuid4().hex
+        payload = 'a rather boring payload' * 100
+        backend.push_batch('weak', 'myapp', [
+            (queue_name, 'first', 3600, {}),
+            (queue_name, payload, 3600, {}),
+            (queue_name2, 'another', 3600, {})], compress=True)
+        queue_names = [queue_name, queue_name2]
+        messages = backend.retrieve_batch('weak', 'myapp', queue_names,
+                                          decompress=True)
+        rows = backend.retrieve_rows('weak', 'myapp', queue_names,
+                                     decompress=True)
+        eq_([(x['message_id'], x['body']) for x in messages],
+            [(x[0], x[2]) for x in rows])
+        eq_([queue_name, queue_name, queue_name2], [x[3] for x in rows])
+        eq_([uuid.UUID(hex=x[0]).time for x in rows], [x[1] for x in rows])
+
+        rows = backend.retrieve_rows('weak', 'myapp', [queue_name], limit=1,
+                                     order='descending')
+        eq_(1, len(rows))
+        assert len(rows[0][2]) < len(payload)
+
+    def test_write_markers(self):
+        backend = self._makeOne()
+        queue_name = uuid.uuid4().hex
+        queue_name2 = uuid.uuid4().hex
+        eq_({}, backend.write_markers('weak', 'myapp', [queue_name]))
+
+        results = backend.push_batch('weak', 'myapp', [
+            (queue_name, 'first', 3600, {}), (queue_name, 'second', 3600, {})])
+        markers = backend.write_markers('weak', 'myapp',
+                                        [queue_name, queue_name2])
+        eq_({queue_name: results[1][0]}, markers)
+
+        # Updates, deletes and truncates count as writes
+        backend.push('weak', 'myapp', queue_name, 'updated',
+                     timestamp=results[1][0])
+        updated = backend.write_markers('weak', 'myapp', [queue_name])
+        assert updated[queue_name] != markers[queue_name]
+        backend.delete('weak', 'myapp', queue_name, results[0][0])
+        deleted = backend.write_markers('weak', 'myapp', [queue_name])
+        assert deleted[queue_name] != updated[queue_name]
+        backend.truncate('weak', 'myapp', queue_name)
+        truncated = backend.write_markers('weak', 'myapp', [queue_name])
+        assert truncated[queue_name] != deleted[queue_name]
+
+    def test_claim(self):
+        backend = self._makeOne()
+        queue_name = uuid.uuid4().hex
+        queue_name2 = uuid.uuid4().hex
+        backend.push_batch('weak', 'myapp', [
+            (queue_name, 'message %s' % x, 3600, {}) for x in range(3)] + [
+            (queue_name2, 'another message', 3600, {})])
+        queues = [queue_name, queue_name2]
+
+        claim_id, first = backend.claim('weak', 'myapp', queues, 2, 1)
+        eq_(['message 0', 'message 1'], [x['body'] for x in first])
+        claim_id2, second = backend.claim('weak', 'myapp', queues, 5, 1)
+        assert claim_id != claim_id2
+        eq_(['message 2', 'another message'], [x['body'] for x in second])
+        eq_([], backend.claim('weak', 'myapp', queues, 5, 1)[1])
+
+        # Deleting acknowledges, leases run out
+        backend.delete('weak', 'myapp', queue_name, first[0]['message_id'])
+        time.sleep(2)
+        claimed = backend.claim('weak', 'myapp', queues, 5, 60)[1]
+        eq_(['message 1', 'message 2', 'another message'],
+            [x['body'] for x in claimed])
+
     def test_message_removal(self):
         backend = self._makeOne()
         payload = 'a rather boring payload'
@@ -245,6 +412,49 @@ class StorageTestMetadataBase(unittest.TestCase):
 
         eq_([{}], backend.queue_information('myapp', ['asdfasdf']))
 
+    def test_consumer_offsets(self):
+        backend = self._makeOne()
+        queue_name = uuid.uuid4().hex
+        eq_({}, backend.consumer_offsets('myapp', queue_name, 'group'))
+        msg_id, msg_id2 = uuid.uuid1().hex, uuid.uuid1().hex
+        backend.commit_offsets({
+            ('myapp', queue_name, 'group'): {1: msg_id, 2: msg_id},
+            ('myapp', queue_name, 'other'): {1: msg_id2}})
+        backend.commit_offsets({('myapp', queue_name, 'group'): {2: msg_id2}})
+        eq_({1: msg_id, 2: msg_id2},
+            backend.consumer_offsets('myapp', queue_name, 'group'))
+        eq_({1: msg_id2},
+            backend.consumer_offsets('myapp', queue_name, 'other'))
+
+    def test_group_members(self):
+        backend = self._makeOne()
+        queue_name = uuid.uuid4().hex
+        eq_([], backend.group_members('myapp', queue_name, 'group'))
+        backend.heartbeat('myapp', queue_name, 'group', 'b', 30)
+        backend.heartbeat('myapp', queue_name, 'group', 'a', 1)
+        backend.heartbeat('myapp', queue_name, 'other', 'c', 30)
+        eq_(['a', 'b'], backend.group_members('myapp', queue_name, 'group'))
+        backend.leave('myapp', queue_name, 'group', 'b')
+        eq_(['a'], backend.group_members('myapp', queue_name, 'group'))
+        time.sleep(2)
+        eq_([], backend.group_members('myapp', queue_name, 'group'))
+        eq_(['c'], backend.group_members('myapp', queue_name, 'other'))
+
+    def test_group_assignment(self):
+        backend = self._makeOne()
+        queue_name = uuid.uuid4().hex
+        eq_((None, {}),
+            backend.group_assignment('myapp', queue_name, 'group'))
+        backend.heartbeat('myapp', queue_name, 'group', 'a', 30)
+        backend.set_group_assignment('myapp', queue_name, 'group', 'abc1',
+                                     {'a': [1, 2], 'b': []}, 1)
+        eq_(('abc1', {'a': [1, 2], 'b': []}),
+            backend.group_assignment('myapp', queue_name, 'group'))
+        eq_(['a'], backend.group_members('myapp', queue_name, 'group'))
+        time.sleep(2)
+        eq_((None, {}),
+            backend.group_assignment('myapp', queue_name, 'group'))
+
     def test_must_use_list(self):
         @raises(Exception)
         def testit():
@@ -1,8 +1,10 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
 import uuid
 import os
+import time
 
 from nose.tools import eq_
 from nose.tools import raises
@@ -35,6 +37,69 @@ class TestCassandraStore(StorageTestMessageBase):
         backend = self._makeOne(**creds)
         eq_(backend.pool.credentials, creds)
 
+    def test_coalesced_push_batch(self):
+        import threading
+        backend = self._makeOne(coalesce_window=20)
+        queue_name = uuid.uuid4().hex
+        sent = []
+        send = backend.coalescer.send
+        backend.coalescer.send = lambda cl, items: sent.append(
+            len(items)) or send(cl, items)
+        results = {}
+
+        def push(number):
+            results[number] = backend.push_batch(
+                'weak', 'myapp', [(queue_name, 'message %s' % number, 60, {})])
+        threads = [threading.Thread(target=push, args=(x,)) for x in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Every push inserts its message and a write marker
+        eq_(10, sum(sent))
+        assert len(sent) < 5
+        existing = backend.retrieve_batch('weak', 'myapp', [queue_name])
+        eq_(sorted(x[0][0] for x in results.values()),
+            sorted(x['message_id'] for x in existing))
+
+    def test_cached_schema_verification(self):
+        import tempfile
+        import shutil
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch('queuey.storage.cassandra.Schema') as schema:
+                self._makeOne(schema_cache_dir=cache_dir)
+                eq_(1, schema.call_count)
+                self._makeOne(schema_cache_dir=cache_dir)
+                eq_(1, schema.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_schema_cache_version(self):
+        import tempfile
+        import shutil
+        from queuey.storage import cassandra
+        cache = cassandra.SchemaCache(tempfile.mkdtemp())
+        try:
+            cache.record('message', 'localhost:9160', 'MessageStore')
+            eq_(True, cache.verified('message', 'localhost:9160',
+                                     'MessageStore'))
+            with mock.patch.object(cassandra, 'SCHEMA_VERSION', -1):
+                eq_(False, cache.verified('message', 'localhost:9160',
+                                          'MessageStore'))
+        finally:
+            shutil.rmtree(cache.directory)
+
+    def test_host_stats(self):
+        backend = self._makeOne()
+        eq_({}, backend.host_stats())
+        backend = self._makeOne(latency_aware=True)
+        queue_name = uuid.uuid4().hex
+        backend.retrieve_batch('weak', 'myapp', [queue_name])
+        stats = backend.host_stats().values()[0]
+        eq_(True, stats['healthy'])
+        assert stats['requests'] > 0
+
     def test_cl(self):
         backend = self._makeOne()
         backend.cl = None
@@ -88,6 +153,235 @@ class TestCassandraStore(StorageTestMessageBase):
             testit()
 
 
+class FakeColumnFamily(object):
+    def __init__(self, value, delay=0, error=None):
+        self.value, self.delay, self.error = value, delay, error
+
+    def get(self, key):
+        import threading
+        self.called = time.time(), threading.current_thread()
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.value
+
+
+class TestHedgedReader(unittest.TestCase):
+    def _makeOne(self, primary, backup):
+        from queuey.storage.cassandra import HedgedReader
+        reader = HedgedReader(['a:9160', 'b:9160'], 'MessageStore',
+                              min_delay=0.02)
+        fams = {('a:9160', False): {'message_fam': primary},
+                ('b:9160', True): {'message_fam': backup}}
+        reader._column_families = lambda host, hedge=False: fams[
+            (host, hedge)]
+        return reader
+
+    def _read(self, reader):
+        with mock.patch('random.sample', lambda hosts, n: hosts[:n]):
+            return reader.read('message_fam', 'get', 'key')
+
+    def test_fast_primary(self):
+        reader = self._makeOne(FakeColumnFamily('a'), FakeColumnFamily('b'))
+        eq_('a', self._read(reader))
+        eq_({'reads': 1, 'fired': 0, 'won': 0}, reader.stats)
+        time.sleep(0.05)
+        eq_(0, reader.stats['fired'])
+
+    def test_hedge_wins(self):
+        backup = FakeColumnFamily('b')
+        reader = self._makeOne(FakeColumnFamily('a', delay=0.5), backup)
+        start = time.time()
+        eq_('b', self._read(reader))
+        # Answered without waiting for the slow primary
+        assert time.time() - start < 0.3
+        eq_({'reads': 1, 'fired': 1, 'won': 1}, reader.stats)
+        # Hedged once the delay passed since the primary read was sent
+        assert backup.called[0] - start < 0.2
+
+    def test_slow_hedge_loses(self):
+        reader = self._makeOne(FakeColumnFamily('a', delay=0.1),
+                               FakeColumnFamily('b', delay=0.5))
+        start = time.time()
+        eq_('a', self._read(reader))
+        assert time.time() - start < 0.3
+        eq_({'reads': 1, 'fired': 1, 'won': 0}, reader.stats)
+
+    def test_failing_primary(self):
+        error = pycassa.TimedOutException()
+        reader = self._makeOne(FakeColumnFamily('a', error=error),
+                               FakeColumnFamily('b'))
+        eq_('b', self._read(reader))
+        # The hedge only answered after the primary failed
+        eq_({'reads': 1, 'fired': 1, 'won': 0}, reader.stats)
+
+    def test_failing_hedge(self):
+        error = pycassa.TimedOutException()
+        reader = self._makeOne(FakeColumnFamily('a', delay=0.2),
+                               FakeColumnFamily('b', error=error))
+        eq_('a', self._read(reader))
+        eq_({'reads': 1, 'fired': 1, 'won': 0}, reader.stats)
+
+    def test_not_found_is_an_answer(self):
+        reader = self._makeOne(
+            FakeColumnFamily('a', error=pycassa.NotFoundException()),
+            FakeColumnFamily('b'))
+
+        @raises(pycassa.NotFoundException)
+        def testit():
+            self._read(reader)
+        testit()
+        eq_(0, reader.stats['fired'])
+
+
+class TestWriteCoalescer(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from queuey.storage.util import WriteCoalescer
+        self.sent = []
+        return WriteCoalescer(self._send, **kwargs)
+
+    def _send(self, group, items):
+        if 'fail' in items:
+            raise pycassa.TimedOutException()
+        self.sent.append((group, items))
+
+    def _write(self, coalescer, writes):
+        import threading
+        errors = []
+
+        def write(group, items):
+            try:
+                coalescer.write(group, items)
+            except Exception, exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=write, args=x) for x in writes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_single_write(self):
+        coalescer = self._makeOne(window=0.001)
+        coalescer.write('one', [1, 2])
+        eq_([('one', [1, 2])], self.sent)
+
+    def test_concurrent_writes(self):
+        coalescer = self._makeOne(window=0.1)
+        eq_([], self._write(coalescer, [('one', [1]), ('one', [2, 3]),
+                                        ('two', [4]), ('one', [5])]))
+        eq_([('one', [1, 2, 3, 5]), ('two', [4])],
+            sorted((x, sorted(y)) for x, y in self.sent))
+
+    def test_full_batch(self):
+        coalescer = self._makeOne(window=5, max_items=2)
+        start = time.time()
+        coalescer.write('one', [1, 2])
+        assert time.time() - start < 1
+        eq_([('one', [1, 2])], self.sent)
+
+    def test_failed_batch(self):
+        coalescer = self._makeOne(window=0.1)
+        errors = self._write(coalescer, [('one', [1]), ('one', ['fail'])])
+        eq_(2, len(errors))
+        eq_([], self.sent)
+
+
+class TestHostPolicy(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from queuey.storage.pool import HostPolicy
+        return HostPolicy(['a:9160', 'b:9160', 'c:9160'], **kwargs)
+
+    def test_prefers_fast_hosts(self):
+        policy = self._makeOne()
+        policy.record('a:9160', 0.001)
+        policy.record('b:9160', 0.1)
+        policy.record('c:9160', 0.1)
+        chosen = [policy.choose() for x in range(100)]
+        assert chosen.count('a:9160') > 40
+
+    def test_unhealthy_hosts(self):
+        policy = self._makeOne()
+        for x in range(5):
+            policy.record('a:9160', error=True)
+        eq_(False, policy.healthy('a:9160'))
+        assert 'a:9160' not in [policy.choose() for x in range(50)]
+        eq_(5, policy.host_stats()['a:9160']['errors'])
+
+    def test_unhealthy_hosts_are_retried(self):
+        policy = self._makeOne(retry_interval=0)
+        policy.record('a:9160', error=True)
+        policy.stats['a:9160'].last_error -= 1
+        eq_(True, policy.healthy('a:9160'))
+
+    def test_prefers_local_hosts(self):
+        policy = self._makeOne(local_hosts=['c:9160'])
+        policy.record('a:9160', 0.001)
+        policy.record('c:9160', 0.1)
+        eq_(set(['c:9160']), set(policy.choose() for x in range(20)))
+        policy.record('c:9160', error=True)
+        policy.record('c:9160', error=True)
+        policy.record('c:9160', error=True)
+        policy.record('c:9160', error=True)
+        assert 'c:9160' not in [policy.choose() for x in range(20)]
+
+    def test_preferred(self):
+        policy = self._makeOne()
+        policy.record('a:9160', 0.001)
+        # Hosts without a measurement don't count against measured ones,
+        # apart from a probe now and then
+        eq_(False, policy.preferred('a:9160'))
+        eq_(True, policy.preferred('a:9160'))
+        eq_(True, policy.preferred('b:9160'))
+        policy.record('c:9160', 0.1)
+        eq_(True, policy.preferred('a:9160'))
+        eq_(False, policy.preferred('c:9160'))
+        policy.record('b:9160', 0.0015)
+        eq_(True, policy.preferred('b:9160'))
+
+    def test_exclude(self):
+        policy = self._makeOne()
+        chosen = set(policy.choose(exclude=('a:9160',)) for x in range(20))
+        assert 'a:9160' not in chosen
+
+
+class TestPolicyConnectionPool(unittest.TestCase):
+    def setUp(self):
+        from queuey.testing import FakeCassandraServer
+        self.fast = FakeCassandraServer().start()
+        self.slow = FakeCassandraServer(delay=0.02).start()
+
+    def tearDown(self):
+        self.fast.stop()
+        self.slow.stop()
+
+    def _makeOne(self):
+        from queuey.storage.pool import PolicyConnectionPool
+        return PolicyConnectionPool(
+            'MessageStore', [self.fast.host, self.slow.host],
+            pool_size=1, max_overflow=0, prefill=False)
+
+    def test_routes_to_fast_host(self):
+        pool = self._makeOne()
+        fam = pycassa.ColumnFamily(pool, 'Messages')
+        for x in range(50):
+            fam.get_count('key')
+        stats = pool.policy.host_stats()
+        assert stats[self.fast.host]['latency'] < \
+            stats[self.slow.host]['latency']
+        assert self.fast.handler.calls > self.slow.handler.calls
+
+    def test_failing_host(self):
+        pool = self._makeOne()
+        fam = pycassa.ColumnFamily(pool, 'Messages')
+        self.fast.handler.fail = True
+        for x in range(20):
+            fam.get_count('key')
+        stats = pool.policy.host_stats()
+        eq_(False, stats[self.fast.host]['healthy'])
+        assert self.slow.handler.calls > 10
+
+
 class TestCassandraMetadata(StorageTestMetadataBase):
     def _makeOne(self, **kwargs):
         from queuey.storage.cassandra import CassandraMetadata
@@ -99,6 +393,17 @@ class TestCassandraMetadata(StorageTestMetadataBase):
         backend = self._makeOne(**creds)
         eq_(backend.pool.credentials, creds)
 
+    def test_backfill_queue_index(self):
+        backend = self._makeOne()
+        app_name = uuid.uuid4().hex
+        backend.register_queue(app_name, 'fredrick')
+        backend.register_queue(app_name, 'alpha')
+        backend.app_queue_fam.remove(app_name)
+        eq_([], backend.queue_list(app_name))
+
+        assert backend.backfill_queue_index() >= 2
+        eq_(['alpha', 'fredrick'], backend.queue_list(app_name))
+
 
 del StorageTestMessageBase
 del StorageTestMetadataBase
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+import zlib
+
+from nose.tools import eq_
+from webob import Request
+from webob import Response
+
+
+def gzip_data(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestGzipEncoding(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from queuey.encoding import GzipEncoding
+        return GzipEncoding(**kwargs)
+
+    def _makeRequest(self, body, encoding=None):
+        request = Request.blank('/', POST=body)
+        if encoding:
+            request.headers['Content-Encoding'] = encoding
+        return request
+
+    def test_plain_body(self):
+        encoding = self._makeOne()
+        eq_('plain', encoding.decode_body(self._makeRequest('plain')))
+
+    def test_gzip_body(self):
+        encoding = self._makeOne()
+        body = 'x' * 200000
+        request = self._makeRequest(gzip_data(body), 'gzip')
+        eq_(body, encoding.decode_body(request))
+
+    def test_body_at_limit(self):
+        encoding = self._makeOne(max_request_size=1000)
+        request = self._makeRequest(gzip_data('x' * 1000), 'gzip')
+        eq_(1000, len(encoding.decode_body(request)))
+
+    def test_body_too_large(self):
+        from queuey.encoding import RequestTooLarge
+        encoding = self._makeOne(max_request_size=1000)
+        request = self._makeRequest(gzip_data('x' * 1001), 'gzip')
+        self.assertRaises(RequestTooLarge, encoding.decode_body, request)
+
+    def test_invalid_body(self):
+        from queuey.encoding import InvalidContentEncoding
+        encoding = self._makeOne()
+        request = self._makeRequest('not gzip', 'gzip')
+        self.assertRaises(InvalidContentEncoding, encoding.decode_body,
+                          request)
+
+    def test_unsupported_encoding(self):
+        from queuey.encoding import UnsupportedContentEncoding
+        encoding = self._makeOne()
+        request = self._makeRequest('data', 'br')
+        self.assertRaises(UnsupportedContentEncoding, encoding.decode_body,
+                          request)
+
+    def test_encode_response(self):
+        encoding = self._makeOne(min_size=100, level=9)
+        request = Request.blank('/', headers={'Accept-Encoding': 'gzip'})
+        response = Response('x' * 100)
+        encoding.encode_response(request, response)
+        eq_('gzip', response.content_encoding)
+        eq_(('Accept-Encoding',), response.vary)
+        eq_('x' * 100, zlib.decompress(response.body, 16 + zlib.MAX_WBITS))
+
+    def test_small_response(self):
+        encoding = self._makeOne(min_size=100)
+        request = Request.blank('/', headers={'Accept-Encoding': 'gzip'})
+        response = Response('x' * 99)
+        encoding.encode_response(request, response)
+        eq_(None, response.content_encoding)
+        eq_('x' * 99, response.body)
+
+    def test_gzip_not_accepted(self):
+        encoding = self._makeOne(min_size=100)
+        request = Request.blank('/', headers={'Accept-Encoding': 'deflate'})
+        response = Response('x' * 100)
+        encoding.encode_response(request, response)
+        eq_(None, response.content_encoding)
+        eq_(('Accept-Encoding',), response.vary)
+
+    def test_streamed_response(self):
+        encoding = self._makeOne(min_size=1)
+        request = Request.blank('/', headers={'Accept-Encoding': 'gzip'})
+        response = Response(app_iter=iter(['x' * 100]))
+        encoding.encode_response(request, response)
+        eq_(None, response.content_encoding)
@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import json
+import unittest
+import uuid
+
+from nose.tools import eq_
+from nose.tools import raises
+
+
+def parse_event(event):
+    fields = dict(x.split(': ', 1) for x in event.strip().split('\n'))
+    return fields['id'], json.loads(fields['data'])
+
+
+class TestEventHub(unittest.TestCase):
+    def setUp(self):
+        from queuey.notify import Notifier
+        from queuey.storage.memory import MemoryQueueBackend
+        self.storage = MemoryQueueBackend()
+        self.notifier = Notifier()
+        self.queue_name = uuid.uuid4().hex
+
+    def _makeOne(self, **kwargs):
+        from queuey.events import EventHub
+        return EventHub(self.storage, self.notifier, keepalive=0.05,
+                        **kwargs)
+
+    def _push(self, body, partition=1):
+        queue_name = '%s:%s' % (self.queue_name, partition)
+        msg_id = self.storage.push('weak', 'myapp', queue_name, body)[0]
+        self.notifier.notify([('myapp', queue_name)])
+        return msg_id
+
+    def _subscribe(self, hub, partitions=(1,), positions=None):
+        return hub.subscribe('weak', 'myapp', self.queue_name,
+                             list(partitions), positions=positions)
+
+    def test_new_messages(self):
+        hub = self._makeOne()
+        subscription = self._subscribe(hub, partitions=[1, 2])
+        events = iter(subscription)
+        assert events.next().startswith(':')
+        msg_id = self._push('hello', partition=2)
+        event_id, msg = parse_event(events.next())
+        eq_('2:%s' % msg_id, event_id)
+        eq_('hello', msg['body'])
+        eq_(2, msg['partition'])
+        subscription.close()
+        eq_({}, hub.readers)
+        eq_(0, hub.subscribers)
+
+    def test_keepalive(self):
+        hub = self._makeOne()
+        subscription = self._subscribe(hub)
+        events = iter(subscription)
+        events.next()
+        eq_(': keepalive\n\n', events.next())
+        subscription.close()
+
+    def test_resume(self):
+        first = self._push('first')
+        self._push('second')
+        hub = self._makeOne()
+        subscription = self._subscribe(hub, positions={1: first})
+        events = iter(subscription)
+        events.next()
+        event_id, msg = parse_event(events.next())
+        eq_('second', msg['body'])
+        third = self._push('third')
+        event_id, msg = parse_event(events.next())
+        eq_('third', msg['body'])
+        eq_('1:%s' % third, event_id)
+        subscription.close()
+
+    def test_shared_reader(self):
+        hub = self._makeOne()
+        first = self._subscribe(hub)
+        second = self._subscribe(hub)
+        eq_(1, len(hub.readers))
+        first.close()
+        eq_(1, len(hub.readers))
+        second.close()
+        eq_(0, len(hub.readers))
+
+    def test_max_subscribers(self):
+        from queuey.events import TooManySubscribers
+        hub = self._makeOne(max_subscribers=1)
+        subscription = self._subscribe(hub)
+
+        @raises(TooManySubscribers)
+        def testit():
+            self._subscribe(hub)
+        testit()
+        subscription.close()
+
+    def test_slow_subscriber(self):
+        hub = self._makeOne(max_pending=2)
+        subscription = self._subscribe(hub)
+        events = iter(subscription)
+        events.next()
+        first = self._push('first')
+        event_id, msg = parse_event(events.next())
+        for x in range(3):
+            subscription.deliver([{'partition': 1, 'message_id': first}])
+        # Disconnected instead of buffering more
+        eq_(True, subscription.dropped)
+        eq_(0, hub.subscribers)
+        eq_({}, hub.readers)
+        eq_([], list(events))
+
+
+class TestParseCursor(unittest.TestCase):
+    def _callFUT(self, cursor, partitions=(1, 2)):
+        from queuey.resources import parse_cursor
+        return parse_cursor(cursor, list(partitions))
+
+    def test_cursors(self):
+        msg_id = uuid.uuid1().hex
+        eq_({}, self._callFUT(None))
+        eq_({1: msg_id, 2: msg_id}, self._callFUT(msg_id))
+        eq_({2: msg_id}, self._callFUT('2:%s' % msg_id))
+        eq_([1, 2], sorted(self._callFUT('1323973966.282637').keys()))
+
+    def test_invalid_cursor(self):
+        from queuey.resources import InvalidMessageID
+
+        @raises(InvalidMessageID)
+        def testit():
+            self._callFUT('fred:%s' % uuid.uuid1().hex)
+        testit()
@@ -1,11 +1,17 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import base64
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import urllib
 import uuid
 import json
+import zlib
 
 from paste.deploy import loadapp
 from webtest import TestApp
@@ -115,6 +121,219 @@ class TestQueueyBaseApp(unittest.TestCase):
         result = json.loads(resp.body)
         eq_('error', result['status'])
 
+    def test_compressed_queue(self):
+        app, queue_name = self._make_app_queue({'compression': 'zlib'})
+        queue = self._get_queue_info(app, queue_name)
+        eq_('zlib', queue['compression'])
+
+        body = 'Hello there! ' * 200
+        app.post('/v1/queuey/' + queue_name, body, headers=auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, headers=auth_header)
+        result = json.loads(resp.body)
+        eq_(body, result['messages'][0]['body'])
+
+        # Updating with a small body stores it uncompressed
+        q = urllib.quote_plus('1:' + result['messages'][0]['message_id'])
+        app.put('/v1/queuey/%s/%s' % (queue_name, q), 'Small',
+                headers=auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, headers=auth_header)
+        eq_('Small', json.loads(resp.body)['messages'][0]['body'])
+        app.put('/v1/queuey/%s/%s' % (queue_name, q), body,
+                headers=auth_header)
+
+        # Turning compression off keeps earlier messages readable
+        resp = app.put('/v1/queuey/%s' % queue_name, {'compression': 'none'},
+                       headers=auth_header)
+        eq_('none', json.loads(resp.body)['compression'])
+        app.post('/v1/queuey/' + queue_name, body, headers=auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, headers=auth_header)
+        result = json.loads(resp.body)
+        eq_([body, body], [x['body'] for x in result['messages']])
+
+    def test_msgpack(self):
+        import msgpack
+        app, queue_name = self._make_app_queue({'partitions': 2})
+        msgpack_header = {'Content-Type': 'application/x-msgpack',
+                          'Accept': 'application/x-msgpack'}
+        msgpack_header.update(auth_header)
+        binary = '\xff\x00binary'
+        msgs = msgpack.packb({'messages': [
+            {'body': 'Hello msg', 'partition': 1, 'ttl': 3600},
+            {'body': binary, 'partition': 2}]})
+        resp = app.post('/v1/queuey/' + queue_name, msgs,
+                        headers=msgpack_header)
+        eq_('application/x-msgpack', resp.content_type)
+        result = msgpack.unpackb(resp.body)
+        eq_('ok', result['status'])
+        eq_([1, 2], [x['partition'] for x in result['messages']])
+
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1,2'},
+                       headers=msgpack_header)
+        messages = msgpack.unpackb(resp.body)['messages']
+        eq_(['Hello msg', binary], [x['body'] for x in messages])
+
+        # JSON clients get binary bodies base64 encoded
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '2'},
+                       headers=auth_header)
+        msg = json.loads(resp.body)['messages'][0]
+        eq_('base64', msg['encoding'])
+        eq_(binary, base64.b64decode(msg['body']))
+
+        # Fetches send the bodies of every queue raw
+        body = json.dumps({'queues': [{'queue_name': queue_name,
+                                       'partitions': [2]}]})
+        headers = {'Accept': 'application/x-msgpack'}
+        headers.update(auth_header)
+        resp = app.post('/v1/queuey/@@fetch', body, headers=headers)
+        msg = msgpack.unpackb(resp.body)['queues'][queue_name]['messages'][0]
+        eq_(binary, msg['body'])
+        assert 'encoding' not in msg
+
+        resp = app.post('/v1/queuey/' + queue_name, 'not msgpack',
+                        headers=msgpack_header, status=400)
+
+    def test_binary_message(self):
+        app, queue_name = self._make_app_queue()
+        binary = '\xff\x00binary'
+        app.post('/v1/queuey/' + queue_name, binary, headers=auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, headers=auth_header)
+        msg = json.loads(resp.body)['messages'][0]
+        eq_(binary, base64.b64decode(msg['body']))
+
+    def test_gzip(self):
+        app, queue_name = self._make_app_queue()
+        msgs = json.dumps({'messages': [{'body': 'Hello gzip %s' % x}
+                                        for x in range(50)]})
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(msgs) + compressor.flush()
+        headers = {'Content-Type': 'application/json',
+                   'Content-Encoding': 'gzip'}
+        headers.update(auth_header)
+        app.post('/v1/queuey/' + queue_name, body, headers=headers)
+
+        headers = {'Accept-Encoding': 'gzip'}
+        headers.update(auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, {'limit': 50},
+                       headers=headers)
+        eq_('gzip', resp.headers['Content-Encoding'])
+        result = json.loads(zlib.decompress(resp.body, 16 + zlib.MAX_WBITS))
+        eq_(50, len(result['messages']))
+
+        # Compressed bodies are limited in their decompressed size
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        bomb = compressor.compress('x' * (11 * 1024 * 1024))
+        bomb += compressor.flush()
+        headers = {'Content-Encoding': 'gzip'}
+        headers.update(auth_header)
+        app.post('/v1/queuey/' + queue_name, bomb, headers=headers,
+                 status=413)
+
+    def test_etag(self):
+        app, queue_name = self._make_app_queue({'partitions': 2})
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1,2'},
+                       headers=auth_header)
+        etag = resp.headers['ETag']
+        headers = {'If-None-Match': etag}
+        headers.update(auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1,2'},
+                       headers=headers, status=304)
+        eq_('', resp.body)
+
+        # Other parameters need their own tag
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1'},
+                       headers=headers)
+        assert resp.headers['ETag'] != etag
+
+        post_headers = {'X-Partition': '2'}
+        post_headers.update(auth_header)
+        app.post('/v1/queuey/' + queue_name, 'Hello there!',
+                 headers=post_headers)
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1,2'},
+                       headers=headers)
+        eq_(1, len(json.loads(resp.body)['messages']))
+        assert resp.headers['ETag'] != etag
+
+    def test_fetch(self):
+        app, queue_name = self._make_app_queue({'partitions': 2})
+        app, queue_name2 = self._make_app_queue()
+        app, private_queue = self._make_app_queue(
+            {'principles': 'app:notifications'})
+        msgs = json.dumps({'messages': [
+            {'body': 'Hello 1', 'partition': 1},
+            {'body': 'Hello 2', 'partition': 2}]})
+        headers = {'Content-Type': 'application/json'}
+        headers.update(auth_header)
+        app.post('/v1/queuey/' + queue_name, msgs, headers=headers)
+        resp = app.post('/v1/queuey/' + queue_name2, 'Hello there',
+                        headers=auth_header)
+        since = json.loads(resp.body)['messages'][0]['timestamp']
+
+        body = json.dumps({'queues': [
+            {'queue_name': queue_name, 'partitions': [1, 2]},
+            {'queue_name': queue_name2, 'since': since, 'limit': 5},
+            {'queue_name': private_queue},
+            {'queue_name': 'missing'}]})
+        resp = app.post('/v1/queuey/@@fetch', body, headers=auth_header)
+        result = json.loads(resp.body)
+        eq_('ok', result['status'])
+        queues = result['queues']
+        eq_(['Hello 1', 'Hello 2'],
+            sorted(x['body'] for x in queues[queue_name]['messages']))
+        eq_(['Hello there'],
+            [x['body'] for x in queues[queue_name2]['messages']])
+        eq_('error', queues[private_queue]['status'])
+        eq_('error', queues['missing']['status'])
+
+        # Anonymous clients can fetch from public queues only
+        app, public_queue = self._make_app_queue({'type': 'public'})
+        body = json.dumps({'queues': [{'queue_name': public_queue},
+                                      {'queue_name': queue_name}]})
+        resp = app.post('/v1/queuey/@@fetch', body)
+        queues = json.loads(resp.body)['queues']
+        eq_('ok', queues[public_queue]['status'])
+        eq_('error', queues[queue_name]['status'])
+
+        body = json.dumps({'queues': [{'queue_name': queue_name},
+                                      {'queue_name': queue_name}]})
+        app.post('/v1/queuey/@@fetch', body, headers=auth_header,
+                 status=400)
+        app.post('/v1/queuey/@@fetch', 'not json', headers=auth_header,
+                 status=400)
+        body = json.dumps({'queues': [{'queue_name': queue_name,
+                                       'partitions': []}]})
+        app.post('/v1/queuey/@@fetch', body, headers=auth_header,
+                 status=400)
+
+    def test_push_to_queues(self):
+        app, queue_name = self._make_app_queue({'partitions': 2})
+        app, queue_name2 = self._make_app_queue({'consistency': 'weak',
+                                                 'compression': 'zlib'})
+        body = json.dumps({'messages': [
+            {'queue_name': queue_name, 'body': 'Hello 1', 'partition': 2},
+            {'queue_name': queue_name2, 'body': 'Hello 2', 'ttl': 3600},
+            {'queue_name': queue_name, 'body': 'Hello 3', 'partition': 3},
+            {'queue_name': 'missing', 'body': 'Hello 4'}]})
+        headers = {'Content-Type': 'application/json'}
+        headers.update(auth_header)
+        resp = app.post('/v1/queuey/@@push', body, headers=headers,
+                        status=201)
+        messages = json.loads(resp.body)['messages']
+        eq_(['ok', 'ok', 'error', 'error'], [x['status'] for x in messages])
+        eq_([queue_name, queue_name2], [x['queue_name'] for x in messages[:2]])
+        eq_(2, messages[0]['partition'])
+
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '2'},
+                       headers=auth_header)
+        result = json.loads(resp.body)['messages']
+        eq_([messages[0]['key']], [x['message_id'] for x in result])
+        resp = app.get('/v1/queuey/' + queue_name2, headers=auth_header)
+        eq_(['Hello 2'], [x['body'] for x in json.loads(resp.body)['messages']])
+
+        # Only applications may push
+        app.post('/v1/queuey/@@push', body, status=403)
+        app.post('/v1/queuey/@@push', json.dumps({'messages': []}),
+                 headers=headers, status=400)
+
     def test_public_queue(self):
         app, queue_name = self._make_app_queue({'type': 'public'})
 
@@ -173,6 +392,542 @@ class TestQueueyBaseApp(unittest.TestCase):
         result = json.loads(resp.body)
         eq_('ok', result['status'])
 
+    def test_stream_messages(self):
+        app, queue_name = self._make_app_queue({'partitions': 2})
+        msgs = json.dumps({'messages': [
+            {'body': 'Hello msg %s' % x, 'partition': x % 2 + 1}
+            for x in range(4)]})
+        json_header = {'Content-Type': 'application/json'}
+        json_header.update(auth_header)
+        app.post('/v1/queuey/' + queue_name, msgs, headers=json_header)
+
+        stream_header = {'Accept': 'application/x-ndjson'}
+        stream_header.update(auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1,2'},
+                       headers=stream_header)
+        eq_('application/x-ndjson', resp.content_type)
+        lines = resp.body.splitlines()
+        eq_(4, len(lines))
+        eq_(set(['Hello msg %s' % x for x in range(4)]),
+            set(json.loads(x)['body'] for x in lines))
+
+        resp = app.get('/v1/queuey/' + queue_name,
+                       {'partitions': '1,2', 'limit': 1},
+                       headers=stream_header)
+        eq_(2, len(resp.body.splitlines()))
+
+        # Nothing to stream
+        app, queue_name = self._make_app_queue()
+        resp = app.get('/v1/queuey/' + queue_name, headers=stream_header)
+        eq_('', resp.body)
+
+    def test_cursor_paging(self):
+        app, queue_name = self._make_app_queue({'partitions': 3})
+        msgs = json.dumps({'messages': [
+            {'body': 'Hello %s' % x, 'partition': x % 3 + 1}
+            for x in range(20)]})
+        json_header = {'Content-Type': 'application/json'}
+        json_header.update(auth_header)
+        app.post('/v1/queuey/' + queue_name, msgs, headers=json_header)
+
+        seen = []
+        params = {'partitions': '1,2,3', 'limit': 3}
+        for page in range(10):
+            resp = app.get('/v1/queuey/' + queue_name, params,
+                           headers=auth_header)
+            result = json.loads(resp.body)
+            if not result['messages']:
+                break
+            seen.extend(x['body'] for x in result['messages'])
+            params['cursor'] = result['cursor']
+        eq_(sorted('Hello %s' % x for x in range(20)), sorted(seen))
+
+        # The last cursor continues with new messages only
+        app.post('/v1/queuey/' + queue_name, 'Hello again',
+                 headers=auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, params,
+                       headers=auth_header)
+        eq_(['Hello again'],
+            [x['body'] for x in json.loads(resp.body)['messages']])
+
+        # Streams continue at the cursor too
+        headers = {'Accept': 'application/x-ndjson'}
+        headers.update(auth_header)
+        resp = app.get('/v1/queuey/' + queue_name, params, headers=headers)
+        eq_(['Hello again'],
+            [json.loads(x)['body'] for x in resp.body.splitlines()])
+
+        params['cursor'] = 'not a cursor'
+        app.get('/v1/queuey/' + queue_name, params, headers=auth_header,
+                status=400)
+
+    def test_consumer_group(self):
+        app, queue_name = self._make_app_queue({'partitions': 2})
+        msgs = json.dumps({'messages': [
+            {'body': 'Hello %s' % x, 'partition': x % 2 + 1}
+            for x in range(6)]})
+        json_header = {'Content-Type': 'application/json'}
+        json_header.update(auth_header)
+        resp = app.post('/v1/queuey/' + queue_name, msgs, headers=json_header)
+        stored = json.loads(resp.body)['messages']
+
+        params = {'partitions': '1,2', 'group': 'workers', 'limit': 2,
+                  'commit': 'true'}
+        seen = []
+        for page in range(3):
+            resp = app.get('/v1/queuey/' + queue_name, params,
+                           headers=auth_header)
+            seen.extend(x['body'] for x in json.loads(resp.body)['messages'])
+        eq_(sorted('Hello %s' % x for x in range(6)), sorted(seen))
+
+        resp = app.get('/v1/queuey/%s/@@offsets' % queue_name,
+                       {'group': 'workers'}, headers=auth_header)
+        offsets = json.loads(resp.body)['offsets']
+        eq_({'1': stored[4]['key'], '2': stored[5]['key']}, offsets)
+
+        # Another group starts from the beginning, reads without committing
+        # don't move the offsets
+        params['group'] = 'others'
+        params['commit'] = 'false'
+        for page in range(2):
+            resp = app.get('/v1/queuey/' + queue_name, params,
+                           headers=auth_header)
+            eq_(4, len(json.loads(resp.body)['messages']))
+
+        # Offsets can be committed explicitly
+        body = json.dumps({'group': 'others',
+                           'offsets': {'1': stored[2]['key']}})
+        app.post('/v1/queuey/%s/@@offsets' % queue_name, body,
+                 headers=json_header)
+        resp = app.get('/v1/queuey/' + queue_name, params,
+                       headers=auth_header)
+        eq_(['Hello 1', 'Hello 3', 'Hello 4'],
+            sorted(x['body'] for x in json.loads(resp.body)['messages']))
+
+        body = json.dumps({'group': 'others', 'offsets': {'3': stored[2]['key']}})
+        app.post('/v1/queuey/%s/@@offsets' % queue_name, body,
+                 headers=json_header, status=400)
+        app.get('/v1/queuey/' + queue_name,
+                {'group': 'others', 'cursor': 'MTox'},
+                headers=auth_header, status=400)
+
+    def test_public_queue_commits(self):
+        app, queue_name = self._make_app_queue({'type': 'public'})
+        resp = app.post('/v1/queuey/' + queue_name, 'Hello',
+                        headers=auth_header)
+        key = json.loads(resp.body)['messages'][0]['key']
+        params = {'group': 'workers', 'commit': 'true'}
+
+        # Anonymous readers may read as a group, but not move its offsets
+        app.get('/v1/queuey/' + queue_name, {'group': 'workers'})
+        app.get('/v1/queuey/' + queue_name, params, status=403)
+        body = json.dumps({'group': 'workers', 'offsets': {'1': key}})
+        app.post('/v1/queuey/%s/@@offsets' % queue_name, body, status=403)
+        resp = app.get('/v1/queuey/%s/@@offsets' % queue_name,
+                       {'group': 'workers'})
+        eq_({}, json.loads(resp.body)['offsets'])
+
+        resp = app.get('/v1/queuey/' + queue_name, params,
+                       headers=auth_header)
+        eq_(['Hello'], [x['body'] for x in json.loads(resp.body)['messages']])
+        app.post('/v1/queuey/%s/@@offsets' % queue_name, body,
+                 headers=auth_header)
+
+    def test_json_rows(self):
+        app, queue_name = self._make_app_queue({'partitions': 3})
+        bodies = [u'caf\xe9'.encode('utf-8'), '\xff\xfe', 'say "hi"\n']
+        for index, body in enumerate(bodies):
+            app.post('/v1/queuey/%s' % queue_name, body,
+                     headers=dict(auth_header, **{'X-Partition':
+                                                  str(index + 1)}))
+        resp = app.get('/v1/queuey/%s' % queue_name,
+                       {'partitions': '1,2,3'}, headers=auth_header)
+        result = json.loads(resp.body)
+        eq_('ok', result['status'])
+        messages = result['messages']
+        eq_([1, 2, 3], [x['partition'] for x in messages])
+        eq_('base64', messages[1]['encoding'])
+        eq_('\xff\xfe', base64.b64decode(messages[1]['body']))
+
+        # The same messages as built from message dicts
+        resp = app.get('/v1/queuey/%s' % queue_name,
+                       {'partitions': '1,2,3'},
+                       headers=dict(auth_header,
+                                    Accept='application/x-ndjson'))
+        eq_(messages, [json.loads(x) for x in resp.body.splitlines()])
+
+        resp = app.get('/v1/queuey/%s' % queue_name,
+                       {'partitions': '1,2,3', 'cursor': result['cursor']},
+                       headers=auth_header)
+        eq_([], json.loads(resp.body)['messages'])
+
+    def test_partition_workers(self):
+        app = self.makeOne()
+        registry = app.app.app.registry
+        eq_(4, registry['read_workers'].size)
+        eq_(4, registry['delete_workers'].size)
+
+    def test_cursor_reads_run_concurrently(self):
+        app, queue_name = self._make_app_queue({'partitions': 3})
+        json_header = {'Content-Type': 'application/json'}
+        json_header.update(auth_header)
+        for x in range(1, 4):
+            msgs = json.dumps({'messages': [{'body': 'Hello', 'partition': x}]})
+            app.post('/v1/queuey/' + queue_name, msgs, headers=json_header)
+        params = {'partitions': '1,2,3'}
+        resp = app.get('/v1/queuey/' + queue_name, params,
+                       headers=auth_header)
+        params['cursor'] = json.loads(resp.body)['cursor']
+
+        storage = app.app.app.registry['backend_storage']
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def slow(retrieve):
+            def slow_retrieve(*args, **kwargs):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.1)
+                with lock:
+                    running[0] -= 1
+                return retrieve(*args, **kwargs)
+            return slow_retrieve
+        for name in ('retrieve_batch', 'retrieve_rows'):
+            setattr(storage, name, slow(getattr(storage, name)))
+            self.addCleanup(delattr, storage, name)
+        for merge in ('false', 'true'):
+            params['merge'] = merge
+            running[1] = 0
+            resp = app.get('/v1/queuey/' + queue_name, params,
+                           headers=auth_header)
+            eq_([], json.loads(resp.body)['messages'])
+            # Every partition is positioned by the cursor and read on its own
+            eq_(3, running[1])
+
+    def test_merged_read(self):
+        app, queue_name = self._make_app_queue({'partitions': 4})
+        json_header = {'Content-Type': 'application/json'}
+        json_header.update(auth_header)
+        for x in range(12):
+            msgs = json.dumps({'messages': [
+                {'body': 'Hello %s' % x, 'partition': x * 3 % 4 + 1}]})
+            app.post('/v1/queuey/' + queue_name, msgs, headers=json_header)
+
+        params = {'partitions': 'all', 'merge': 'true', 'limit': 5}
+        resp = app.get('/v1/queuey/' + queue_name, params,
+                       headers=auth_header)
+        result = json.loads(resp.body)
+        eq_(['Hello %s' % x for x in range(5)],
+            [x['body'] for x in result['messages']])
+
+        # Continues with the cursor across all partitions
+        params['cursor'] = result['cursor']
+        params['limit'] = 10
+        resp = app.get('/v1/queuey/' + queue_name, params,
+                       headers=auth_header)
+        eq_(['Hello %s' % x for x in range(5, 12)],
+            [x['body'] for x in json.loads(resp.body)['messages']])
+
+        params = {'partitions': '1,2,3', 'merge': 'true',
+                  'order': 'descending', 'limit': 4}
+        resp = app.get('/v1/queuey/' + queue_name, params,
+                       headers=auth_header)
+        eq_(['Hello 11', 'Hello 10', 'Hello 8', 'Hello 7'],
+            [x['body'] for x in json.loads(resp.body)['messages']])
+
+        headers = {'Accept': 'application/x-ndjson'}
+        headers.update(auth_header)
+        resp = app.get('/v1/queuey/' + queue_name,
+                       {'partitions': 'all', 'merge': 'true'},
+                       headers=headers)
+        eq_(['Hello %s' % x for x in range(12)],
+            [json.loads(x)['body'] for x in resp.body.splitlines()])
+
+        app.get('/v1/queuey/' + queue_name, {'partitions': 'some'},
+                headers=auth_header, status=400)
+
+    def test_claim(self):
+        app, queue_name = self._make_app_queue({'partitions': 2})
+        msgs = json.dumps({'messages': [
+            {'body': 'Hello %s' % x, 'partition': x % 2 + 1}
+            for x in range(4)]})
+        json_header = {'Content-Type': 'application/json'}
+        json_header.update(auth_header)
+        app.post('/v1/queuey/' + queue_name, msgs, headers=json_header)
+
+        url = '/v1/queuey/%s/@@claim' % queue_name
+        resp = app.post(url, {'partitions': '1,2', 'limit': 3},
+                        headers=auth_header)
+        result = json.loads(resp.body)
+        eq_(3, len(result['messages']))
+        eq_(60, result['lease'])
+        resp = app.post(url, {'partitions': '1,2', 'limit': 3},
+                        headers=auth_header)
+        second = json.loads(resp.body)
+        eq_(1, len(second['messages']))
+        assert second['claim'] != result['claim']
+
+        # Acknowledge by deleting
+        ids = ['%s:%s' % (x['partition'], x['message_id'])
+               for x in result['messages']]
+        app.post('/v1/queuey/%s/@@delete' % queue_name,
+                 json.dumps({'messages': ids}), headers=json_header)
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1,2'},
+                       headers=auth_header)
+        eq_([second['messages'][0]['message_id']],
+            [x['message_id'] for x in json.loads(resp.body)['messages']])
+
+        app.post(url, {'lease': 0}, headers=auth_header, status=400)
+        app.post(url, status=403)
+
+    def test_group_membership(self):
+        app, queue_name = self._make_app_queue({'partitions': 5})
+        url = '/v1/queuey/%s/@@join' % queue_name
+        resp = app.post(url, {'group': 'workers', 'member': 'a'},
+                        headers=auth_header)
+        result = json.loads(resp.body)
+        eq_([1, 2, 3, 4, 5], result['partitions'])
+        eq_(1, result['members'])
+        eq_(30, result['timeout'])
+        first = result['generation']
+
+        # Members without an id get one
+        resp = app.post(url, {'group': 'workers'}, headers=auth_header)
+        result = json.loads(resp.body)
+        member = result['member']
+        eq_(2, result['members'])
+        generation = result['generation']
+        assert generation != first
+
+        # The first member keeps its first partitions
+        resp = app.post(url, {'group': 'workers', 'member': 'a'},
+                        headers=auth_header)
+        result = json.loads(resp.body)
+        eq_([1, 2, 3], result['partitions'])
+        eq_(generation, result['generation'])
+        resp = app.post(url, {'group': 'workers', 'member': member},
+                        headers=auth_header)
+        eq_([4, 5], json.loads(resp.body)['partitions'])
+
+        # Commits have to present the current generation
+        resp = app.post('/v1/queuey/' + queue_name, 'Hello',
+                        headers=auth_header)
+        key = json.loads(resp.body)['messages'][0]['key']
+        offsets_url = '/v1/queuey/%s/@@offsets' % queue_name
+        json_header = {'Content-Type': 'application/json'}
+        json_header.update(auth_header)
+        body = {'group': 'workers', 'offsets': {'1': key}, 'member': 'a',
+                'generation': generation}
+        app.post(offsets_url, json.dumps(body), headers=json_header)
+        body['generation'] = first
+        resp = app.post(offsets_url, json.dumps(body), headers=json_header,
+                        status=409)
+        assert 'StaleGeneration' in json.loads(resp.body)['error_msg']
+        del body['generation']
+        app.post(offsets_url, json.dumps(body), headers=json_header,
+                 status=409)
+        app.get('/v1/queuey/' + queue_name,
+                {'group': 'workers', 'commit': 'true', 'member': 'a',
+                 'generation': first},
+                headers=auth_header, status=409)
+
+        # and may only commit their own partitions
+        body = {'group': 'workers', 'offsets': {'4': key},
+                'generation': generation}
+        for committer in ('a', None):
+            body['member'] = committer
+            resp = app.post(offsets_url, json.dumps(body),
+                            headers=json_header, status=409)
+            assert 'UnassignedPartitions' in \
+                json.loads(resp.body)['error_msg']
+        app.get('/v1/queuey/' + queue_name,
+                {'group': 'workers', 'commit': 'true', 'member': 'a',
+                 'partitions': '3,4', 'generation': generation},
+                headers=auth_header, status=409)
+        app.get('/v1/queuey/' + queue_name,
+                {'group': 'workers', 'commit': 'true', 'member': 'a',
+                 'partitions': '2,3', 'generation': generation},
+                headers=auth_header)
+
+        app.post('/v1/queuey/%s/@@leave' % queue_name,
+                 {'group': 'workers', 'member': member}, headers=auth_header)
+        resp = app.post(url, {'group': 'workers', 'member': 'a'},
+                        headers=auth_header)
+        result = json.loads(resp.body)
+        eq_([1, 2, 3, 4, 5], result['partitions'])
+        eq_(first, result['generation'])
+
+        app.post(url, {'group': 'workers', 'timeout': 0},
+                 headers=auth_header, status=400)
+        app.post(url, {'group': 'workers'}, status=403)
+
+        # Anonymous readers of public queues can't take part in groups
+        app, queue_name = self._make_app_queue({'type': 'public'})
+        app.post('/v1/queuey/%s/@@join' % queue_name, {'group': 'workers'},
+                 status=403)
+        app.post('/v1/queuey/%s/@@leave' % queue_name,
+                 {'group': 'workers', 'member': 'a'}, status=403)
+
+    def test_sticky_assignment(self):
+        from queuey.resources import assign_partitions
+        eq_({'a': [1, 2, 3], 'b': [4, 5], 'c': [6, 7]},
+            assign_partitions(['c', 'a', 'b'], 7))
+        previous = assign_partitions(['a', 'b', 'c'], 12)
+        # A joining member only takes partitions the others can spare
+        assignment = assign_partitions(['a', 'b', 'c', 'd'], 12, previous)
+        eq_([3, 3, 3, 3], [len(x) for x in assignment.values()])
+        moved = sum(1 for member in 'abc' for x in previous[member]
+                    if x not in assignment[member])
+        eq_(3, moved)
+        # A leaving member's partitions go to the others, nothing else moves
+        previous = assignment
+        assignment = assign_partitions(['a', 'c', 'd'], 12, previous)
+        for member in 'acd':
+            assert set(previous[member]) <= set(assignment[member])
+        eq_(range(1, 13), sorted(sum(assignment.values(), [])))
+
+    def test_journaled_push(self):
+        from queuey.journal import Journal
+        app, queue_name = self._make_app_queue({'consistency': 'weak'})
+        strong_queue = self._make_app_queue()[1]
+        app.get('/__journal__', status=404)
+
+        registry = app.app.app.registry
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        journal = registry['journal'] = Journal(registry['backend_storage'],
+                                                path)
+        self.addCleanup(registry.__setitem__, 'journal', None)
+
+        resp = app.post('/v1/queuey/%s' % queue_name,
+                        json.dumps({'messages': [{'body': 'hello'}]}),
+                        headers=dict(auth_header,
+                                     **{'Content-Type': 'application/json'}),
+                        status=202)
+        key = json.loads(resp.body)['messages'][0]['key']
+        resp = app.post('/v1/queuey/@@push', json.dumps({'messages': [
+            {'queue_name': queue_name, 'body': 'world'}]}),
+            headers=auth_header, status=202)
+        eq_('ok', json.loads(resp.body)['messages'][0]['status'])
+        resp = app.get('/__journal__')
+        eq_(2, json.loads(resp.body)['backlog'])
+
+        # Other queues are written right away
+        app.post('/v1/queuey/%s' % strong_queue, 'stored', headers=auth_header,
+                 status=201)
+
+        # Stored once the journal was pushed
+        resp = app.get('/v1/queuey/%s' % queue_name, headers=auth_header)
+        eq_([], json.loads(resp.body)['messages'])
+
+        # The push would undo changes made before it
+        message_url = str('/v1/queuey/%s/%s' % (queue_name, key))
+        resp = app.delete(message_url, headers=auth_header, status=409)
+        assert 'MessagesPending' in json.loads(resp.body)['error_msg']
+        app.post('/v1/queuey/%s/@@delete' % queue_name,
+                 json.dumps({'messages': [key]}),
+                 headers=dict(auth_header,
+                              **{'Content-Type': 'application/json'}),
+                 status=409)
+        app.put(message_url, 'changed', headers=auth_header, status=409)
+
+        journal.flush()
+        resp = app.get('/v1/queuey/%s' % queue_name, headers=auth_header)
+        messages = json.loads(resp.body)['messages']
+        eq_(['hello', 'world'], sorted(x['body'] for x in messages))
+        eq_(1, len([x for x in messages if x['message_id'] == key]))
+        app.delete(message_url, headers=auth_header)
+        resp = app.get('/v1/queuey/%s' % queue_name, headers=auth_header)
+        eq_(['world'], [x['body'] for x in json.loads(resp.body)['messages']])
+
+    def test_events_disabled(self):
+        app, queue_name = self._make_app_queue()
+        url = '/v1/queuey/%s/@@events' % queue_name
+        app.get(url, headers=auth_header, status=404)
+
+        # Enabled streams go on to the subscriber limit
+        hub = app.app.app.registry['event_hub']
+        self.addCleanup(setattr, hub, 'enabled', False)
+        self.addCleanup(setattr, hub, 'max_subscribers', hub.max_subscribers)
+        hub.enabled = True
+        hub.max_subscribers = 0
+        resp = app.get(url, headers=auth_header, status=503)
+        assert 'TooManySubscribers' in json.loads(resp.body)['error_msg']
+
+    def test_long_polling(self):
+        app, queue_name = self._make_app_queue()
+        resp = app.get('/v1/queuey/' + queue_name, {'wait': 1},
+                       headers=auth_header)
+        eq_([], json.loads(resp.body)['messages'])
+
+        resp = app.post('/v1/queuey/' + queue_name, 'Hello there!',
+                        headers=auth_header)
+        msg_id = json.loads(resp.body)['messages'][0]['key']
+        resp = app.get('/v1/queuey/' + queue_name, {'wait': 30},
+                       headers=auth_header)
+        eq_(['Hello there!'],
+            [x['body'] for x in json.loads(resp.body)['messages']])
+
+        # Messages after the since message are waited for
+        resp = app.get('/v1/queuey/' + queue_name,
+                       {'wait': 1, 'since': msg_id}, headers=auth_header)
+        eq_([msg_id],
+            [x['message_id'] for x in json.loads(resp.body)['messages']])
+
+        app.get('/v1/queuey/' + queue_name, {'wait': 61},
+                headers=auth_header, status=400)
+
+    def test_long_polling_since_limit(self):
+        app, queue_name = self._make_app_queue()
+        resp = app.post('/v1/queuey/' + queue_name, 'first',
+                        headers=auth_header)
+        msg_id = json.loads(resp.body)['messages'][0]['key']
+        timer = threading.Timer(0.3, app.post, ['/v1/queuey/' + queue_name,
+                                                'second'],
+                                {'headers': auth_header})
+        timer.start()
+        start = time.time()
+        resp = app.get('/v1/queuey/' + queue_name,
+                       {'wait': 3, 'since': msg_id, 'limit': 1},
+                       headers=auth_header)
+        timer.join()
+        eq_(['second'],
+            [x['body'] for x in json.loads(resp.body)['messages']])
+        assert time.time() - start < 2
+
+    def test_since_limit_partitions(self):
+        app, queue_name = self._make_app_queue({'partitions': 3})
+        bodies = [('1', 'since'), ('1', 'b'), ('1', 'c'), ('2', 'd'),
+                  ('2', 'e'), ('3', 'f'), ('3', 'g')]
+        ids = []
+        for partition, body in bodies:
+            resp = app.post('/v1/queuey/' + queue_name, body,
+                            headers=dict(auth_header, **{'X-Partition':
+                                                         partition}))
+            ids.append(json.loads(resp.body)['messages'][0]['key'])
+        url = '/v1/queuey/' + queue_name
+        msgpack_header = dict(auth_header, Accept='application/x-msgpack')
+        for headers in (auth_header, msgpack_header):
+            for wait in (0, 1):
+                params = {'since': ids[0], 'limit': 2, 'wait': wait,
+                          'partitions': '1,2,3'}
+                resp = app.get(url, params, headers=headers)
+                if headers is auth_header:
+                    messages = json.loads(resp.body)['messages']
+                else:
+                    import msgpack
+                    messages = msgpack.unpackb(resp.body)['messages']
+                # The limit applies per partition, the since message only
+                # gives way to newer ones
+                eq_(['b', 'c', 'd', 'e', 'f', 'g'],
+                    sorted(x['body'] for x in messages))
+                params['limit'] = 3
+                resp = app.get(url, params, headers=auth_header)
+                eq_(['b', 'c', 'd', 'e', 'f', 'g', 'since'],
+                    sorted(x['body'] for x in json.loads(resp.body)[
+                        'messages']))
+
     def test_delete_queue(self):
         app, queue_name = self._make_app_queue({'partitions': 3})
 
@@ -234,6 +989,43 @@ class TestQueueyBaseApp(unittest.TestCase):
         result = json.loads(resp.body)
         eq_(1, len(result['messages']))
 
+    def test_delete_messages_by_body(self):
+        app, queue_name = self._make_app_queue({'partitions': 3})
+        msgs = json.dumps({'messages': [
+            {'body': 'Hello %s' % x, 'partition': x % 3 + 1}
+            for x in range(9)]})
+        json_header = {'Content-Type': 'application/json'}
+        json_header.update(auth_header)
+        resp = app.post('/v1/queuey/' + queue_name, msgs, headers=json_header)
+        stored = json.loads(resp.body)['messages']
+
+        ids = ['%s:%s' % (x['partition'], x['key']) for x in stored[:6]]
+        # Unknown ids are ignored
+        ids += ['1:%s' % uuid.uuid1().hex] * 2000
+        resp = app.post('/v1/queuey/%s/@@delete' % queue_name,
+                        json.dumps({'messages': ids}), headers=json_header)
+        eq_(2006, json.loads(resp.body)['deleted'])
+
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1,2,3'},
+                       headers=auth_header)
+        result = json.loads(resp.body)
+        eq_(sorted(x['key'] for x in stored[6:]),
+            sorted(x['message_id'] for x in result['messages']))
+
+        # Ids without a partition are in partition 1
+        ids = [x['key'] for x in stored[6:] if x['partition'] == 1]
+        app.post('/v1/queuey/%s/@@delete' % queue_name,
+                 json.dumps({'messages': ids}), headers=json_header)
+        resp = app.get('/v1/queuey/' + queue_name, {'partitions': '1,2,3'},
+                       headers=auth_header)
+        eq_(2, len(json.loads(resp.body)['messages']))
+
+        app.post('/v1/queuey/%s/@@delete' % queue_name,
+                 json.dumps({'messages': ['1:nothex']}), headers=json_header,
+                 status=400)
+        app.post('/v1/queuey/%s/@@delete' % queue_name,
+                 json.dumps({'messages': ids}), status=403)
+
     def test_get_messages_by_key(self):
         app, queue_name = self._make_app_queue({'partitions': 2})
 
@@ -480,5 +1272,42 @@ class TestQueueyBaseApp(unittest.TestCase):
         eq_(404, resp.status_int)
 
 
+class TestFastPathApp(TestQueueyBaseApp):
+    ini_file = 'test_fastpath.ini'
+
+    def test_dispatch(self):
+        fast_path = self.makeOne().app.app
+        environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/v1/queuey/q1'}
+        eq_(('queuey', u'q1'), fast_path.dispatch(environ))
+        for method, path in [('DELETE', '/v1/queuey/q1'),
+                             ('GET', '/v1/queuey'),
+                             ('GET', '/v1/queuey/q1/'),
+                             ('GET', '/v1/queuey/q1/1:abc'),
+                             ('POST', '/v1/queuey/@@push'),
+                             ('GET', '/v1/queuey/q%201'),
+                             ('GET', '/v1/other/q1'),
+                             ('GET', '/__heartbeat__')]:
+            environ = {'REQUEST_METHOD': method, 'PATH_INFO': path}
+            eq_(None, fast_path.dispatch(environ))
+
+    def test_router_skipped(self):
+        app, queue_name = self._make_app_queue()
+        fast_path = app.app.app
+        router = fast_path.router
+
+        def unused(environ, start_response):
+            raise AssertionError("Routed %s" % environ['PATH_INFO'])
+        fast_path.router = unused
+        try:
+            app.post('/v1/queuey/%s' % queue_name, 'Hello',
+                     headers=auth_header, status=201)
+            resp = app.get('/v1/queuey/%s' % queue_name, headers=auth_header)
+            eq_('Hello', json.loads(resp.body)['messages'][0]['body'])
+            app.get('/v1/queuey/%s' % queue_name, status=403)
+            app.get('/v1/queuey/missing', headers=auth_header, status=404)
+        finally:
+            fast_path.router = router
+
+
 class TestCassandraQueueyApp(TestQueueyBaseApp):
     ini_file = 'test_cassandra.ini'
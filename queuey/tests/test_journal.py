@@ -0,0 +1,141 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import uuid
+
+from nose.tools import eq_
+
+
+class FailingStorage(object):
+    def push_batch(self, *args, **kwargs):
+        raise Exception("Unavailable")
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        from queuey.storage.memory import MemoryQueueBackend
+        self.path = tempfile.mkdtemp()
+        self.storage = MemoryQueueBackend()
+        self.queue = '%s:1' % uuid.uuid4().hex
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _makeOne(self, **kwargs):
+        from queuey.journal import Journal
+        kwargs.setdefault('storage', self.storage)
+        return Journal(path=self.path, **kwargs)
+
+    def _stored(self):
+        return self.storage.retrieve_batch('weak', 'app', [self.queue],
+                                           limit=100)
+
+    def test_append_and_flush(self):
+        journal = self._makeOne()
+        results = journal.append('app', 'weak', False, [
+            (self.queue, 'first', 3600, {}),
+            (self.queue, 'second', 3600, {}),
+        ])
+        eq_(2, len(results))
+        eq_([], self._stored())
+        eq_(2, journal.stats()['backlog'])
+
+        eq_(2, journal.flush())
+        stored = self._stored()
+        eq_(['first', 'second'], [x['body'] for x in stored])
+        eq_([x[0] for x in results], [x['message_id'] for x in stored])
+        stats = journal.stats()
+        eq_(0, stats['backlog'])
+        eq_(2, stats['pushed'])
+        eq_(0, journal.flush())
+
+    def test_batches(self):
+        journal = self._makeOne(batch_size=2)
+        for x in range(5):
+            journal.append('app', 'weak', False,
+                           [(self.queue, 'msg %s' % x, 3600, {})])
+        eq_(2, journal._flush_batch())
+        eq_(2, len(self._stored()))
+        eq_(3, journal.flush())
+        eq_(5, len(self._stored()))
+
+    def test_replay(self):
+        journal = self._makeOne()
+        journal.append('app', 'weak', False, [(self.queue, 'first', 3600, {})])
+        journal.flush()
+        journal.append('app', 'weak', False,
+                       [(self.queue, 'second', 3600, {})])
+        # Not checkpointed yet, as if pushed right before a crash
+        journal._push(journal._read()[0])
+
+        journal = self._makeOne()
+        eq_(1, journal.stats()['backlog'])
+        eq_(1, journal.flush())
+        eq_(['first', 'second'], [x['body'] for x in
+                                  self._stored()])
+        # Pushed segments are removed
+        eq_(1, journal.stats()['segments'])
+
+    def test_pending(self):
+        journal = self._makeOne()
+        first = journal.append('app', 'weak', False,
+                               [(self.queue, 'first', 3600, {})])[0][0]
+        second = journal.append('app', 'weak', False,
+                                [(self.queue, 'second', 3600, {})])[0][0]
+        other = uuid.uuid4().hex
+        eq_([first, second], journal.pending([first, other, second]))
+        eq_([second.upper()], journal.pending([second.upper()]))
+
+        # Known again after a restart
+        journal = self._makeOne()
+        eq_([first, second], journal.pending([first, second]))
+        journal.flush()
+        eq_([], journal.pending([first, second]))
+
+    def test_torn_frame(self):
+        journal = self._makeOne()
+        journal.append('app', 'weak', False, [(self.queue, 'first', 3600, {})])
+        journal.append('app', 'weak', False, [(self.queue, 'torn', 3600, {})])
+        path = journal._segment_path(journal._segment)
+        with open(path, 'r+b') as segment_file:
+            segment_file.truncate(os.path.getsize(path) - 3)
+
+        journal = self._makeOne()
+        eq_(1, journal.stats()['backlog'])
+        eq_(1, journal.flush())
+        journal.append('app', 'weak', False, [(self.queue, 'third', 3600, {})])
+        eq_(1, journal.flush())
+        eq_(['first', 'third'], [x['body'] for x in self._stored()])
+
+    def test_rotation(self):
+        journal = self._makeOne(segment_size=1)
+        for x in range(3):
+            journal.append('app', 'weak', False,
+                           [(self.queue, 'msg %s' % x, 3600, {})])
+        eq_(3, journal.stats()['segments'])
+        eq_(3, journal.flush())
+        eq_(1, journal.stats()['segments'])
+        eq_(3, len(self._stored()))
+
+    def test_background_retries(self):
+        journal = self._makeOne(storage=FailingStorage(), flush_interval=0.01,
+                                retry_interval=0.01)
+        journal.start()
+        journal.append('app', 'weak', False, [(self.queue, 'first', 3600, {})])
+        time.sleep(0.1)
+        stats = journal.stats()
+        self.assertTrue(stats['failures'] > 0)
+        eq_(1, stats['backlog'])
+        self.assertTrue(stats['lag'] > 0)
+
+        journal.storage = self.storage
+        time.sleep(0.1)
+        stats = journal.stats()
+        eq_(0, stats['backlog'])
+        eq_(0, stats['lag'])
+        eq_(1, len(self._stored()))
@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import threading
+import time
+import unittest
+
+from nose.tools import eq_
+
+
+class TestNotifier(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from queuey.notify import Notifier
+        return Notifier(**kwargs)
+
+    def test_no_wait(self):
+        notifier = self._makeOne()
+        eq_([], notifier.wait(['a'], 0, lambda: []))
+
+    def test_timeout(self):
+        notifier = self._makeOne(recheck_interval=0.05)
+        checks = []
+
+        def check():
+            checks.append(1)
+            return False
+        start = time.time()
+        eq_(False, notifier.wait(['a'], 0.2, check))
+        assert time.time() - start >= 0.2
+        assert len(checks) > 2
+        eq_(0, notifier.waiters)
+        eq_({}, dict(notifier._events))
+
+    def test_notify(self):
+        notifier = self._makeOne(recheck_interval=10)
+        messages = []
+
+        def push():
+            time.sleep(0.05)
+            messages.append('hello')
+            notifier.notify(['b', 'a'])
+        threading.Thread(target=push).start()
+        start = time.time()
+        eq_(['hello'], notifier.wait(['a'], 5, lambda: list(messages)))
+        assert time.time() - start < 1
+
+    def test_max_waiters(self):
+        notifier = self._makeOne(max_waiters=0)
+        start = time.time()
+        eq_(False, notifier.wait(['a'], 5, lambda: False))
+        assert time.time() - start < 1
@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+import unittest
+
+from nose.tools import eq_
+
+
+class RecordingMetadata(object):
+    def __init__(self):
+        self.stored = {}
+        self.commits = []
+        self.fail = False
+
+    def commit_offsets(self, offsets):
+        if self.fail:
+            raise Exception("Unavailable")
+        self.commits.append(offsets)
+        for key, partitions in offsets.items():
+            self.stored.setdefault(key, {}).update(partitions)
+
+    def consumer_offsets(self, application_name, queue_name, group):
+        return dict(self.stored.get((application_name, queue_name, group),
+                                    {}))
+
+
+class TestOffsetCommitter(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from queuey.offsets import OffsetCommitter
+        self.metadata = RecordingMetadata()
+        return OffsetCommitter(self.metadata, **kwargs)
+
+    def test_pending_offsets_visible(self):
+        committer = self._makeOne(interval=60)
+        committer.commit('app', 'queue', 'group', {1: 'a'})
+        committer.commit('app', 'queue', 'group', {1: 'b', 2: 'c'})
+        eq_({1: 'b', 2: 'c'}, committer.offsets('app', 'queue', 'group'))
+        eq_([], self.metadata.commits)
+        eq_({}, committer.offsets('app', 'queue', 'other'))
+
+    def test_flush_batches(self):
+        committer = self._makeOne(interval=60)
+        committer.commit('app', 'queue', 'group', {1: 'a'})
+        committer.commit('app', 'queue2', 'group', {1: 'b'})
+        committer.flush()
+        eq_(1, len(self.metadata.commits))
+        eq_({('app', 'queue', 'group'): {1: 'a'},
+             ('app', 'queue2', 'group'): {1: 'b'}}, self.metadata.commits[0])
+        committer.flush()
+        eq_(1, len(self.metadata.commits))
+
+    def test_interval(self):
+        committer = self._makeOne(interval=0.05)
+        committer.commit('app', 'queue', 'group', {1: 'a'})
+        time.sleep(0.2)
+        eq_({1: 'a'}, self.metadata.consumer_offsets('app', 'queue', 'group'))
+
+    def test_max_pending(self):
+        committer = self._makeOne(interval=60, max_pending=2)
+        committer.commit('app', 'queue', 'group', {1: 'a'})
+        committer.commit('app', 'queue', 'group', {1: 'b'})
+        time.sleep(0.1)
+        eq_([], self.metadata.commits)
+        committer.commit('app', 'queue', 'group', {2: 'c'})
+        time.sleep(0.1)
+        eq_([{('app', 'queue', 'group'): {1: 'b', 2: 'c'}}],
+            self.metadata.commits)
+
+    def test_failed_flush_retried(self):
+        committer = self._makeOne(interval=60)
+        committer.commit('app', 'queue', 'group', {1: 'a', 2: 'b'})
+        self.metadata.fail = True
+        committer.flush()
+        committer.commit('app', 'queue', 'group', {1: 'c'})
+        self.metadata.fail = False
+        committer.flush()
+        eq_({1: 'c', 2: 'b'},
+            self.metadata.consumer_offsets('app', 'queue', 'group'))
@@ -0,0 +1,216 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import gzip
+import json
+import StringIO
+import unittest
+
+from nose.tools import eq_
+from pyramid import testing
+from webob import Request
+
+
+class TestTokenBucket(unittest.TestCase):
+    def _makeOne(self, rate, capacity):
+        from queuey.ratelimit import TokenBucket
+        return TokenBucket(rate, capacity, 100)
+
+    def test_burst(self):
+        bucket = self._makeOne(2, 4)
+        eq_([0, 0, 0, 0], [bucket.take(1, 100) for x in range(4)])
+        eq_(0.5, bucket.take(1, 100))
+
+    def test_refill(self):
+        bucket = self._makeOne(2, 4)
+        bucket.take(4, 100)
+        eq_(0, bucket.take(1, 100.5))
+        eq_(0.5, bucket.take(1, 100.5))
+        # Never more than the capacity
+        eq_(0, bucket.take(4, 200))
+        eq_(0.5, bucket.take(1, 200))
+
+    def test_large_amount(self):
+        bucket = self._makeOne(10, 10)
+        eq_(0, bucket.take(25, 100))
+        eq_(1.1, bucket.take(1, 100.5))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from queuey.ratelimit import RateLimiter
+        return RateLimiter(**kwargs)
+
+    def test_disabled(self):
+        limiter = self._makeOne()
+        eq_(False, limiter.enabled)
+        for x in range(100):
+            limiter.check('app', 'queue', 'pushes')
+
+    def test_limits(self):
+        from queuey.ratelimit import RateLimited
+        limiter = self._makeOne(pushes=2, reads='10', burst=1)
+        limiter.check('app', 'queue', 'pushes')
+        limiter.check('app', 'queue', 'pushes')
+        try:
+            limiter.check('app', 'queue', 'pushes')
+        except RateLimited, exc:
+            eq_(429, exc.status)
+            eq_(1, exc.retry_after)
+        else:
+            self.fail("Not rate limited")
+        # Other applications and kinds have their own buckets
+        limiter.check('other', 'queue', 'pushes')
+        limiter.check('app', 'queue', 'reads')
+        limiter.check('app', 'queue', 'bytes', 1000000)
+
+    def test_overrides(self):
+        from queuey.ratelimit import RateLimited
+        limiter = self._makeOne(pushes=1, nodes=2, **{'big.pushes': '20'})
+        eq_(0.5, limiter.limit('app', 'pushes'))
+        eq_(10, limiter.limit('big', 'pushes'))
+        limiter.check('app', None, 'pushes')
+        self.assertRaises(RateLimited, limiter.check, 'app', None, 'pushes')
+        self.assertRaises(ValueError, self._makeOne, **{'big.posts': 1})
+
+    def test_per_queue(self):
+        from queuey.ratelimit import RateLimited
+        limiter = self._makeOne(reads=1, per_queue='true')
+        limiter.check('app', 'one', 'reads')
+        limiter.check('app', 'two', 'reads')
+        self.assertRaises(RateLimited, limiter.check, 'app', 'one', 'reads')
+
+    def test_anonymous(self):
+        from queuey.ratelimit import RateLimited
+        limiter = self._makeOne(reads=1, **{'app.reads': 2})
+        limiter.check('app', None, 'reads', anonymous=True)
+        limiter.check('app', None, 'reads', anonymous=True)
+        # Anonymous requests of an application share its limits, but not
+        # the buckets of its own requests or those of other applications
+        self.assertRaises(RateLimited, limiter.check, 'app', None, 'reads',
+                          anonymous=True)
+        limiter.check('app', None, 'reads')
+        limiter.check('other', None, 'reads', anonymous=True)
+        self.assertRaises(RateLimited, limiter.check, 'other', None,
+                          'reads', anonymous=True)
+
+    def test_max_buckets(self):
+        from queuey.ratelimit import RateLimited
+        limiter = self._makeOne(reads=1, per_queue='true', max_buckets=2)
+        limiter.check('app', 'one', 'reads')
+        limiter.check('app', 'two', 'reads')
+        # Further queues share the bucket of the application
+        limiter.check('app', 'three', 'reads')
+        self.assertRaises(RateLimited, limiter.check, 'app', 'four', 'reads')
+        eq_(3, len(limiter._buckets))
+        # Buckets that refilled are dropped
+        for bucket in limiter._buckets.values():
+            bucket.updated -= 10
+        limiter._swept -= 10
+        limiter.check('app', 'five', 'reads')
+        eq_([('app', False, 'five', 'reads')], limiter._buckets.keys())
+
+
+class TestRateLimitTween(unittest.TestCase):
+    def setUp(self):
+        from queuey.encoding import GzipEncoding
+        self.config = testing.setUp()
+        self.config.registry['metlog_client'] = self
+        self.config.registry['gzip_encoding'] = GzipEncoding()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def incr(self, name):
+        self.limited = name
+
+    def _makeOne(self, **kwargs):
+        from queuey.ratelimit import RateLimiter
+        from queuey.ratelimit import ratelimit_tween_factory
+        registry = self.config.registry
+        registry['rate_limiter'] = RateLimiter(**kwargs)
+        return ratelimit_tween_factory(lambda request: 'handled', registry)
+
+    def _call(self, tween, path, method='GET', body=None, headers=None):
+        request = Request.blank(path, method=method, body=body,
+                                headers=headers)
+        request.registry = self.config.registry
+        return tween(request)
+
+    def test_classify(self):
+        from queuey.ratelimit import classify
+
+        def check(path, method='GET'):
+            return classify(Request.blank(path, method=method))
+        eq_(('app', 'queue', ('pushes', 'bytes')),
+            check('/v1/app/queue', 'POST'))
+        eq_(('app', None, ('pushes', 'bytes')),
+            check('/v1/app/@@push', 'POST'))
+        eq_(('app', 'queue', ('reads',)), check('/v1/app/queue'))
+        eq_(('app', 'queue', ('reads',)), check('/v1/app/queue/1:abc'))
+        eq_(('app', 'queue', ('reads',)),
+            check('/v1/app/queue/@@claim', 'POST'))
+        eq_(('app', None, ('reads',)), check('/v1/app/@@fetch', 'POST'))
+        eq_(('app', None, ()), check('/v1/app', 'POST'))
+        eq_(('app', 'queue', ()), check('/v1/app/queue', 'DELETE'))
+        eq_((None, None, ()), check('/__heartbeat__'))
+
+    def test_disabled(self):
+        tween = self._makeOne()
+        eq_('handled', tween(None))
+
+    def test_limited(self):
+        tween = self._makeOne(pushes=100, bytes=10)
+        eq_('handled', self._call(tween, '/v1/app/queue', 'POST', 'x' * 10))
+        response = self._call(tween, '/v1/app/queue', 'POST', 'x' * 10)
+        eq_(429, response.status_int)
+        eq_('1', response.headers['Retry-After'])
+        eq_('error', json.loads(response.body)['status'])
+        eq_('app.anonymous.rate_limited', self.limited)
+        # Reads aren't limited
+        eq_('handled', self._call(tween, '/v1/app/queue'))
+
+    def test_decoded_bytes(self):
+        tween = self._makeOne(bytes=100)
+        body = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as gzip_file:
+            gzip_file.write('x' * 1000)
+        headers = {'Content-Encoding': 'gzip'}
+        request = Request.blank('/v1/app/queue', method='POST',
+                                body=body.getvalue(), headers=headers)
+        request.registry = self.config.registry
+        # The compressed body is small, but the decoded one is counted
+        assert request.content_length < 100
+        eq_('handled', tween(request))
+        eq_(429, self._call(tween, '/v1/app/queue', 'POST', body.getvalue(),
+                            headers).status_int)
+        # Views get the body decoded already
+        eq_('x' * 1000, self.config.registry['gzip_encoding'].decode_body(
+            request))
+        # Broken bodies are left to the views
+        tween = self._makeOne(bytes=100)
+        eq_('handled', self._call(tween, '/v1/app/queue', 'POST', 'x',
+                                  headers))
+
+    def test_authenticated_application(self):
+        from pyramid.authorization import ACLAuthorizationPolicy
+        from queuey.security import QueueyAuthenticationPolicy
+        self.config.set_authorization_policy(ACLAuthorizationPolicy())
+        self.config.set_authentication_policy(QueueyAuthenticationPolicy())
+        self.config.registry['app_keys'] = {'key': 'owner'}
+        tween = self._makeOne(reads=1)
+        request = Request.blank('/v1/app/queue',
+                                headers={'Authorization': 'Application key'})
+        request.registry = self.config.registry
+        eq_('handled', tween(request))
+        eq_(429, tween(request).status_int)
+        eq_('owner.rate_limited', self.limited)
+        # Anonymous requests aren't charged to the application in the URL
+        tween = self._makeOne(reads=1)
+        eq_('handled', self._call(tween, '/v1/owner/queue'))
+        eq_(429, self._call(tween, '/v1/owner/queue').status_int)
+        eq_('handled', tween(request))
+        eq_('handled', self._call(tween, '/v1/other/queue'))
+        # Invalid keys are rejected by the views
+        request.headers['Authorization'] = 'Application other'
+        eq_('handled', tween(request))
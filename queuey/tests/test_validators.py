@@ -0,0 +1,65 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+
+import colander
+from nose.tools import eq_
+
+
+class TestDeserializeMessages(unittest.TestCase):
+    def _colander(self, messages, max_partition):
+        from queuey.validators import MessageList
+        schema = MessageList().bind(max_partition=max_partition)
+        try:
+            return schema.deserialize(messages)
+        except colander.Invalid, exc:
+            return exc.asdict()
+
+    def _fast(self, messages, max_partition):
+        from queuey.validators import deserialize_messages
+        try:
+            return deserialize_messages(messages, max_partition)
+        except colander.Invalid, exc:
+            return exc.asdict()
+
+    def _check(self, messages, max_partition=3):
+        eq_(self._colander(messages, max_partition),
+            self._fast(messages, max_partition))
+
+    def test_valid(self):
+        self._check([])
+        self._check([{'body': u'hello'}])
+        self._check([{'body': 'hello', 'partition': 3, 'ttl': 2 ** 25}])
+        self._check([{'body': u'hello', 'partition': '2', 'ttl': '60'}])
+        self._check([{'body': u'hello', 'partition': None, 'ttl': None,
+                      'other': 1}])
+
+    def test_invalid(self):
+        self._check([{'body': u''}])
+        self._check([{'partition': 1}])
+        self._check([{'body': u'hello'}, {'body': u'hello', 'partition': 4}])
+        self._check([{'body': u'hello', 'partition': 0}])
+        self._check([{'body': u'hello', 'partition': 'fred'}])
+        self._check([{'body': u'hello', 'ttl': 0}])
+        self._check([{'body': u'hello', 'ttl': 2 ** 25 + 1}])
+        self._check([{'body': u'hello', 'ttl': -5}])
+        self._check([{'body': u'hello', 'partition': True}])
+        self._check([{'body': 5}])
+        self._check(['hello'])
+        self._check({'body': u'hello'})
+
+    def test_single_message(self):
+        from queuey.validators import Message
+        from queuey.validators import deserialize_message
+        schema = Message().bind(max_partition=2)
+        for msg in [{'body': 'hello', 'partition': '2', 'ttl': None},
+                    {'body': 'hello', 'partition': None, 'ttl': '3600'}]:
+            eq_(schema.deserialize(msg), deserialize_message(msg, 2))
+
+    def test_bound_schema_cache(self):
+        from queuey.validators import MessageList
+        from queuey.validators import bound_schema
+        schema = bound_schema(MessageList, max_partition=5)
+        assert schema is bound_schema(MessageList, max_partition=5)
+        assert schema is not bound_schema(MessageList, max_partition=6)
@@ -7,7 +7,17 @@ import uuid
 import colander
 
 BID_REGEX = re.compile(r'^(bid:\w+@\w+\.\w+|app:\w+)$')
+GROUP_REGEX = re.compile(r'^[\w\-\.]{1,50}$')
 INT_REGEX = re.compile(r'^\d+$')
+DEFAULT_TTL = 60 * 60 * 24 * 3
+MAX_TTL = 2 ** 25
+MAX_FETCH_QUEUES = 500
+MAX_GROUP_TIMEOUT = 300
+MAX_PUSH_MESSAGES = 1000
+MAX_DELETE_MESSAGES = 10000
+
+# Bound schemas are never modified, so they are shared between requests
+_bound_schemas = {}
 
 
 @colander.deferred
@@ -38,6 +48,12 @@ def principle_validator(node, value):
                                    value)
 
 
+def partition_list(node, value):
+    """Like :func:`comma_int_list`, also allowing `all` partitions"""
+    if value != ['all']:
+        comma_int_list(node, value)
+
+
 def comma_int_list(node, value):
     msg = ('%r is not a valid comma separated list of integers or a single '
            'integer.' % value)
@@ -53,10 +69,91 @@ class GetMessages(colander.MappingSchema):
     order = colander.SchemaNode(colander.String(), missing="ascending",
                                 validator=colander.OneOf(['descending',
                                                           'ascending']))
+    partitions = colander.SchemaNode(CommaList(), missing=[1],
+                                    validator=partition_list)
+    merge = colander.SchemaNode(colander.Bool(), missing=False)
+    wait = colander.SchemaNode(colander.Int(), missing=0,
+                               validator=colander.Range(0, 60))
+    cursor = colander.SchemaNode(colander.String(), missing=None)
+    group = colander.SchemaNode(colander.String(), missing=None,
+                                validator=colander.Regex(GROUP_REGEX))
+    commit = colander.SchemaNode(colander.Bool(), missing=False)
+    generation = colander.SchemaNode(colander.String(), missing=None)
+    member = colander.SchemaNode(colander.String(), missing=None,
+                                 validator=colander.Regex(GROUP_REGEX))
+
+
+class Claim(colander.MappingSchema):
+    limit = colander.SchemaNode(colander.Int(), missing=10,
+                                validator=colander.Range(1, 1000))
+    lease = colander.SchemaNode(colander.Int(), missing=60,
+                                validator=colander.Range(1, 60 * 60 * 12))
+    partitions = colander.SchemaNode(CommaList(), missing=[1],
+                                    validator=comma_int_list)
+
+
+class ConsumerGroup(colander.MappingSchema):
+    group = colander.SchemaNode(colander.String(),
+                                validator=colander.Regex(GROUP_REGEX))
+
+
+class CommitOffsets(ConsumerGroup):
+    generation = colander.SchemaNode(colander.String(), missing=None)
+    member = colander.SchemaNode(colander.String(), missing=None,
+                                 validator=colander.Regex(GROUP_REGEX))
+
+
+class JoinGroup(ConsumerGroup):
+    member = colander.SchemaNode(colander.String(), missing=None,
+                                 validator=colander.Regex(GROUP_REGEX))
+    timeout = colander.SchemaNode(colander.Int(), missing=30,
+                                  validator=colander.Range(
+                                      1, MAX_GROUP_TIMEOUT))
+
+
+class LeaveGroup(ConsumerGroup):
+    member = colander.SchemaNode(colander.String(),
+                                 validator=colander.Regex(GROUP_REGEX))
+
+
+class Events(colander.MappingSchema):
+    since = colander.SchemaNode(colander.String(), missing=None)
     partitions = colander.SchemaNode(CommaList(), missing=[1],
                                     validator=comma_int_list)
 
 
+def unique_queue_names(node, value):
+    names = [x['queue_name'] for x in value]
+    if len(set(names)) != len(names):
+        raise colander.Invalid(node, 'Every queue may only be listed once.')
+
+
+class PartitionList(colander.SequenceSchema):
+    partition = colander.SchemaNode(colander.Int(),
+                                    validator=colander.Range(1, 200))
+
+
+class FetchQueue(colander.MappingSchema):
+    queue_name = colander.SchemaNode(colander.String(),
+                                     validator=colander.Length(1, 50))
+    partitions = PartitionList(missing=[1], validator=colander.Length(min=1))
+    since = colander.SchemaNode(colander.String(), missing=None)
+    limit = colander.SchemaNode(colander.Int(), missing=None,
+                                validator=colander.Range(1, 1000))
+
+
+class FetchQueueList(colander.SequenceSchema):
+    queue = FetchQueue()
+
+
+class FetchMessages(colander.MappingSchema):
+    queues = FetchQueueList(validator=colander.All(
+        colander.Length(1, MAX_FETCH_QUEUES), unique_queue_names))
+    order = colander.SchemaNode(colander.String(), missing="ascending",
+                                validator=colander.OneOf(['descending',
+                                                          'ascending']))
+
+
 class UpdateQueue(colander.MappingSchema):
     partitions = colander.SchemaNode(colander.Int(), missing=None,
                                      validator=colander.Range(1, 200))
@@ -67,6 +164,9 @@ class UpdateQueue(colander.MappingSchema):
             ['weak', 'strong', 'very_strong']))
     principles = colander.SchemaNode(colander.String(), missing=None,
                                       validator=principle_validator)
+    compression = colander.SchemaNode(
+        colander.String(), missing=None, validator=colander.OneOf(
+            ['none', 'zlib']))
 
 
 class NewQueue(colander.MappingSchema):
@@ -81,6 +181,9 @@ class NewQueue(colander.MappingSchema):
             ['weak', 'strong', 'very_strong']))
     principles = colander.SchemaNode(colander.String(), missing=None,
                                       validator=principle_validator)
+    compression = colander.SchemaNode(
+        colander.String(), missing=None, validator=colander.OneOf(
+            ['none', 'zlib']))
 
 
 class QueueList(colander.MappingSchema):
@@ -95,9 +198,91 @@ class Message(colander.MappingSchema):
                                validator=colander.Length(min=1))
     partition = colander.SchemaNode(colander.Int(), missing=None,
                                     validator=max_queue_partition)
-    ttl = colander.SchemaNode(colander.Int(), missing=60 * 60 * 24 * 3,
-                              validator=colander.Range(1, 2 ** 25))
+    ttl = colander.SchemaNode(colander.Int(), missing=DEFAULT_TTL,
+                              validator=colander.Range(1, MAX_TTL))
 
 
 class MessageList(colander.SequenceSchema):
     message = Message()
+
+
+def bound_schema(schema_class, **kw):
+    """Return a cached instance of ``schema_class`` bound to ``kw``"""
+    key = (schema_class, tuple(sorted(kw.items())))
+    schema = _bound_schemas.get(key)
+    if schema is None:
+        schema = _bound_schemas[key] = schema_class().bind(**kw)
+    return schema
+
+
+def _fast_int(value):
+    """Convert what :class:`colander.Int` surely accepts, returns None
+    otherwise"""
+    if type(value) in (int, long):
+        return value
+    elif type(value) in (str, unicode) and INT_REGEX.match(value):
+        return int(value)
+    return None
+
+
+def _fast_message(msg, max_partition):
+    """Deserialize a valid message like :class:`Message` does
+
+    Only the common case of a well-formed message is handled, None is
+    returned for anything else so the caller can fall back to colander
+    for the exact result or errors.
+
+    """
+    if type(msg) is not dict:
+        return None
+    body = msg.get('body')
+    if type(body) is str:
+        try:
+            body = unicode(body)
+        except UnicodeDecodeError:
+            return None
+    elif type(body) is not unicode:
+        return None
+    if not body:
+        return None
+
+    partition = msg.get('partition')
+    if partition is not None:
+        partition = _fast_int(partition)
+        if partition is None or not 1 <= partition <= max_partition:
+            return None
+
+    ttl = msg.get('ttl')
+    if ttl is None:
+        ttl = DEFAULT_TTL
+    else:
+        ttl = _fast_int(ttl)
+        if ttl is None or not 1 <= ttl <= MAX_TTL:
+            return None
+    return {'body': body, 'partition': partition, 'ttl': ttl}
+
+
+def deserialize_message(msg, max_partition):
+    """Deserialize a message, with the same results and errors as
+    :class:`Message` bound to ``max_partition``"""
+    result = _fast_message(msg, max_partition)
+    if result is None:
+        schema = bound_schema(Message, max_partition=max_partition)
+        result = schema.deserialize(msg)
+    return result
+
+
+def deserialize_messages(messages, max_partition):
+    """Deserialize a list of messages, with the same results and errors as
+    :class:`MessageList` bound to ``max_partition``"""
+    if type(messages) is list:
+        result = []
+        for msg in messages:
+            msg = _fast_message(msg, max_partition)
+            if msg is None:
+                break
+            result.append(msg)
+        else:
+            return result
+    schema = bound_schema(MessageList, max_partition=max_partition)
+    return schema.deserialize(messages)
@@ -1,16 +1,36 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import base64
+import itertools
 import random
+import uuid
 
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.security import has_permission
 from pyramid.view import view_config
 import ujson
 
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
 from queuey import validators
 
 from queuey.resources import Application
 from queuey.resources import Queue
 from queuey.resources import MessageBatch
+from queuey.resources import Root
+from queuey.resources import parse_offsets
+from queuey.storage.util import encode_binary
+
+MSGPACK = 'application/x-msgpack'
+NDJSON = 'application/x-ndjson'
+
+# Amount of messages read and written at once for streamed responses
+STREAM_CHUNK_SIZE = 100
 
 
 class InvalidParameter(Exception):
@@ -18,11 +38,39 @@ class InvalidParameter(Exception):
     status = 400
 
 
+def raw_bodies(value):
+    """Return the response with base64 encoded binary bodies decoded,
+    including those of the per queue results of a fetch"""
+    queues = value.get('queues')
+    if isinstance(queues, dict):
+        value = value.copy()
+        value['queues'] = dict((name, raw_bodies(result))
+                               for name, result in queues.iteritems())
+    messages = value.get('messages')
+    if not messages:
+        return value
+    value = value.copy()
+    value['messages'] = raw = []
+    for msg in messages:
+        if msg.get('encoding') == 'base64':
+            msg = msg.copy()
+            del msg['encoding']
+            msg['body'] = base64.b64decode(msg['body'])
+        raw.append(msg)
+    return value
+
+
 class UJSONRendererFactory:
+    """Renders JSON, or MessagePack if the client prefers it"""
     def __init__(self, info):
         pass
 
     def __call__(self, value, system):
+        request = system.get('request')
+        if msgpack is not None and request is not None and \
+           request.accept.best_match(['application/json', MSGPACK]) == MSGPACK:
+            request.response.content_type = MSGPACK
+            return msgpack.packb(raw_bodies(value))
         return ujson.dumps(value)
 
 
@@ -34,7 +82,15 @@ class UJSONRendererFactory:
 @view_config(context='queuey.resources.InvalidQueueName')
 @view_config(context='queuey.resources.InvalidUpdate')
 @view_config(context='queuey.resources.InvalidMessageID')
+@view_config(context='queuey.resources.InvalidCursor')
+@view_config(context='queuey.resources.StaleGeneration')
+@view_config(context='queuey.resources.UnassignedPartitions')
+@view_config(context='queuey.resources.MessagesPending')
 @view_config(context='queuey.storage.StorageUnavailable')
+@view_config(context='queuey.events.TooManySubscribers')
+@view_config(context='queuey.encoding.RequestTooLarge')
+@view_config(context='queuey.encoding.InvalidContentEncoding')
+@view_config(context='queuey.encoding.UnsupportedContentEncoding')
 def bad_params(context, request):
     exc = request.exception
     cls_name = exc.__class__.__name__
@@ -55,6 +111,14 @@ def bad_params(context, request):
     }
 
 
+@view_config(context=Root, name='__journal__', request_method='GET')
+def journal_stats(context, request):
+    journal = request.registry['journal']
+    if journal is None:
+        raise HTTPNotFound("No journal is configured.")
+    return dict(status='ok', **journal.stats())
+
+
 @view_config(context=Application, request_method='POST',
              permission='create_queue')
 def create_queue(context, request):
@@ -75,6 +139,40 @@ def queue_list(context, request):
     }
 
 
+@view_config(context=Application, name='fetch', request_method='POST',
+             permission='fetch')
+def fetch_messages(context, request):
+    try:
+        data = ujson.loads(request_body(request))
+    except:
+        raise InvalidParameter("Unable to properly deserialize JSON body.")
+    params = validators.FetchMessages().deserialize(data)
+    return {
+        'status': 'ok',
+        'queues': context.fetch(**params)
+    }
+
+
+@view_config(context=Application, name='push', request_method='POST',
+             permission='push')
+def push_to_queues(context, request):
+    try:
+        msgs = ujson.loads(request_body(request))['messages']
+    except:
+        raise InvalidParameter("Unable to properly deserialize JSON body.")
+    if type(msgs) is not list or \
+       not 1 <= len(msgs) <= validators.MAX_PUSH_MESSAGES:
+        raise InvalidParameter("Between 1 and %s messages are required." %
+                               validators.MAX_PUSH_MESSAGES)
+    results = context.push(msgs)
+    # Journaled messages are accepted but not stored yet
+    request.response.status = 202 if context.journaled else 201
+    return {
+        'status': 'ok',
+        'messages': results
+    }
+
+
 @view_config(context=Queue, request_method='PUT', permission='create_queue')
 def update_queue(context, request):
     params = validators.UpdateQueue().deserialize(request.POST)
@@ -85,52 +183,292 @@ def update_queue(context, request):
         partitions=context.partitions,
         created=context.created,
         principles=context.principles,
-        type=context.type
+        type=context.type,
+        compression=getattr(context, 'compression', 'none')
     )
 
 
+def request_body(request):
+    """Return the request body, decoded from its Content-Encoding"""
+    return request.registry['gzip_encoding'].decode_body(request)
+
+
+def push_messages(context, request, msgs, binary=False):
+    """Validate and push a batch of deserialized messages, with
+    ``binary`` byte string bodies are stored as they are"""
+    request.response.status = 202 if context.journaled else 201
+    metadata = []
+    if binary and type(msgs) is list:
+        for msg in msgs:
+            metadata.append({})
+            if isinstance(msg, dict) and isinstance(msg.get('body'), str):
+                msg['body'] = encode_binary(msg['body'], metadata[-1])
+    msgs = validators.deserialize_messages(msgs, context.partitions)
+    for index, msg in enumerate(msgs):
+        if not msg['partition']:
+            msg['partition'] = random.randint(1, context.partitions)
+        if metadata and metadata[index]:
+            msg['metadata'] = metadata[index]
+    return {
+        'status': 'ok',
+        'messages': context.push_batch(msgs)
+    }
+
+
 @view_config(context=Queue, request_method='POST', permission='create',
              header="Content-Type:application/json")
 def new_messages(context, request):
-    request.response.status = 201
+    body = request_body(request)
     try:
-        msgs = ujson.loads(request.body)['messages']
+        msgs = ujson.loads(body)['messages']
     except:
         # A bare except like this is horrible, but we need to toss this right
         raise InvalidParameter("Unable to properly deserialize JSON body.")
-    schema = validators.MessageList().bind(max_partition=context.partitions)
-    msgs = schema.deserialize(msgs)
-    for msg in msgs:
-        if not msg['partition']:
-            msg['partition'] = random.randint(1, context.partitions)
-    return {
-        'status': 'ok',
-        'messages': context.push_batch(msgs)
-    }
+    return push_messages(context, request, msgs)
+
+
+@view_config(context=Queue, request_method='POST', permission='create',
+             header="Content-Type:%s" % MSGPACK)
+def new_messages_msgpack(context, request):
+    if msgpack is None:
+        raise InvalidParameter("MessagePack is not supported.")
+    body = request_body(request)
+    try:
+        msgs = msgpack.unpackb(body)['messages']
+    except:
+        raise InvalidParameter("Unable to properly deserialize "
+                               "MessagePack body.")
+    return push_messages(context, request, msgs, binary=True)
 
 
 @view_config(context=Queue, request_method='POST', permission='create')
 def new_message(context, request):
-    request.response.status = 201
-    msg = {'body': request.body,
+    body = request_body(request)
+    request.response.status = 202 if context.journaled else 201
+    metadata = {}
+    msg = {'body': encode_binary(body, metadata),
            'ttl': request.headers.get('X-TTL'),
            'partition': request.headers.get('X-Partition')}
-    schema = validators.Message().bind(max_partition=context.partitions)
-    msg = schema.deserialize(msg)
+    msg = validators.deserialize_message(msg, context.partitions)
     if not msg['partition']:
         msg['partition'] = random.randint(1, context.partitions)
+    if metadata:
+        msg['metadata'] = metadata
     return {
         'status': 'ok',
         'messages': context.push_batch([msg])
     }
 
 
+def stream_messages(messages, request):
+    """Return a response writing the messages as one JSON object per line,
+    a chunk at a time"""
+    def chunks():
+        lines = []
+        for msg in messages:
+            lines.append(ujson.dumps(msg))
+            if len(lines) >= STREAM_CHUNK_SIZE:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    app_iter = chunks()
+    # Read the first chunk before answering, so a failing storage still
+    # results in an error response
+    first = next(app_iter, None)
+    response = request.response
+    response.content_type = NDJSON
+    if first is None:
+        response.app_iter = []
+    else:
+        response.app_iter = itertools.chain([first], app_iter)
+    return response
+
+
+def committing(messages, context, group):
+    """Commit the offsets of the streamed messages once done"""
+    offsets = {}
+    try:
+        for msg in messages:
+            offsets[msg['partition']] = msg['message_id']
+            yield msg
+    finally:
+        if offsets:
+            context.commit_offsets(group, offsets)
+
+
 @view_config(context=Queue, request_method='GET', permission='view')
 def get_messages(context, request):
     params = validators.GetMessages().deserialize(request.GET)
+    params['partitions'] = context.partition_list(params['partitions'])
+    group = params.pop('group')
+    commit = params.pop('commit')
+    generation = params.pop('generation')
+    member = params.pop('member')
+    if group:
+        if params['cursor']:
+            raise InvalidParameter("Either a cursor or a group can be "
+                                   "given.")
+        params['cursor'] = context.group_cursor(group)
+    elif commit:
+        raise InvalidParameter("Committing requires a group.")
+    if commit and not has_permission('delete', context, request):
+        # Readers of public queues mustn't move the offsets of others
+        raise HTTPForbidden("Committing offsets requires the permission to "
+                            "delete messages.")
+    if commit:
+        context.check_assignment(group, generation, member,
+                                 params['partitions'])
+    variant = request.accept.best_match(['application/json', NDJSON,
+                                         MSGPACK])
+    if not params['wait']:
+        etag = context.etag(variant, since=params['since'],
+                            limit=params['limit'], order=params['order'],
+                            partitions=params['partitions'],
+                            cursor=params['cursor'], merge=params['merge'])
+        if etag:
+            request.response.etag = etag
+            if etag in request.if_none_match:
+                response = request.response
+                response.status = 304
+                del response.content_type
+                return response
+    if request.accept.best_match(['application/json', NDJSON]) == NDJSON:
+        messages = context.iter_messages(chunk_size=STREAM_CHUNK_SIZE,
+                                         **params)
+        if commit:
+            messages = committing(messages, context, group)
+        return stream_messages(messages, request)
+    if variant == 'application/json' and not params['merge']:
+        return json_messages(context, request, params, group, commit)
+    messages = context.get_messages(**params)
+    if commit and messages:
+        context.commit_offsets(group, dict(
+            (x['partition'], x['message_id']) for x in messages))
+    return {
+        'status': 'ok',
+        'messages': messages,
+        'cursor': context.next_cursor(messages, params['partitions'],
+                                      params['since'], params['cursor'])
+    }
+
+
+def json_messages(context, request, params, group, commit):
+    """Answer a message read with JSON written straight from the storage
+    rows, the same JSON the renderer writes for the message dicts"""
+    del params['merge']
+    rows = context.get_rows(**params)
+    if commit and rows:
+        context.commit_offsets(group, dict(rows.positions()))
+    cursor = context.next_cursor(rows, params['partitions'],
+                                 params['since'], params['cursor'])
+    response = request.response
+    response.body = '{"status":"ok","messages":%s,"cursor":%s}' % (
+        rows.encode(), ujson.dumps(cursor))
+    return response
+
+
+@view_config(context=Queue, name='claim', request_method='POST',
+             permission='delete')
+def claim_messages(context, request):
+    params = validators.Claim().deserialize(request.params)
+    claim_id, messages = context.claim(**params)
+    return {
+        'status': 'ok',
+        'claim': claim_id,
+        'lease': params['lease'],
+        'messages': messages
+    }
+
+
+@view_config(context=Queue, name='offsets', request_method='GET',
+             permission='view')
+def get_offsets(context, request):
+    params = validators.ConsumerGroup().deserialize(request.GET)
+    offsets = context.offsets(params['group'])
+    return {
+        'status': 'ok',
+        'group': params['group'],
+        'offsets': dict((str(x), y) for x, y in offsets.items())
+    }
+
+
+@view_config(context=Queue, name='offsets', request_method='POST',
+             permission='delete')
+def commit_offsets(context, request):
+    try:
+        data = ujson.loads(request_body(request))
+        offsets = data['offsets']
+    except:
+        raise InvalidParameter("Unable to properly deserialize JSON body.")
+    params = validators.CommitOffsets().deserialize(data)
+    offsets = parse_offsets(offsets, context.partitions)
+    context.check_assignment(params['group'], params['generation'],
+                             params['member'], offsets)
+    offsets = context.commit_offsets(params['group'], offsets)
+    return {
+        'status': 'ok',
+        'group': params['group'],
+        'offsets': dict((str(x), y) for x, y in offsets.items())
+    }
+
+
+@view_config(context=Queue, name='join', request_method='POST',
+             permission='delete')
+def join_group(context, request):
+    params = validators.JoinGroup().deserialize(request.params)
+    member = params['member'] or uuid.uuid4().hex
+    members, generation, partitions = context.join(
+        params['group'], member, params['timeout'])
+    return {
+        'status': 'ok',
+        'group': params['group'],
+        'member': member,
+        'members': len(members),
+        'generation': generation,
+        'timeout': params['timeout'],
+        'partitions': partitions
+    }
+
+
+@view_config(context=Queue, name='leave', request_method='POST',
+             permission='delete')
+def leave_group(context, request):
+    params = validators.LeaveGroup().deserialize(request.params)
+    context.leave(params['group'], params['member'])
+    return {'status': 'ok'}
+
+
+@view_config(context=Queue, name='events', request_method='GET',
+             permission='view')
+def events(context, request):
+    if not request.registry['event_hub'].enabled:
+        raise HTTPNotFound("Event streams aren't enabled.")
+    params = validators.Events().deserialize(request.GET)
+    since = request.headers.get('Last-Event-ID') or params['since']
+    response = request.response
+    response.content_type = 'text/event-stream'
+    response.cache_control = 'no-cache'
+    response.app_iter = context.subscribe(params['partitions'], since)
+    return response
+
+
+@view_config(context=Queue, name='delete', request_method='POST',
+             permission='delete')
+def delete_messages(context, request):
+    try:
+        message_ids = ujson.loads(request_body(request))['messages']
+    except:
+        raise InvalidParameter("Unable to properly deserialize JSON body.")
+    if type(message_ids) is not list or \
+       len(message_ids) > validators.MAX_DELETE_MESSAGES or \
+       [x for x in message_ids if not isinstance(x, basestring)]:
+        raise InvalidParameter("A list of up to %s message id's is "
+                               "required." % validators.MAX_DELETE_MESSAGES)
     return {
         'status': 'ok',
-        'messages': context.get_messages(**params)
+        'deleted': context.delete_messages(message_ids)
     }
 
 
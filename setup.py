@@ -56,6 +56,10 @@ setup(
     license="MPLv2.0",
     packages=find_packages(),
     test_suite="queuey.tests",
+    extras_require={
+        'gevent': ['gevent'],
+        'msgpack': ['msgpack-python'],
+    },
     include_package_data=True,
     zip_safe=False,
     tests_require=['pkginfo', 'Mock>=0.8rc2', 'nose', 'supervisor'],
@@ -63,6 +67,9 @@ setup(
     entry_points="""
         [paste.app_factory]
         main = queuey:main
+
+        [console_scripts]
+        queuey-migrate = queuey.migrate:main
     """,
 
 )